@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+acquisition.py
+
+Subscription based acquisition of the measured current (MEAS.I) of the
+spectrometer power converters. Samples are stored with their acquisition
+timestamps in a preallocated NumPy ring buffer, so that plots and checks can
+read the recent history of a magnet without a round trip per sample.
+"""
+
+import threading
+from time import sleep, monotonic
+
+import numpy as np
+
+from japc_session import get_japc
+
+
+class RingBuffer(object):
+
+    """
+    Fixed-size buffer of (timestamp, value) pairs. When full, the oldest
+    samples are overwritten. No memory is allocated when appending.
+
+    Arguments:
+
+        - capacity      Maximum number of samples held.
+    """
+
+    def __init__(self, capacity):
+
+        self.capacity = int(capacity)
+        self.times = np.empty(self.capacity)
+        self.values = np.empty(self.capacity)
+        self.count = 0
+        self.index = 0
+        self.lock = threading.Lock()
+
+    def append(self, timestamp, value):
+
+        with self.lock:
+
+            self.times[self.index] = timestamp
+            self.values[self.index] = value
+            self.index = (self.index + 1) % self.capacity
+            self.count = min(self.count + 1, self.capacity)
+
+    def clear(self):
+
+        with self.lock:
+
+            self.count = 0
+            self.index = 0
+
+    def last_time(self):
+
+        with self.lock:
+            return self.times[self.index - 1] if self.count else None
+
+    def span(self):
+
+        """
+        Returns the time covered by the samples in the buffer, in seconds.
+        """
+
+        with self.lock:
+
+            if self.count < 2:
+                return 0.
+
+            first = (self.index - self.count) % self.capacity
+            return self.times[self.index - 1] - self.times[first]
+
+    def read(self, window=None):
+
+        """
+        Returns copies of the buffered timestamps and values in chronological
+        order.
+
+        Arguments:
+
+            - window    If given, only samples from the last window seconds
+                        before the newest sample are returned.
+        """
+
+        with self.lock:
+
+            first = (self.index - self.count) % self.capacity
+
+            if first + self.count <= self.capacity:
+                times = self.times[first:first + self.count].copy()
+                values = self.values[first:first + self.count].copy()
+            else:
+                times = np.concatenate((self.times[first:],
+                                        self.times[:self.index]))
+                values = np.concatenate((self.values[first:],
+                                         self.values[:self.index]))
+
+        if window is not None and len(times):
+
+            start = np.searchsorted(times, times[-1] - window)
+            times, values = times[start:], values[start:]
+
+        return times, values
+
+
+class CurrentAcquisition(object):
+
+    """
+    Collects MEAS.I samples of one power converter from a JAPC subscription.
+
+    Arguments:
+
+        - device        Power converter device name.
+
+        - window        Length of history kept. Measured in seconds [s].
+
+        - rate          Maximum sample rate stored; faster updates are
+                        decimated. Measured in Hertz [Hz].
+
+        - japc          PyJapc instance to use. Defaults to the shared session.
+    """
+
+    def __init__(self, device, window=60., rate=50., japc=None):
+
+        self.parameter = device + '/MEAS.I'
+        self.window = float(window)
+        self.rate = float(rate)
+        self.buffer = RingBuffer(int(np.ceil(self.window * self.rate)) + 1)
+        self.running = False
+        self.listeners = []
+        self.stop_listeners = []
+        self._japc = japc
+        self._min_interval = 1. / self.rate
+
+    @property
+    def japc(self):
+
+        return self._japc if self._japc is not None else get_japc()
+
+    def add_listener(self, listener):
+
+        """
+        Registers a function listener(timestamp, value) which is called for
+        every sample stored in the buffer.
+        """
+
+        self.listeners = self.listeners + [listener]
+
+    def remove_listener(self, listener):
+
+        self.listeners = [item for item in self.listeners if item is not listener]
+
+    def add_stop_listener(self, listener):
+
+        """
+        Registers a function listener() which is called whenever the
+        acquisition stops, for example to flush what the listeners wrote.
+        """
+
+        self.stop_listeners = self.stop_listeners + [listener]
+
+    def start(self):
+
+        """
+        Subscribes to MEAS.I and starts filling the buffer.
+        """
+
+        if self.running:
+            return
+
+        japc = self.japc
+        japc.subscribeParam(self.parameter, onValueReceived=self._on_value,
+                            getHeader=True, unixtime=True)
+        japc.startSubscriptions(parameterName=self.parameter)
+        self.running = True
+
+    def stop(self):
+
+        """
+        Stops the MEAS.I subscription. The buffered samples are kept.
+        """
+
+        if not self.running:
+            return
+
+        japc = self.japc
+        japc.stopSubscriptions(parameterName=self.parameter)
+        japc.clearSubscriptions(parameterName=self.parameter)
+        self.running = False
+
+        for listener in self.stop_listeners:
+            listener()
+
+    def _on_value(self, parameter, value, header):
+
+        timestamp = header['acqStamp']
+        last = self.buffer.last_time()
+
+        if last is not None and timestamp - last < self._min_interval:
+            return
+
+        self.buffer.append(timestamp, value)
+
+        for listener in self.listeners:
+            listener(timestamp, value)
+
+    def wait_for(self, duration, timeout=5.):
+
+        """
+        Blocks until the buffer covers at least duration seconds, or until
+        duration plus timeout seconds have passed.
+        """
+
+        duration = min(duration, self.window)
+        deadline = monotonic() + duration + timeout
+
+        while self.buffer.span() < duration - self._min_interval:
+
+            if monotonic() >= deadline:
+                return False
+
+            sleep(min(0.1, duration / 10.))
+
+        return True
+
+    def read(self, window=None):
+
+        """
+        Returns the timestamps and currents of the buffered samples, optionally
+        restricted to the last window seconds.
+        """
+
+        return self.buffer.read(window)
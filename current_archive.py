@@ -0,0 +1,680 @@
+# -*- coding: utf-8 -*-
+"""
+current_archive.py
+
+Append-only archive of the measured current (MEAS.I) of the spectrometer
+magnets, to compare shifts and correlate with beam events long after the
+acquisition that produced the samples.
+
+Each magnet has a directory of chunk files holding a fixed number of
+(timestamp, current) records of two doubles, memory-mapped, so that appending
+a sample is two stores into the mapping and a range query is a binary search.
+Next to each chunk an index file holds the first and last time stamp, minimum,
+maximum, sum and number of samples of every block of BLOCK_RECORDS records,
+written as each block fills. Downsampled queries over long ranges are served
+from these block summaries, and only the records at the edges of the range
+are read.
+
+The archive is written to MAGNET_ARCHIVE, by default ~/magnet_archive against
+the control system and not at all against the simulator or a replay unless
+MAGNET_ARCHIVE is set; the backend is that of the shared JAPC session when the
+archive is first used. Samples are collected in memory and written in batches
+of up to BATCH_RECORDS samples or BATCH_INTERVAL seconds. Several processes may
+append to the same archive: each batch is written holding an exclusive lock on
+the lock file of the magnet directory, after picking up the samples and chunks
+added by the others. The archive is flushed when an acquisition feeding it
+stops, and flushed and closed when the process exits.
+"""
+
+import argparse
+import atexit
+import fcntl
+import os
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from time import monotonic, perf_counter
+
+import numpy as np
+
+from japc_session import provider
+
+ARCHIVE_PATH = os.environ.get('MAGNET_ARCHIVE')
+DEFAULT_PATH = os.path.expanduser('~/magnet_archive')
+
+# Records per chunk file, about 6 hours at 50 Hz, and per index block.
+CHUNK_RECORDS = 2 ** 20
+BLOCK_RECORDS = 1024
+
+# Samples collected before they are written, and the longest time a sample is
+# held back. Measured in seconds [s].
+BATCH_RECORDS = 64
+BATCH_INTERVAL = 1.
+
+MAGIC = int.from_bytes(b'MJMEASI1', 'little')
+HEADER_SIZE = 64
+
+RECORD = np.dtype([('time', '<f8'), ('value', '<f8')])
+SUMMARY = np.dtype([('first', '<f8'), ('last', '<f8'), ('min', '<f8'),
+                    ('max', '<f8'), ('sum', '<f8'), ('count', '<f8')])
+
+
+class ArchiveChunk(object):
+
+    """
+    One memory-mapped chunk file of records and its block index.
+
+    Arguments:
+
+        - path          Chunk file, without extension.
+
+        - capacity      Number of records of a new chunk.
+    """
+
+    def __init__(self, path, capacity=CHUNK_RECORDS):
+
+        self.path = path
+        data_path = path + '.dat'
+
+        if not os.path.exists(data_path):
+
+            # The file is extended sparsely, so a new chunk takes no disk
+            # space until it is filled.
+
+            with open(data_path, 'wb') as chunk:
+                np.array([MAGIC, 0, capacity, BLOCK_RECORDS],
+                         dtype='<u8').tofile(chunk)
+                chunk.truncate(HEADER_SIZE + capacity * RECORD.itemsize)
+
+            with open(path + '.idx', 'wb') as index:
+                index.truncate(capacity // BLOCK_RECORDS * SUMMARY.itemsize)
+
+        self.header = np.memmap(data_path, dtype='<u8', mode='r+',
+                                shape=(HEADER_SIZE // 8,))
+
+        if self.header[0] != MAGIC or self.header[3] != BLOCK_RECORDS:
+            raise ValueError("{} is not a MEAS.I archive chunk".format(
+                data_path))
+
+        self.capacity = int(self.header[2])
+        self.records = np.memmap(data_path, dtype=RECORD, mode='r+',
+                                 offset=HEADER_SIZE, shape=(self.capacity,))
+        self.times = self.records['time']
+        self.values = self.records['value']
+        self.summaries = np.memmap(path + '.idx', dtype=SUMMARY, mode='r+',
+                                   shape=(self.capacity // BLOCK_RECORDS,))
+        self.count = int(self.header[1])
+
+    @property
+    def full(self):
+
+        return self.count >= self.capacity
+
+    @property
+    def first_time(self):
+
+        return float(self.times[0]) if self.count else None
+
+    @property
+    def last_time(self):
+
+        return float(self.times[self.count - 1]) if self.count else None
+
+    def append(self, timestamp, value):
+
+        """
+        Appends one record. The count in the header is only advanced once the
+        record is written, so an interrupted append leaves no partial record.
+        """
+
+        index = self.count
+        self.times[index] = timestamp
+        self.values[index] = value
+        self.count = index + 1
+        self.header[1] = self.count
+
+        if self.count % BLOCK_RECORDS == 0:
+            self._summarise(self.count // BLOCK_RECORDS - 1)
+
+    def _summarise(self, block):
+
+        start = block * BLOCK_RECORDS
+        values = self.values[start:start + BLOCK_RECORDS]
+        self.summaries[block] = (self.times[start],
+                                 self.times[start + BLOCK_RECORDS - 1],
+                                 values.min(), values.max(), values.sum(),
+                                 BLOCK_RECORDS)
+
+    def search(self, start, stop):
+
+        """
+        Returns the record indices [first, last) of the samples in the time
+        range [start, stop).
+        """
+
+        times = self.times[:self.count]
+
+        return (int(np.searchsorted(times, start)),
+                int(np.searchsorted(times, stop)))
+
+    def flush(self):
+
+        self.records.flush()
+        self.header.flush()
+        self.summaries.flush()
+
+    def close(self):
+
+        """
+        Flushes the chunk and releases its mappings.
+        """
+
+        self.flush()
+        self.header = self.records = self.summaries = None
+        self.times = self.values = None
+
+
+class MagnetArchive(object):
+
+    """
+    Archive of the MEAS.I samples of one magnet.
+
+    Arguments:
+
+        - directory     Directory of the chunk files, created if needed.
+
+        - chunk_records Number of records per chunk file.
+    """
+
+    def __init__(self, directory, chunk_records=CHUNK_RECORDS):
+
+        self.directory = directory
+        self.chunk_records = chunk_records
+        self.lock = threading.Lock()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+
+        self.lock_file = open(os.path.join(directory, 'lock'), 'a')
+
+        # Coarse time index: first time stamp of every chunk, None for the
+        # newest while it is empty.
+        self.chunks = []
+        self.starts = []
+        self.last = None
+
+        # Samples not written yet, and chunks written since the last flush.
+        self.pending = []
+        self.written = monotonic()
+        self.dirty = set()
+        self.closed = False
+
+        with self.lock, self._file_locked():
+            self._refresh()
+
+    @contextmanager
+    def _file_locked(self):
+
+        """
+        Holds the lock file of the directory, which serialises writes with
+        those of other processes. Called with the thread lock held.
+        """
+
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+
+        try:
+            yield
+        finally:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+
+    def _open_chunks(self):
+
+        names = sorted(name[:-4] for name in os.listdir(self.directory)
+                       if name.endswith('.dat'))
+
+        for name in names[len(self.chunks):]:
+            chunk = ArchiveChunk(os.path.join(self.directory, name))
+            self.chunks.append(chunk)
+            self.starts.append(chunk.first_time)
+
+    def _refresh(self):
+
+        """
+        Picks up the samples and chunks appended by other processes. Called
+        with the lock held.
+        """
+
+        if self.chunks:
+            self.chunks[-1].count = int(self.chunks[-1].header[1])
+
+        # Other processes only start a chunk once the newest one is full.
+
+        if not self.chunks or self.chunks[-1].full:
+            self._open_chunks()
+
+        for index in reversed(range(len(self.chunks))):
+
+            chunk = self.chunks[index]
+            chunk.count = int(chunk.header[1])
+
+            if self.starts[index] is None:
+                self.starts[index] = chunk.first_time
+
+            if chunk.count:
+                self.last = chunk.last_time
+                break
+
+    def _new_chunk(self):
+
+        chunk = ArchiveChunk(os.path.join(self.directory, '{:06d}'.format(
+            int(os.path.basename(self.chunks[-1].path)) + 1
+            if self.chunks else 0)), self.chunk_records)
+        self.chunks.append(chunk)
+        self.starts.append(None)
+
+        return chunk
+
+    def append(self, timestamp, value):
+
+        """
+        Appends a sample. It is written with the next batch; samples not
+        newer than the last one are dropped, so that the archive stays sorted.
+        """
+
+        with self.lock:
+
+            if self.closed:
+                return
+
+            self.pending.append((timestamp, value))
+
+            if len(self.pending) >= BATCH_RECORDS or \
+                    monotonic() - self.written >= BATCH_INTERVAL:
+                self._write_pending()
+
+    def _write_pending(self):
+
+        """
+        Writes the collected samples under the lock file. Called with the
+        thread lock held.
+        """
+
+        self.written = monotonic()
+
+        if not self.pending:
+            return
+
+        with self._file_locked():
+
+            self._refresh()
+
+            for timestamp, value in self.pending:
+
+                if self.last is not None and timestamp <= self.last:
+                    continue
+
+                chunk = self.chunks[-1] if self.chunks else None
+
+                if chunk is None or chunk.full:
+                    chunk = self._new_chunk()
+
+                chunk.append(timestamp, value)
+                self.dirty.add(chunk)
+
+                if self.starts[-1] is None:
+                    self.starts[-1] = timestamp
+
+                self.last = timestamp
+
+        self.pending = []
+
+    def flush(self):
+
+        """
+        Writes the collected samples and flushes the chunks written since the
+        last flush to disk.
+        """
+
+        with self.lock:
+
+            if self.closed:
+                return
+
+            self._write_pending()
+
+            for chunk in self.dirty:
+                chunk.flush()
+
+            self.dirty.clear()
+
+    def close(self):
+
+        """
+        Flushes the archive and releases its files. Later samples are dropped.
+        """
+
+        self.flush()
+
+        with self.lock:
+
+            if self.closed:
+                return
+
+            for chunk in self.chunks:
+                chunk.close()
+
+            self.chunks = []
+            self.starts = []
+            self.lock_file.close()
+            self.closed = True
+
+    def _chunks_in(self, start, stop):
+
+        """
+        Returns the chunks which may hold samples in [start, stop).
+        """
+
+        with self.lock:
+
+            if self.closed:
+                return []
+
+            self._write_pending()
+
+            with self._file_locked():
+                self._refresh()
+
+            first = max(0, int(np.searchsorted(
+                [time for time in self.starts if time is not None], start,
+                side='right')) - 1)
+
+            return [chunk for chunk in self.chunks[first:] if chunk.count and
+                    chunk.first_time < stop and chunk.last_time >= start]
+
+    def read(self, start, stop):
+
+        """
+        Returns copies of the time stamps and currents of the samples in the
+        time range [start, stop), given as Unix times.
+        """
+
+        times, values = [], []
+
+        for chunk in self._chunks_in(start, stop):
+
+            first, last = chunk.search(start, stop)
+            times.append(np.array(chunk.times[first:last]))
+            values.append(np.array(chunk.values[first:last]))
+
+        if not times:
+            return np.empty(0), np.empty(0)
+
+        return np.concatenate(times), np.concatenate(values)
+
+    def downsample(self, start, stop, buckets=1000):
+
+        """
+        Returns the samples in [start, stop) reduced to a number of equal time
+        buckets, as arrays of bucket start times, minimum, maximum and mean
+        currents and sample counts. Empty buckets have NaN currents.
+
+        Where buckets are at least twice as wide as an index block, the
+        blocks falling entirely within a bucket are taken from the block
+        summaries, and only the samples of the other blocks and at the edges
+        of the range are read.
+        """
+
+        edges = np.linspace(start, stop, buckets + 1)
+        width = (stop - start) / float(buckets)
+
+        minimum = np.full(buckets, np.inf)
+        maximum = np.full(buckets, -np.inf)
+        total = np.zeros(buckets)
+        count = np.zeros(buckets)
+
+        for chunk in self._chunks_in(start, stop):
+
+            first, last = chunk.search(start, stop)
+            block_span = ((chunk.last_time - chunk.first_time) / chunk.count *
+                          BLOCK_RECORDS)
+
+            low = -(-first // BLOCK_RECORDS)
+            high = min(last // BLOCK_RECORDS, chunk.count // BLOCK_RECORDS)
+
+            if high <= low or block_span * 2 > width:
+                reduce_samples(chunk.times[first:last],
+                               chunk.values[first:last], edges,
+                               minimum, maximum, total, count)
+                continue
+
+            summaries = chunk.summaries[low:high]
+            bucket = np.searchsorted(edges, summaries['first'], 'right') - 1
+            inside = bucket == np.searchsorted(edges, summaries['last'],
+                                               'right') - 1
+
+            summaries, bucket = summaries[inside], bucket[inside]
+            np.minimum.at(minimum, bucket, summaries['min'])
+            np.maximum.at(maximum, bucket, summaries['max'])
+            np.add.at(total, bucket, summaries['sum'])
+            np.add.at(count, bucket, summaries['count'])
+
+            segments = [(first, low * BLOCK_RECORDS)] + \
+                [(block * BLOCK_RECORDS, (block + 1) * BLOCK_RECORDS)
+                 for block in low + np.nonzero(~inside)[0]] + \
+                [(high * BLOCK_RECORDS, last)]
+
+            reduce_samples(
+                np.concatenate([chunk.times[begin:end]
+                                for begin, end in segments]),
+                np.concatenate([chunk.values[begin:end]
+                                for begin, end in segments]),
+                edges, minimum, maximum, total, count)
+
+        empty = count == 0
+        minimum[empty] = maximum[empty] = np.nan
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = total / count
+
+        return edges[:-1], minimum, maximum, mean, count
+
+
+def reduce_samples(times, values, edges, minimum, maximum, total, count):
+
+    """
+    Accumulates sorted samples into the bucket minimum, maximum, total and
+    count arrays of the buckets delimited by edges.
+    """
+
+    starts = np.searchsorted(times, edges[:-1])
+    ends = np.searchsorted(times, edges[1:])
+    occupied = np.nonzero(ends > starts)[0]
+
+    if not len(occupied):
+        return
+
+    values = values[starts[occupied[0]]:ends[occupied[-1]]]
+    offsets = starts[occupied] - starts[occupied[0]]
+
+    minimum[occupied] = np.minimum(minimum[occupied],
+                                   np.minimum.reduceat(values, offsets))
+    maximum[occupied] = np.maximum(maximum[occupied],
+                                   np.maximum.reduceat(values, offsets))
+    total[occupied] += np.add.reduceat(values, offsets)
+    count[occupied] += ends[occupied] - starts[occupied]
+
+
+class CurrentArchive(object):
+
+    """
+    MEAS.I archives of all magnets, opened on first use.
+
+    Arguments:
+
+        - path          Root directory, with one subdirectory per magnet.
+    """
+
+    def __init__(self, path=DEFAULT_PATH):
+
+        self.path = path
+        self.magnets = {}
+        self.lock = threading.Lock()
+
+    def __getitem__(self, name):
+
+        with self.lock:
+
+            if name not in self.magnets:
+                self.magnets[name] = MagnetArchive(os.path.join(self.path,
+                                                                name))
+
+            return self.magnets[name]
+
+    def flush(self):
+
+        for magnet in list(self.magnets.values()):
+            magnet.flush()
+
+    def close(self):
+
+        with self.lock:
+            for magnet in self.magnets.values():
+                magnet.close()
+
+
+archive = None
+enabled = True
+_lock = threading.Lock()
+
+
+def get_archive():
+
+    """
+    Returns the CurrentArchive of the magnets, created on first use, or None
+    if archiving is disabled or the shared JAPC session runs against the
+    simulator or a replay and MAGNET_ARCHIVE is not set.
+    """
+
+    global archive
+
+    with _lock:
+
+        if archive is None and enabled:
+
+            if ARCHIVE_PATH is not None:
+                path = ARCHIVE_PATH
+            elif provider.backend in ('sim', 'replay'):
+                path = None
+            else:
+                path = DEFAULT_PATH
+
+            if path:
+                archive = CurrentArchive(path)
+                atexit.register(close)
+
+        return archive
+
+
+def disable():
+
+    """
+    Stops archiving for the rest of the process, for benchmarks and tests
+    whose samples must not reach the archive.
+    """
+
+    global enabled
+
+    enabled = False
+
+
+def close():
+
+    """
+    Flushes and closes the archive, and stops archiving for the rest of the
+    process.
+    """
+
+    global archive
+
+    disable()
+
+    with _lock:
+
+        if archive is not None:
+            archive.close()
+            archive = None
+
+
+def parse_time(text):
+
+    """
+    Returns the Unix time of an ISO 8601 date and time, or of a number of
+    hours before now if text is a negative number.
+    """
+
+    try:
+        hours = float(text)
+    except ValueError:
+        return datetime.fromisoformat(text).timestamp()
+
+    return datetime.now().timestamp() + hours * 3600.
+
+
+if __name__ == "__main__":
+
+    from magnet_control import MAGNETS
+
+    parser = argparse.ArgumentParser(description="""
+    Queries the MEAS.I archive of a spectrometer magnet.
+    """, formatter_class=argparse.RawTextHelpFormatter)
+
+    parser.add_argument('--magnet', dest='magnet', default='dipole',
+                        choices=sorted(MAGNETS), help='''
+    Magnet to query.''')
+
+    parser.add_argument('--start', dest='start', default='-24', help='''
+    Start of the range, as an ISO 8601 date and time or a negative number of
+    hours before now.''')
+
+    parser.add_argument('--stop', dest='stop', default='0', help='''
+    End of the range, in the same form as --start.''')
+
+    parser.add_argument('--buckets', dest='buckets', type=int, default=50,
+                        help='''
+    Number of time buckets the range is reduced to.''')
+
+    parser.add_argument('--output', dest='output', default=None, help='''
+    Save the buckets to this text file instead of printing them.''')
+
+    parser.add_argument('--path', dest='path',
+                        default=ARCHIVE_PATH or DEFAULT_PATH, help='''
+    Archive directory.''')
+
+    arguments = parser.parse_args()
+
+    magnet_archive = CurrentArchive(arguments.path)[arguments.magnet]
+
+    begin = perf_counter()
+    times, minimum, maximum, mean, count = magnet_archive.downsample(
+        parse_time(arguments.start), parse_time(arguments.stop),
+        arguments.buckets)
+    elapsed = perf_counter() - begin
+
+    print("{} samples in {} buckets, queried in {:.1f}ms\n".format(
+        int(count.sum()), arguments.buckets, elapsed * 1000))
+
+    if arguments.output is not None:
+
+        np.savetxt(arguments.output,
+                   np.column_stack((times, minimum, maximum, mean, count)),
+                   header='time min max mean count')
+
+    else:
+
+        print("{:<20s} {:>10s} {:>10s} {:>10s} {:>8s}".format(
+            "Time", "Min [A]", "Max [A]", "Mean [A]", "Samples"))
+
+        for row in zip(times, minimum, maximum, mean, count):
+            print("{:<20s} {:10.3f} {:10.3f} {:10.3f} {:8d}".format(
+                datetime.fromtimestamp(row[0]).strftime('%Y-%m-%d %H:%M:%S'),
+                row[1], row[2], row[3], int(row[4])))
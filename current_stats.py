@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+current_stats.py
+
+Online statistics of the measured current of a spectrometer magnet. The
+statistics are kept over a sliding window of the most recent samples and are
+updated in constant time per sample, so that the stability of a magnet can be
+judged continuously from the MEAS.I stream without re-scanning the samples.
+"""
+
+import threading
+from collections import deque
+
+import numpy as np
+
+
+class StreamingStats(object):
+
+    """
+    Sliding-window statistics of a (timestamp, current) stream.
+
+    The mean and variance are kept with Welford's method, the drift with the
+    equivalent running co-moment of time and current, and the peak-to-peak
+    range with monotonic queues, all of which support removing the sample that
+    leaves the window. The ripple spectrum is only computed when queried.
+
+    Arguments:
+
+        - samples   Number of samples in the sliding window.
+    """
+
+    def __init__(self, samples=250):
+
+        self.samples = int(samples)
+        self.times = np.empty(self.samples)
+        self.values = np.empty(self.samples)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+
+        with self.lock:
+
+            self.count = 0
+            self.total = 0
+            self.origin = None
+            self.mean_t = 0.
+            self.mean_i = 0.
+            self.m2_t = 0.
+            self.m2_i = 0.
+            self.c_ti = 0.
+            self.maxima = deque()
+            self.minima = deque()
+
+    def update(self, timestamp, value):
+
+        """
+        Adds one sample, dropping the oldest one if the window is full.
+        """
+
+        with self.lock:
+
+            # Times are kept relative to the first sample, so that the running
+            # moments do not lose precision on Unix timestamps.
+
+            if self.origin is None:
+                self.origin = timestamp
+
+            timestamp = timestamp - self.origin
+            index = self.total % self.samples
+
+            if self.count == self.samples:
+                self._remove(self.times[index], self.values[index])
+
+            self.times[index] = timestamp
+            self.values[index] = value
+            self._add(timestamp, value)
+
+            # Monotonic queues of (sequence number, value) for the window
+            # maximum and minimum.
+
+            sequence = self.total
+            self.total += 1
+
+            while self.maxima and self.maxima[-1][1] <= value:
+                self.maxima.pop()
+            self.maxima.append((sequence, value))
+
+            while self.minima and self.minima[-1][1] >= value:
+                self.minima.pop()
+            self.minima.append((sequence, value))
+
+            oldest = self.total - self.samples
+
+            while self.maxima[0][0] < oldest:
+                self.maxima.popleft()
+
+            while self.minima[0][0] < oldest:
+                self.minima.popleft()
+
+    def _add(self, t, i):
+
+        self.count += 1
+        n = self.count
+        dt = t - self.mean_t
+        di = i - self.mean_i
+        self.mean_t += dt / n
+        self.mean_i += di / n
+        factor = (n - 1.) / n
+        self.m2_t += dt * dt * factor
+        self.m2_i += di * di * factor
+        self.c_ti += dt * di * factor
+
+    def _remove(self, t, i):
+
+        n = self.count
+
+        if n == 1:
+            self.count = 0
+            self.mean_t = self.mean_i = 0.
+            self.m2_t = self.m2_i = self.c_ti = 0.
+            return
+
+        et = t - self.mean_t
+        ei = i - self.mean_i
+        factor = n / (n - 1.)
+        self.m2_t -= et * et * factor
+        self.m2_i -= ei * ei * factor
+        self.c_ti -= et * ei * factor
+        self.mean_t -= et / (n - 1)
+        self.mean_i -= ei / (n - 1)
+        self.count = n - 1
+
+    @property
+    def full(self):
+
+        return self.count == self.samples
+
+    def mean(self):
+
+        return self.mean_i
+
+    def std(self):
+
+        with self.lock:
+            return np.sqrt(max(self.m2_i, 0.) / (self.count - 1)) if self.count > 1 else 0.
+
+    def drift(self):
+
+        """
+        Returns the slope of a linear fit of current against time over the
+        window. Measured in Amps per second [A/s].
+        """
+
+        with self.lock:
+            return self.c_ti / self.m2_t if self.count > 1 and self.m2_t > 0 else 0.
+
+    def peak_to_peak(self):
+
+        with self.lock:
+            return self.maxima[0][1] - self.minima[0][1] if self.count else 0.
+
+    def window(self):
+
+        """
+        Returns copies of the window's timestamps and currents in order.
+        """
+
+        with self.lock:
+
+            start = (self.total - self.count) % self.samples
+            order = (np.arange(self.count) + start) % self.samples
+            origin = self.origin if self.origin is not None else 0.
+            return self.times[order] + origin, self.values[order]
+
+    def ripple(self):
+
+        """
+        Returns (frequency, amplitude) of the strongest periodic component of
+        the detrended current in the window, measured in Hertz [Hz] and Amps
+        [A], or (0, 0) if there are too few samples.
+        """
+
+        times, values = self.window()
+
+        if len(values) < 4 or times[-1] <= times[0]:
+            return 0., 0.
+
+        residual = values - np.polyval(np.polyfit(times - times[0], values, 1),
+                                       times - times[0])
+        spectrum = np.abs(np.fft.rfft(residual)) * 2. / len(residual)
+        frequencies = np.fft.rfftfreq(len(residual),
+                                      (times[-1] - times[0]) / (len(times) - 1))
+        peak = np.argmax(spectrum[1:]) + 1
+
+        return frequencies[peak], spectrum[peak]
+
+    def is_stable(self, tolerance, max_drift=None):
+
+        """
+        Returns True if the window is full and every sample in it lies within
+        tolerance of the window mean, and, if max_drift is given, the drift is
+        no larger than max_drift.
+
+        Arguments:
+
+            - tolerance     Allowed deviation from the mean. Measured in
+                            Amps [A].
+
+            - max_drift     Allowed drift. Measured in Amps per second [A/s].
+        """
+
+        with self.lock:
+
+            if self.count < self.samples:
+                return False
+
+            within = (self.maxima[0][1] - self.mean_i <= tolerance and
+                      self.mean_i - self.minima[0][1] <= tolerance)
+
+        if max_drift is not None and abs(self.drift()) > max_drift:
+            return False
+
+        return within
+
+    def summary(self, tolerance=None, max_drift=None):
+
+        """
+        Returns the current statistics as a dictionary. With a tolerance, the
+        dictionary also says whether the window is full and the current
+        stable, as given by is_stable().
+        """
+
+        frequency, amplitude = self.ripple()
+        summary = {'samples': self.count,
+                   'mean': self.mean(),
+                   'std': self.std(),
+                   'drift': self.drift(),
+                   'peak_to_peak': self.peak_to_peak(),
+                   'ripple_frequency': frequency,
+                   'ripple_amplitude': amplitude}
+
+        if tolerance is not None:
+            summary['full'] = self.full
+            summary['stable'] = self.is_stable(tolerance, max_drift)
+
+        return summary
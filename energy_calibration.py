@@ -0,0 +1,482 @@
+# -*- coding: utf-8 -*-
+"""
+energy_calibration.py
+
+Conversion between electron energy and spectrometer magnet current. Each
+magnet has versioned transfer functions, stored in calibrations.json, giving
+the current as a function of the energy as a polynomial, a monotone cubic
+spline or a linearly interpolated table. One version per magnet is active and
+can be swapped at run time; new versions can be fitted by least squares to
+logged (current, energy) pairs and saved to the file.
+
+The conversions work on scalars and on NumPy arrays of any shape, so that a
+whole energy scan can be planned in one call, and never print; points outside
+the range of a magnet are clipped and reported in a mask instead.
+
+The file can be replaced with the environment variable MAGNET_CALIBRATIONS.
+"""
+
+import json
+import os
+import threading
+from datetime import datetime
+
+import numpy as np
+
+CALIBRATION_PATH = os.environ.get(
+    'MAGNET_CALIBRATIONS',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                 'calibrations.json'))
+
+KINDS = ('polynomial', 'spline', 'table')
+
+# Number of points of the lookup table used for the inverse conversion.
+TABLE_POINTS = 4096
+
+
+def pchip_slopes(x, y):
+
+    """
+    Returns the knot derivatives of the monotone piecewise cubic Hermite
+    interpolant through (x, y) (Fritsch-Carlson).
+    """
+
+    h = np.diff(x)
+    delta = np.diff(y) / h
+    slopes = np.zeros_like(y)
+
+    if len(x) == 2:
+        slopes[:] = delta[0]
+        return slopes
+
+    w1 = 2 * h[1:] + h[:-1]
+    w2 = h[1:] + 2 * h[:-1]
+    same_sign = delta[:-1] * delta[1:] > 0
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        harmonic = (w1 + w2) / (w1 / delta[:-1] + w2 / delta[1:])
+
+    slopes[1:-1] = np.where(same_sign, harmonic, 0.)
+    slopes[0] = delta[0]
+    slopes[-1] = delta[-1]
+
+    return slopes
+
+
+def hat_basis(x, knots):
+
+    """
+    Returns the matrix of the piecewise linear basis functions on the knots
+    evaluated at x, used to fit tables and splines by least squares.
+    """
+
+    basis = np.zeros((len(x), len(knots)))
+    index = np.clip(np.searchsorted(knots, x) - 1, 0, len(knots) - 2)
+    fraction = (x - knots[index]) / (knots[index + 1] - knots[index])
+    rows = np.arange(len(x))
+
+    basis[rows, index] = 1 - fraction
+    basis[rows, index + 1] = fraction
+
+    return basis
+
+
+class TransferFunction(object):
+
+    """
+    One version of the energy to current calibration of a magnet.
+
+    Arguments:
+
+        - magnet        Name of the magnet in magnet_control.MAGNETS.
+
+        - version       Version name.
+
+        - kind          'polynomial', 'spline' or 'table'.
+
+        - max_current   Current at which results are clipped. Measured in
+                        Amps [A].
+
+        - coefficients  Polynomial coefficients, highest power first, of the
+                        current [A] against the energy [GeV] (polynomial).
+
+        - energies      Knot energies in GeV (spline and table).
+
+        - currents      Knot currents in Amps (spline and table).
+
+        - info          Dictionary of notes, such as the fit residual or the
+                        date, stored with the version.
+    """
+
+    def __init__(self, magnet, version, kind, max_current, coefficients=None,
+                 energies=None, currents=None, info=None):
+
+        if kind not in KINDS:
+            raise ValueError("Unknown calibration kind '{}'".format(kind))
+
+        self.magnet = magnet
+        self.version = version
+        self.kind = kind
+        self.max_current = float(max_current)
+        self.info = info or {}
+
+        if kind == 'polynomial':
+            self.coefficients = np.asarray(coefficients, dtype=float)
+        else:
+            order = np.argsort(energies)
+            self.energies = np.asarray(energies, dtype=float)[order]
+            self.currents = np.asarray(currents, dtype=float)[order]
+
+        if kind == 'spline':
+            self.slopes = pchip_slopes(self.energies, self.currents)
+
+        self._inverse = None
+
+    def evaluate(self, energy):
+
+        """
+        Returns the unclipped current for an energy array in GeV.
+        """
+
+        if self.kind == 'polynomial':
+            return np.polyval(self.coefficients, energy)
+
+        if self.kind == 'table':
+            return np.interp(energy, self.energies, self.currents)
+
+        x, y, slopes = self.energies, self.currents, self.slopes
+        index = np.clip(np.searchsorted(x, energy) - 1, 0, len(x) - 2)
+        h = x[index + 1] - x[index]
+        t = np.clip((energy - x[index]) / h, 0., 1.)
+
+        return ((2 * t**3 - 3 * t**2 + 1) * y[index] +
+                (t**3 - 2 * t**2 + t) * h * slopes[index] +
+                (-2 * t**3 + 3 * t**2) * y[index + 1] +
+                (t**3 - t**2) * h * slopes[index + 1])
+
+    def __call__(self, energy):
+
+        """
+        Returns a tuple (current, clipped) of arrays of the shape of energy,
+        where clipped is True for points whose current was outside
+        [0, max_current].
+        """
+
+        current = self.evaluate(np.asarray(energy, dtype=float))
+        clipped = (current > self.max_current) | (current < 0)
+
+        return np.clip(current, 0., self.max_current), clipped
+
+    def energy_range(self):
+
+        """
+        Returns the energies in GeV at which the current is 0 and max_current.
+        """
+
+        if self.kind != 'polynomial':
+            return self.energies[0], self.energies[-1]
+
+        # Expand a coarse grid until it reaches max_current, then bracket.
+
+        top = 1.
+        while self.evaluate(top) < self.max_current and top < 1e3:
+            top *= 2
+
+        grid = np.linspace(0., top, TABLE_POINTS)
+        current = self.evaluate(grid)
+
+        return (grid[np.searchsorted(current, 0.)],
+                grid[min(np.searchsorted(current, self.max_current),
+                         len(grid) - 1)])
+
+    def inverse(self, current):
+
+        """
+        Returns a tuple (energy, clipped) for a current in Amps, scalar or
+        array, by interpolating a dense lookup table built on first use.
+        """
+
+        if self._inverse is None:
+
+            low, high = self.energy_range()
+            energies = np.linspace(low, high, TABLE_POINTS)
+            self._inverse = (self.evaluate(energies), energies)
+
+        currents, energies = self._inverse
+        current = np.asarray(current, dtype=float)
+        clipped = (current > self.max_current) | (current < 0)
+
+        return np.interp(current, currents, energies), clipped
+
+    def to_dict(self):
+
+        entry = {'kind': self.kind, 'max_current': self.max_current}
+
+        if self.kind == 'polynomial':
+            entry['coefficients'] = self.coefficients.tolist()
+        else:
+            entry['energies'] = self.energies.tolist()
+            entry['currents'] = self.currents.tolist()
+
+        if self.info:
+            entry['info'] = self.info
+
+        return entry
+
+    @classmethod
+    def from_dict(cls, magnet, version, entry):
+
+        return cls(magnet, version, entry['kind'], entry['max_current'],
+                   entry.get('coefficients'), entry.get('energies'),
+                   entry.get('currents'), entry.get('info'))
+
+
+def fit(magnet, version, currents, energies, kind='polynomial', degree=2,
+        knots=10, max_current=None):
+
+    """
+    Fits a transfer function to logged (current, energy) pairs by linear
+    least squares.
+
+    Arguments:
+
+        - magnet        Name of the magnet.
+
+        - version       Name of the new version.
+
+        - currents      Logged currents. Measured in Amps [A].
+
+        - energies      Energies focused at these currents. Measured in GeV.
+
+        - kind          'polynomial', 'spline' or 'table'.
+
+        - degree        Degree of the polynomial.
+
+        - knots         Number of equally spaced knots of a spline or table.
+
+        - max_current   Current at which results are clipped [A]. Defaults to
+                        the largest logged current.
+    """
+
+    currents = np.asarray(currents, dtype=float)
+    energies = np.asarray(energies, dtype=float)
+
+    if kind == 'polynomial':
+
+        design = np.vander(energies, degree + 1)
+        coefficients = np.linalg.lstsq(design, currents, rcond=None)[0]
+        residual = currents - design.dot(coefficients)
+        knot_energies = knot_currents = None
+
+    else:
+
+        knot_energies = np.linspace(energies.min(), energies.max(), knots)
+        design = hat_basis(energies, knot_energies)
+        knot_currents = np.linalg.lstsq(design, currents, rcond=None)[0]
+        residual = currents - design.dot(knot_currents)
+        coefficients = None
+
+    info = {'points': len(currents),
+            'rms': float(np.sqrt(np.mean(residual**2))),
+            'fitted': datetime.now().isoformat(timespec='seconds')}
+
+    if max_current is None:
+        max_current = currents.max()
+
+    return TransferFunction(magnet, version, kind, max_current, coefficients,
+                            knot_energies, knot_currents, info)
+
+
+class CalibrationRegistry(object):
+
+    """
+    Versioned transfer functions of every magnet, loaded from a JSON file of
+    the form {magnet: {'active': version, 'versions': {version: entry}}}.
+    Evaluators are built once per version and kept in memory, so activating
+    another version only swaps a reference.
+
+    Arguments:
+
+        - path      Calibration file, or None for an empty registry.
+    """
+
+    def __init__(self, path=None):
+
+        self.path = path
+        self.functions = {}
+        self.active = {}
+        self.lock = threading.Lock()
+
+        if path is not None and os.path.exists(path):
+            self.load(path)
+
+    def load(self, path):
+
+        with open(path) as calibration_file:
+            data = json.load(calibration_file)
+
+        with self.lock:
+
+            for magnet, calibrations in data.items():
+
+                self.functions[magnet] = {
+                    version: TransferFunction.from_dict(magnet, version, entry)
+                    for version, entry in calibrations['versions'].items()}
+                self.active[magnet] = calibrations['active']
+
+        self.path = path
+
+    def save(self, path=None):
+
+        path = path or self.path
+
+        with self.lock:
+            data = {magnet: {'active': self.active[magnet],
+                             'versions': {version: function.to_dict()
+                                          for version, function
+                                          in versions.items()}}
+                    for magnet, versions in self.functions.items()}
+
+        with open(path, 'w') as calibration_file:
+            json.dump(data, calibration_file, indent=1)
+
+    def versions(self, magnet):
+
+        return sorted(self.functions.get(magnet, {}))
+
+    def get(self, magnet, version=None):
+
+        """
+        Returns the active transfer function of a magnet, or the given version.
+        """
+
+        try:
+            if version is None:
+                version = self.active[magnet]
+            return self.functions[magnet][version]
+        except KeyError:
+            raise KeyError("No calibration {}for the {}".format(
+                '' if version is None else version + ' ', magnet))
+
+    def add(self, function, activate=False):
+
+        with self.lock:
+
+            self.functions.setdefault(function.magnet, {})[function.version] = \
+                function
+
+            if activate or function.magnet not in self.active:
+                self.active[function.magnet] = function.version
+
+    def activate(self, magnet, version):
+
+        """
+        Makes a loaded version the active calibration of a magnet.
+        """
+
+        self.get(magnet, version)
+        self.active[magnet] = version
+
+
+registry = CalibrationRegistry(CALIBRATION_PATH)
+
+
+def energy_to_current(energy, magnet='quadrupole', version=None):
+
+    """
+    Returns the current required for a magnet at the given energy.
+
+    Arguments:
+
+        - energy        Energy, scalar or array. Measured in GeV.
+
+        - magnet        Name of the magnet.
+
+        - version       Calibration version, or None for the active one.
+
+    Returns a tuple (current, clipped) of arrays of the shape of energy, where
+    clipped is True for points whose current was outside the range of the
+    magnet.
+    """
+
+    return registry.get(magnet, version)(energy)
+
+
+def current_to_energy(current, magnet='quadrupole', version=None):
+
+    """
+    Returns a tuple (energy, clipped) giving the energy in GeV corresponding
+    to a current in Amps, scalar or array.
+    """
+
+    return registry.get(magnet, version).inverse(current)
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description="""
+    Lists, activates and fits the energy calibrations of the spectrometer magnets.
+    """, formatter_class=argparse.RawTextHelpFormatter)
+
+    parser.add_argument('--magnet', dest='magnet', default='quadrupole',
+                        help='''
+    Magnet whose calibrations are changed.''')
+
+    parser.add_argument('--fit', dest='fit', default=None, help='''
+    Text file of logged pairs, one "current energy" line per point, with the current
+    in Amps and the energy in GeV, to fit a new version to.''')
+
+    parser.add_argument('--version', dest='version', default=None, help='''
+    Name of the fitted version, or of the version to activate.''')
+
+    parser.add_argument('--kind', dest='kind', default='polynomial',
+                        choices=KINDS, help='''
+    Kind of the fitted transfer function.''')
+
+    parser.add_argument('--degree', dest='degree', type=int, default=2, help='''
+    Degree of a fitted polynomial.''')
+
+    parser.add_argument('--knots', dest='knots', type=int, default=10, help='''
+    Number of knots of a fitted spline or table.''')
+
+    parser.add_argument('--activate', dest='activate', action='store_true',
+                        help='''
+    Make the version the active calibration of the magnet.''')
+
+    arguments = parser.parse_args()
+
+    if arguments.fit is not None:
+
+        if arguments.version is None:
+            parser.error("--fit requires --version")
+
+        pairs = np.loadtxt(arguments.fit, ndmin=2)
+        function = fit(arguments.magnet, arguments.version, pairs[:, 0],
+                       pairs[:, 1], arguments.kind, arguments.degree,
+                       arguments.knots)
+        registry.add(function, arguments.activate)
+        registry.save(CALIBRATION_PATH)
+
+        print("Fitted {} {} to {} points, rms residual {:.3f}A".format(
+            arguments.magnet, arguments.version, function.info['points'],
+            function.info['rms']))
+
+    elif arguments.activate:
+
+        if arguments.version is None:
+            parser.error("--activate requires --version")
+
+        registry.activate(arguments.magnet, arguments.version)
+        registry.save(CALIBRATION_PATH)
+
+    for magnet in sorted(registry.functions):
+
+        for version in registry.versions(magnet):
+
+            function = registry.get(magnet, version)
+            marker = '*' if registry.active[magnet] == version else ' '
+
+            print("{} {:<12s} {:<20s} {:<10s} {}".format(
+                marker, magnet, version, function.kind, function.info))
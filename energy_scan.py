@@ -0,0 +1,364 @@
+# -*- coding: utf-8 -*-
+"""
+energy_scan.py
+
+Energy scans of the electron spectrometer. The currents of every point are
+computed up front from the energy calibrations, then the dipole and quadrupole
+are driven through the points together, each point ending as soon as both
+measured currents have settled. A magnet whose setpoint is the one it already
+reached, such as the dipole at a fixed current, is not stepped. The achieved
+MEAS.I of both magnets is recorded at every point.
+
+The dipole ramp of each point is planned from the previous setpoint. The TSG41
+GUI support vector is written in the background by the publisher when the
+magnets start moving, so that it always describes the point being measured.
+The logbook events of the whole scan are posted as a single summary entry when
+it ends.
+"""
+
+import argparse
+import contextlib
+import sys
+from time import monotonic, sleep
+
+import numpy as np
+
+import metrics
+import tracing
+from energy_calibration import energy_to_current
+from magnet_control import Magnet
+from publisher import publisher
+from ramp_planner import plan_ramp
+from spectrometer import run_parallel
+from thread_output import redirect
+
+# PC states from which a scan step changes the current; from any other state
+# the magnet is turned on.
+RUN_STATES = ('IDLE', 'RUNNING')
+
+
+def plan_scan(energies, dipole_current=None):
+
+    """
+    Computes the currents of every point of a scan.
+
+    Arguments:
+
+        - energies          Energies of the points. Measured in GeV.
+
+        - dipole_current    Dipole current used at every point [A], or None to
+                            take it from the dipole energy calibration.
+
+    Returns a dictionary of arrays 'energy', 'dipole', 'quadrupole' and
+    'clipped', the latter True for points where a current was clipped to the
+    range of its magnet.
+    """
+
+    energies = np.asarray(energies, dtype=float)
+
+    quadrupole, clipped = energy_to_current(energies, 'quadrupole')
+
+    if dipole_current is None:
+        dipole, dipole_clipped = energy_to_current(energies, 'dipole')
+        clipped = clipped | dipole_clipped
+    else:
+        dipole = np.full_like(energies, float(dipole_current))
+
+    return {'energy': energies, 'dipole': dipole, 'quadrupole': quadrupole,
+            'clipped': clipped}
+
+
+class ScanRunner(object):
+
+    """
+    Drives the spectrometer magnets through the points of a scan plan.
+
+    Arguments:
+
+        - dipole            Magnet object of the dipole.
+
+        - quadrupole        Magnet object of the quadrupole.
+
+        - ramp_duration     Dipole ramp duration of each step. Measured in
+                            seconds [s]. If None, each step is planned from
+                            the dipole ramp model.
+
+        - dwell             Time for which MEAS.I is recorded once both
+                            magnets have settled. Measured in seconds [s].
+    """
+
+    def __init__(self, dipole, quadrupole, ramp_duration=None, dwell=1.):
+
+        self.dipole = dipole
+        self.quadrupole = quadrupole
+        self.ramp_duration = ramp_duration
+        self.dwell = dwell
+
+    def prepare(self, plan, index, previous=None):
+
+        """
+        Prepares a point: plans the dipole ramp from the previous setpoint and
+        reads the TSG41 GUI support vector if there is no copy of it yet.
+        Returns a dictionary describing the point.
+        """
+
+        point = {'index': index,
+                 'energy': float(plan['energy'][index]),
+                 'dipole': float(plan['dipole'][index]),
+                 'quadrupole': float(plan['quadrupole'][index]),
+                 'clipped': bool(plan['clipped'][index]),
+                 'ramp_duration': self.ramp_duration}
+
+        if point['ramp_duration'] is None and previous is not None:
+            point['ramp_duration'], _ = plan_ramp(
+                self.dipole.config, previous['dipole'], point['dipole'])
+
+        if publisher.gui.vector is None:
+            publisher.gui.japc = self.dipole.converter._japc
+            publisher.gui.sync()
+
+        return point
+
+    def publish(self, point):
+
+        publisher.set_slots({self.dipole.config['gui_index']: point['dipole'],
+                             self.quadrupole.config['gui_index']:
+                                 point['quadrupole']},
+                            self.dipole.converter._japc)
+        publisher.log("{:.3f} GeV: Dipole {:0.2f} Amps, Quadrupole {:0.2f} "
+                      "Amps".format(point['energy'], point['dipole'],
+                                    point['quadrupole']))
+
+    def step(self, magnet, current, ramp_duration=None, quiet=True):
+
+        """
+        Moves a magnet to a current, turning it on unless its converter is
+        already IDLE or RUNNING. With quiet, the messages of the procedure are
+        dropped; only those of the calling thread, so that other threads still
+        report.
+        """
+
+        with redirect(None) if quiet else contextlib.nullcontext():
+
+            if magnet.converter.state() in RUN_STATES:
+                return magnet.change_current(current, ramp_duration,
+                                             publish=False)
+
+            return magnet.turn_on(current, ramp_duration, publish=False)
+
+    def measure(self, magnet, since):
+
+        """
+        Returns the mean and standard deviation of the MEAS.I samples of a
+        magnet received after the acquisition time since.
+        """
+
+        times, current = magnet.acquisition.read()
+
+        if since is not None:
+            current = current[times > since]
+
+        if not len(current):
+            return np.nan, np.nan
+
+        return float(np.mean(current)), float(np.std(current))
+
+    def run(self, plan, quiet=True):
+
+        """
+        Runs the scan and returns a list with one dictionary per point.
+        Points are reported as they complete. With quiet, the messages of the
+        individual magnet procedures are suppressed.
+        """
+
+        points = len(plan['energy'])
+        results = []
+
+        # Setpoints reached by each magnet, which are not stepped again.
+        reached = {}
+
+        for magnet in (self.dipole, self.quadrupole):
+            magnet.acquisition.start()
+
+        print_header()
+
+        title = "Spectrometer energy scan, {} points from {:.3f} to {:.3f} " \
+            "GeV:".format(points, plan['energy'][0], plan['energy'][-1])
+
+        try:
+
+            with publisher.batch(title):
+
+                point = None
+
+                for index in range(points):
+
+                    start = monotonic()
+
+                    point = self.prepare(plan, index, point)
+                    self.publish(point)
+
+                    moves = {'dipole': (self.dipole, point['ramp_duration']),
+                             'quadrupole': (self.quadrupole, None)}
+
+                    tasks = {name: (self.step, (magnet, point[name],
+                                                ramp_duration, quiet))
+                             for name, (magnet, ramp_duration) in moves.items()
+                             if reached.get(name) != point[name]}
+
+                    steps = run_parallel(tasks) if tasks else {}
+
+                    for name in moves:
+                        if steps.get(name, True) is True:
+                            reached[name] = point[name]
+                        else:
+                            reached.pop(name, None)
+
+                    since = [magnet.acquisition.buffer.last_time()
+                             for magnet in (self.dipole, self.quadrupole)]
+
+                    sleep(self.dwell)
+
+                    dipole_mean, dipole_std = self.measure(self.dipole,
+                                                           since[0])
+                    quadrupole_mean, quadrupole_std = self.measure(
+                        self.quadrupole, since[1])
+
+                    result = {
+                        'energy': point['energy'],
+                        'dipole_set': point['dipole'],
+                        'quadrupole_set': point['quadrupole'],
+                        'clipped': point['clipped'],
+                        'settled': all(value is True
+                                       for value in steps.values()),
+                        'dipole_meas': dipole_mean,
+                        'dipole_std': dipole_std,
+                        'quadrupole_meas': quadrupole_mean,
+                        'quadrupole_std': quadrupole_std,
+                        'elapsed': monotonic() - start,
+                    }
+
+                    for name, value in steps.items():
+                        if isinstance(value, Exception):
+                            result['error'] = "{}: {}".format(name, value)
+
+                    results.append(result)
+                    print_point(index, result)
+
+        finally:
+
+            for magnet in (self.dipole, self.quadrupole):
+                magnet.acquisition.stop()
+
+        return results
+
+
+FIELDS = ('energy', 'dipole_set', 'quadrupole_set', 'dipole_meas',
+          'dipole_std', 'quadrupole_meas', 'quadrupole_std', 'elapsed')
+
+
+def print_header():
+
+    print("{:>4s} {:>8s} {:>10s} {:>10s} {:>10s} {:>10s} {:>7s}  {}".format(
+        "#", "GeV", "Dip set", "Dip meas", "Quad set", "Quad meas", "Time",
+        "Status"))
+
+
+def print_point(index, result):
+
+    status = 'ok' if result['settled'] else 'not settled'
+
+    if result['clipped']:
+        status += ', clipped'
+
+    if 'error' in result:
+        status += ', ' + result['error']
+
+    print("{:4d} {:8.3f} {:10.3f} {:10.3f} {:10.3f} {:10.3f} {:6.1f}s  "
+          "{}".format(index, result['energy'], result['dipole_set'],
+                      result['dipole_meas'], result['quadrupole_set'],
+                      result['quadrupole_meas'], result['elapsed'], status))
+
+
+def save_results(results, path):
+
+    """
+    Writes the scan results to a whitespace separated text file.
+    """
+
+    table = np.array([[result[field] for field in FIELDS] + [result['settled']]
+                      for result in results], dtype=float)
+
+    np.savetxt(path, table, fmt='%.6g', header=' '.join(FIELDS + ('settled',)))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="""
+    Runs an energy scan of the electron spectrometer, setting the dipole and quadrupole
+    for each energy in turn and recording the measured currents.
+    """, formatter_class=argparse.RawTextHelpFormatter)
+
+    parser.add_argument('--energies', dest='energies', type=float, nargs='+',
+                        default=None, help='''
+    Energies of the scan points. Measured in GeV.''')
+
+    parser.add_argument('--range', dest='range', type=float, nargs=3,
+                        default=None, metavar=('START', 'STOP', 'POINTS'),
+                        help='''
+    Scan POINTS equally spaced energies from START to STOP GeV instead.''')
+
+    parser.add_argument('--dipole_current', dest='dipole_current', type=float,
+                        default=None, help='''
+    Fixed dipole current for every point. Measured in Amps [A]. Without it the dipole
+    current is taken from the dipole energy calibration.''')
+
+    parser.add_argument('--ramp_duration', dest='ramp_duration', type=float,
+                        default=None, help='''
+    Dipole ramp duration of each step. Measured in seconds [s]. By default each step
+    is as short as the dipole ramp rate limit allows, or 15s while the limit has not been
+    measured.''')
+
+    parser.add_argument('--dwell', dest='dwell', type=float, default=1.,
+                        help='''
+    Time for which MEAS.I is recorded at each point. Measured in seconds [s].''')
+
+    parser.add_argument('--output', dest='output', default=None, help='''
+    Text file to which the results are written.''')
+
+    parser.add_argument('--verbose', dest='verbose', action='store_true',
+                        help='''
+    Print the messages of the individual magnet procedures.''')
+
+    tracing.add_arguments(parser)
+    metrics.add_arguments(parser)
+
+    arguments = parser.parse_args()
+
+    tracing.from_arguments(arguments)
+    metrics.from_arguments(arguments)
+
+    if arguments.energies is not None:
+        energies = arguments.energies
+    elif arguments.range is not None:
+        start, stop, points = arguments.range
+        energies = np.linspace(start, stop, int(points))
+    else:
+        parser.error("either --energies or --range is required")
+
+    try:
+        plan = plan_scan(energies, arguments.dipole_current)
+    except KeyError as error:
+        parser.error("{}; give --dipole_current".format(error))
+
+    runner = ScanRunner(Magnet('dipole'), Magnet('quadrupole'),
+                        arguments.ramp_duration, arguments.dwell)
+    results = runner.run(plan, quiet=not arguments.verbose)
+
+    if arguments.output is not None:
+        save_results(results, arguments.output)
+
+    tracing.finish()
+    metrics.finish()
+
+    sys.exit(0 if all(result['settled'] for result in results) else 1)
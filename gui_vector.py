@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+gui_vector.py
+
+Shared copy of the TSG41 GUI support vector, in which the set currents of the
+spectrometer magnets are stored for the event builder. Magnets update their
+own slots in the local copy; the updates of all magnets are merged and written
+back in one write, at most once per flush interval, so that concurrent updates
+cannot overwrite each other and the full vector is not read for every change.
+
+The copy is refreshed from ValueAcquisition when it gets old, after a failed
+write, or continuously when subscribed. Slots written locally are re-applied
+over every vector received until ValueAcquisition reflects them, so that a
+late acquisition update cannot revert a write and have the stale value written
+back by the next flush. They are given up after WRITTEN_TIMEOUT, so that a
+slot changed meanwhile by another tool is not overwritten by every later
+flush.
+"""
+
+import copy
+import threading
+from time import monotonic
+
+from japc_session import get_japc
+
+# Vector in which the set currents are stored for the event builder.
+GUI_SUPPORT_ACQUISITION = 'TSG41.AWAKE-GUI-SUPPORT/ValueAcquisition#floatValue'
+GUI_SUPPORT_SETTINGS = 'TSG41.AWAKE-GUI-SUPPORT/ValueSettings#floatValue'
+
+# Difference below which a received slot reflects a written value, since the
+# vector is stored in single precision.
+TOLERANCE = 1e-3
+
+# Time after a write for which a slot is re-applied over received vectors that
+# do not reflect it yet. Measured in seconds [s].
+WRITTEN_TIMEOUT = 5.
+
+
+class GuiSupportVector(object):
+
+    """
+    Cached TSG41 GUI support vector with pending slot updates.
+
+    Arguments:
+
+        - japc          PyJapc instance to use. Defaults to the shared session.
+
+        - min_interval  Minimum time between two writes. Measured in seconds
+                        [s].
+
+        - max_age       Age after which the copy is read again before a write,
+                        unless subscribed. Measured in seconds [s].
+    """
+
+    def __init__(self, japc=None, min_interval=0.5, max_age=60.):
+
+        self.japc = japc
+        self.min_interval = min_interval
+        self.max_age = max_age
+
+        self.lock = threading.Lock()
+        self.vector = None
+        self.synced = 0.
+        self.pending = {}
+        self.written = {}
+        self.last_write = float('-inf')
+        self.subscribed = False
+        self.reads = 0
+        self.writes = 0
+
+    def _japc(self):
+
+        return self.japc if self.japc is not None else get_japc()
+
+    def update(self, slots):
+
+        """
+        Merges slot updates, a dictionary of index to value, into the pending
+        write.
+        """
+
+        with self.lock:
+            self.pending.update(slots)
+
+    def get(self, index):
+
+        """
+        Returns the value of a slot, including pending updates.
+        """
+
+        with self.lock:
+
+            if index in self.pending:
+                return self.pending[index]
+
+        if self.vector is None:
+            self.sync()
+
+        return float(self.vector[index])
+
+    def sync(self):
+
+        """
+        Reads the vector from ValueAcquisition.
+        """
+
+        vector = self._japc().getParam(GUI_SUPPORT_ACQUISITION)
+        self._received(GUI_SUPPORT_ACQUISITION, vector)
+        self.reads += 1
+
+    def _received(self, name, value):
+
+        vector = copy.copy(value)
+
+        with self.lock:
+
+            self.synced = monotonic()
+
+            for index, (written, time) in list(self.written.items()):
+
+                if abs(float(vector[index]) - written) <= TOLERANCE or \
+                        self.synced - time > WRITTEN_TIMEOUT:
+                    del self.written[index]
+                else:
+                    vector[index] = written
+
+            self.vector = vector
+
+    def subscribe(self):
+
+        """
+        Keeps the copy up to date from ValueAcquisition updates, for
+        long-running processes.
+        """
+
+        if self.subscribed:
+            return
+
+        japc = self._japc()
+        japc.subscribeParam(GUI_SUPPORT_ACQUISITION,
+                            onValueReceived=self._received)
+        japc.startSubscriptions(parameterName=GUI_SUPPORT_ACQUISITION)
+        self.subscribed = True
+
+    def next_write(self):
+
+        """
+        Returns the time until pending updates may be written, or None if
+        there are none.
+        """
+
+        if not self.pending:
+            return None
+
+        return max(0., self.last_write + self.min_interval - monotonic())
+
+    def flush(self, force=False):
+
+        """
+        Writes the pending updates in one write if the flush interval has
+        passed, or regardless of it with force. Returns True if nothing is
+        left pending.
+        """
+
+        if not self.pending:
+            return True
+
+        if not force and self.next_write() > 0:
+            return False
+
+        stale = monotonic() - self.synced > self.max_age
+
+        if self.vector is None or (stale and not self.subscribed):
+            self.sync()
+
+        with self.lock:
+            slots = self.pending
+            self.pending = {}
+            vector = self.vector.copy()
+
+        for index, value in slots.items():
+            vector[index] = value
+
+        try:
+            self._japc().setParam(GUI_SUPPORT_SETTINGS, vector)
+        except Exception:
+
+            # Keep the updates, unless newer ones arrived meanwhile, and read
+            # the vector again before the next attempt.
+
+            with self.lock:
+                slots.update(self.pending)
+                self.pending = slots
+                self.vector = None
+            raise
+
+        with self.lock:
+
+            # Written values stay authoritative until they are acquired, or
+            # until WRITTEN_TIMEOUT has passed.
+
+            self.last_write = monotonic()
+            self.written.update((index, (value, self.last_write))
+                                for index, value in slots.items())
+
+            for index, (value, time) in list(self.written.items()):
+                if self.last_write - time > WRITTEN_TIMEOUT:
+                    del self.written[index]
+                else:
+                    vector[index] = value
+
+            self.vector = vector
+            self.writes += 1
+
+        return True
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+japc_batch.py
+
+Batched reads of several JAPC parameters, possibly on different devices, in
+one round. Reads use a pyjapc parameter group where the control system accepts
+one and otherwise fall back to concurrent single requests.
+
+The settings writes of the magnet procedures are not batched: each depends on
+the one before it, REF.TRIM.DURATION before REF.TRIM.FINAL and the reference
+before REF.FUNC.TYPE, which arms the converter.
+"""
+
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Shared pool for the concurrent fallback, so that threads are not created for
+# every batch.
+executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='japc-batch')
+
+# Groups which the control system refused, read as single requests from then
+# on.
+unsupported = set()
+lock = threading.Lock()
+
+
+def group_errors():
+
+    """
+    Returns the exception types with which a parameter group read may be
+    refused: pyjapc raises Java exceptions through JPype, which is only looked
+    up if pyjapc has already loaded it.
+    """
+
+    errors = (TypeError, ValueError, NotImplementedError)
+    jpype = sys.modules.get('jpype')
+
+    if jpype is not None and hasattr(jpype, 'JException'):
+        errors += (jpype.JException,)
+
+    return errors
+
+
+def get_params(japc, names):
+
+    """
+    Reads a group of parameters and returns a dictionary mapping each name to
+    its value. If the group read is refused, the reason is printed and the
+    parameters are read with concurrent single requests, which raise any
+    error that also affects the individual parameters.
+
+    Arguments:
+
+        - japc      The PyJapc instance used to read the parameters.
+
+        - names     List of full parameter names, 'DEVICE/PROPERTY'.
+    """
+
+    names = list(names)
+
+    if len(names) == 1:
+        return {names[0]: japc.getParam(names[0])}
+
+    values = None
+    key = tuple(names)
+
+    if key not in unsupported:
+
+        try:
+            values = japc.getParam(names)
+        except group_errors() as error:
+            print("Group read of {} failed ({}), reading them "
+                  "individually".format(', '.join(names), error))
+            with lock:
+                unsupported.add(key)
+
+    if values is None or len(values) != len(names):
+        values = list(executor.map(japc.getParam, names))
+
+    return dict(zip(names, values))
@@ -0,0 +1,663 @@
+# -*- coding: utf-8 -*-
+"""
+japc_record.py
+
+Recording and replay of the control system traffic of the spectrometer magnet
+scripts, to reproduce a slow or failed sequence offline.
+
+RecordingJapc wraps a PyJapc instance and writes every get, set and
+subscription update, with its time, duration and value or error, to a compact
+binary log. ReplayJapc is a drop-in replacement for pyjapc.PyJapc which plays
+a log back: a get returns the value recorded for that parameter at the same
+point of the recorded timeline, after the recorded latency; subscription
+updates are delivered at their recorded times; sets are checked against the
+recorded ones. The timeline can be played back faster than real time.
+
+Recording is enabled for the scripts by setting MAGNET_JAPC_RECORD to the log
+file; replay by MAGNET_JAPC_BACKEND=replay and MAGNET_JAPC_REPLAY, with the
+speed-up taken from MAGNET_SIM_SPEEDUP.
+
+Log format, little-endian: the header b'MJRL', a version byte and the Unix
+start time as a double, followed by records of a kind byte, the time since the
+start (double), the duration (float), a parameter id (unsigned short) and the
+payload length (unsigned int), then the payload. Parameter names are stored
+once, in NAME records, and values in a small tagged encoding.
+"""
+
+import atexit
+import bisect
+import struct
+import threading
+from datetime import datetime, timedelta
+from statistics import median
+from time import time, perf_counter, monotonic, sleep
+
+MAGIC = b'MJRL'
+VERSION = 1
+
+HEADER = struct.Struct('<4sBd')
+RECORD = struct.Struct('<BdfHI')
+
+NAME, GET, SET, EVENT, GET_ERROR, SET_ERROR = range(6)
+KINDS = {NAME: 'name', GET: 'get', SET: 'set', EVENT: 'event',
+         GET_ERROR: 'get error', SET_ERROR: 'set error'}
+
+# Value encoding
+
+_DOUBLE = struct.Struct('<d')
+_LONG = struct.Struct('<q')
+_LENGTH = struct.Struct('<I')
+
+
+def encode(value):
+
+    """
+    Encodes a parameter value: None, bool, int, float, str, datetime, list,
+    tuple, dict or NumPy array.
+    """
+
+    if value is None:
+        return b'N'
+
+    if isinstance(value, bool):
+        return b'T' if value else b'F'
+
+    if isinstance(value, datetime):
+        return b't' + _DOUBLE.pack(value.timestamp())
+
+    if hasattr(value, 'dtype') and hasattr(value, 'tobytes'):
+
+        if value.ndim == 0:
+            return encode(value.item())
+
+        dtype = value.dtype.str.encode()
+        data = value.tobytes()
+
+        return (b'a' + bytes([len(dtype)]) + dtype + _LENGTH.pack(len(data)) +
+                data)
+
+    if isinstance(value, int):
+        return b'i' + _LONG.pack(value)
+
+    if isinstance(value, float):
+        return b'd' + _DOUBLE.pack(value)
+
+    if isinstance(value, str):
+        data = value.encode('utf-8')
+        return b's' + _LENGTH.pack(len(data)) + data
+
+    if isinstance(value, (list, tuple)):
+        return (b'l' + _LENGTH.pack(len(value)) +
+                b''.join(encode(item) for item in value))
+
+    if isinstance(value, dict):
+        return (b'm' + _LENGTH.pack(len(value)) +
+                b''.join(encode(str(key)) + encode(item)
+                         for key, item in value.items()))
+
+    return encode(str(value))
+
+
+def decode(data, offset=0):
+
+    """
+    Decodes one value starting at offset and returns (value, next offset).
+    """
+
+    tag = data[offset:offset + 1]
+    offset += 1
+
+    if tag == b'N':
+        return None, offset
+    if tag == b'T':
+        return True, offset
+    if tag == b'F':
+        return False, offset
+    if tag == b'i':
+        return _LONG.unpack_from(data, offset)[0], offset + 8
+    if tag == b'd':
+        return _DOUBLE.unpack_from(data, offset)[0], offset + 8
+    if tag == b't':
+        return (datetime.fromtimestamp(_DOUBLE.unpack_from(data, offset)[0]),
+                offset + 8)
+
+    if tag == b's':
+        length = _LENGTH.unpack_from(data, offset)[0]
+        offset += 4
+        return data[offset:offset + length].decode('utf-8'), offset + length
+
+    if tag == b'a':
+
+        import numpy as np
+
+        dtype_length = data[offset]
+        dtype = data[offset + 1:offset + 1 + dtype_length].decode()
+        offset += 1 + dtype_length
+        length = _LENGTH.unpack_from(data, offset)[0]
+        offset += 4
+        array = np.frombuffer(data[offset:offset + length], dtype=dtype).copy()
+        return array, offset + length
+
+    if tag in (b'l', b'm'):
+
+        count = _LENGTH.unpack_from(data, offset)[0]
+        offset += 4
+        items = []
+
+        for _ in range(count * (2 if tag == b'm' else 1)):
+            item, offset = decode(data, offset)
+            items.append(item)
+
+        if tag == b'm':
+            return dict(zip(items[::2], items[1::2])), offset
+
+        return items, offset
+
+    raise ValueError("Unknown value tag {!r} in recording".format(tag))
+
+
+def parameter_key(parameterName):
+
+    if isinstance(parameterName, (list, tuple)):
+        return '|'.join(parameterName)
+
+    return parameterName
+
+
+# Recording
+
+class Recorder(object):
+
+    """
+    Writes control system traffic to a binary log.
+
+    Arguments:
+
+        - path      Log file, overwritten.
+    """
+
+    def __init__(self, path):
+
+        self.path = path
+        self.lock = threading.Lock()
+        self.names = {}
+        self.start = time()
+        self.origin = perf_counter()
+        self.file = open(path, 'wb')
+        self.file.write(HEADER.pack(MAGIC, VERSION, self.start))
+        self.file.flush()
+
+    def _name_id(self, name):
+
+        if name not in self.names:
+
+            self.names[name] = len(self.names)
+            data = name.encode('utf-8')
+            self.file.write(RECORD.pack(NAME, 0., 0., self.names[name],
+                                        len(data)) + data)
+
+        return self.names[name]
+
+    def record(self, kind, name, value, duration=0., at=None):
+
+        """
+        Writes one record. The time defaults to now minus the duration.
+        """
+
+        if at is None:
+            at = perf_counter() - duration
+
+        payload = encode(value)
+
+        with self.lock:
+
+            if self.file is None:
+                return
+
+            name_id = self._name_id(parameter_key(name))
+            self.file.write(RECORD.pack(kind, at - self.origin, duration,
+                                        name_id, len(payload)) + payload)
+            self.file.flush()
+
+    def close(self):
+
+        with self.lock:
+
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+class RecordingJapc(object):
+
+    """
+    Wrapper around a PyJapc instance recording every get, set and
+    subscription update. Other attributes are passed through.
+    """
+
+    def __init__(self, japc, recorder):
+
+        self.japc = japc
+        self.recorder = recorder
+
+    def getParam(self, parameterName, **kwargs):
+
+        begin = perf_counter()
+
+        try:
+            value = self.japc.getParam(parameterName, **kwargs)
+        except Exception as error:
+            self.recorder.record(GET_ERROR, parameterName, str(error),
+                                 perf_counter() - begin, begin)
+            raise
+
+        self.recorder.record(GET, parameterName, value, perf_counter() - begin,
+                             begin)
+        return value
+
+    def setParam(self, parameterName, parameterValue, **kwargs):
+
+        begin = perf_counter()
+
+        try:
+            result = self.japc.setParam(parameterName, parameterValue, **kwargs)
+        except Exception as error:
+            self.recorder.record(SET_ERROR, parameterName,
+                                 [parameterValue, str(error)],
+                                 perf_counter() - begin, begin)
+            raise
+
+        self.recorder.record(SET, parameterName, parameterValue,
+                             perf_counter() - begin, begin)
+        return result
+
+    def subscribeParam(self, parameterName, onValueReceived=None, **kwargs):
+
+        def recorded(name, value, *header):
+
+            self.recorder.record(EVENT, name, [value] + list(header))
+
+            if onValueReceived is not None:
+                onValueReceived(name, value, *header)
+
+        return self.japc.subscribeParam(parameterName, onValueReceived=recorded,
+                                        **kwargs)
+
+    def __getattr__(self, name):
+
+        return getattr(self.japc, name)
+
+
+def read_log(path):
+
+    """
+    Reads a log and returns (start, records), where start is the Unix time at
+    which recording started and records is a list of (kind, time, duration,
+    name, value) tuples in file order.
+    """
+
+    with open(path, 'rb') as log:
+        data = log.read()
+
+    magic, version, start = HEADER.unpack_from(data, 0)
+
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("{} is not a control system recording".format(path))
+
+    offset = HEADER.size
+    names = {}
+    records = []
+
+    while offset + RECORD.size <= len(data):
+
+        kind, at, duration, name_id, length = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        payload = data[offset:offset + length]
+        offset += length
+
+        if len(payload) < length:
+            break  # Truncated by an interrupted recording.
+
+        if kind == NAME:
+            names[name_id] = payload.decode('utf-8')
+            continue
+
+        records.append((kind, at, duration, names[name_id],
+                        decode(payload)[0]))
+
+    return start, records
+
+
+# Replay
+
+class ReplayJapc(object):
+
+    """
+    Drop-in replacement for pyjapc.PyJapc playing back a recording.
+
+    The replay follows the recorded timeline, but never passes a set which
+    the procedure has not made yet: the timeline waits for the procedure at
+    each recorded set, and moves on to the time of the set when it is made
+    early. Readbacks therefore keep their order relative to the commands
+    whatever the speed-up, and a procedure waiting on a state change is not
+    held up by the real time it took during the recording.
+
+    Arguments:
+
+        - path          Log file written by a Recorder.
+
+        - speedup       Factor by which the recorded timeline is played back
+                        faster than real time.
+
+        - latency       Whether gets and sets take their recorded duration.
+    """
+
+    def __init__(self, path, speedup=1., latency=True, selector=None,
+                 **kwargs):
+
+        self.path = path
+        self.speedup = float(speedup)
+        self.latency = latency
+        self.start, records = read_log(path)
+
+        self.responses = {}
+        self.sets = {}
+        self.events = {}
+
+        for kind, at, duration, name, value in records:
+
+            if kind in (GET, GET_ERROR):
+                self.responses.setdefault(name, []).append(
+                    (at, duration, kind, value))
+            elif kind in (SET, SET_ERROR):
+                self.sets.setdefault(name, []).append(
+                    (at, duration, kind, value))
+            elif kind == EVENT:
+                self.events.setdefault(name, []).append((at, value))
+
+        self.response_times = {name: [entry[0] for entry in entries]
+                               for name, entries in self.responses.items()}
+        self.outstanding = sorted(
+            (entry[0], name, index) for name, entries in self.sets.items()
+            for index, entry in enumerate(entries))
+        self.set_index = {}
+        self.divergences = []
+        self.subscriptions = {}
+        self.players = {}
+        self.lock = threading.Lock()
+        self.position = 0.
+        self.anchor = monotonic()
+
+        atexit.register(self.report)
+
+    def report(self):
+
+        """
+        Prints the sets which differed from the recording.
+        """
+
+        if not self.divergences:
+            return
+
+        print("\nReplay of {} diverged from the recording in {} sets:".format(
+            self.path, len(self.divergences)))
+
+        for at, name, value, recorded in self.divergences:
+            print("  {:8.3f}s {} = {} (recorded {})".format(
+                at, name, str(value)[:40],
+                str(recorded)[:40] if recorded is not None else "none"))
+
+    def now(self):
+
+        """
+        Returns the position in the recorded timeline [s].
+        """
+
+        with self.lock:
+            return self._now()
+
+    def _now(self):
+
+        position = self.position + (monotonic() - self.anchor) * self.speedup
+
+        if self.outstanding:
+            position = min(position, self.outstanding[0][0])
+
+        return position
+
+    def _wait(self, duration):
+
+        if self.latency and duration > 0:
+            sleep(duration / self.speedup)
+
+    def getParam(self, parameterName, **kwargs):
+
+        name = parameter_key(parameterName)
+
+        if name not in self.responses:
+            raise KeyError("{} was not read in the recording".format(name))
+
+        # Latest response recorded at or before this point of the timeline,
+        # or the first one.
+
+        index = max(0, bisect.bisect_right(self.response_times[name],
+                                           self.now()) - 1)
+        _, duration, kind, value = self.responses[name][index]
+
+        self._wait(duration)
+
+        if kind == GET_ERROR:
+            raise RuntimeError(value)
+
+        return value.copy() if hasattr(value, 'copy') else value
+
+    def setParam(self, parameterName, parameterValue, **kwargs):
+
+        name = parameter_key(parameterName)
+        recorded = self.sets.get(name, [])
+
+        with self.lock:
+
+            now = self._now()
+            index = self.set_index.get(name, 0)
+            self.set_index[name] = index + 1
+
+            if index < len(recorded):
+
+                # Release the timeline up to this set.
+
+                self.outstanding.remove((recorded[index][0], name, index))
+                self.position = max(now, recorded[index][0])
+                self.anchor = monotonic()
+
+        if index >= len(recorded):
+            self.divergences.append((now, name, parameterValue, None))
+            return
+
+        _, duration, kind, value = recorded[index]
+
+        if kind == SET_ERROR:
+            value = value[0]
+
+        if not same_value(value, parameterValue):
+            self.divergences.append((now, name, parameterValue, value))
+
+        self._wait(duration)
+
+        if kind == SET_ERROR:
+            raise RuntimeError(recorded[index][3][1])
+
+    # RBAC
+
+    def rbacLogin(self, username=None, password=None, **kwargs):
+
+        from japc_sim import SimulatedToken
+
+        self.token = SimulatedToken()
+
+    def rbacGetToken(self):
+
+        return getattr(self, 'token', None)
+
+    def rbacLogout(self):
+
+        self.token = None
+
+    # Subscriptions
+
+    def subscribeParam(self, parameterName, onValueReceived=None, **kwargs):
+
+        self.subscriptions[parameterName] = onValueReceived
+
+    def startSubscriptions(self, parameterName=None, **kwargs):
+
+        names = [parameterName] if parameterName is not None else \
+            list(self.subscriptions)
+
+        for name in names:
+
+            if name in self.players or name not in self.subscriptions:
+                continue
+
+            stop = threading.Event()
+            player = threading.Thread(target=self._play, args=(name, stop),
+                                      name='japc-replay', daemon=True)
+            self.players[name] = (player, stop)
+            player.start()
+
+    def stopSubscriptions(self, parameterName=None, **kwargs):
+
+        names = [parameterName] if parameterName is not None else \
+            list(self.players)
+
+        for name in names:
+            if name in self.players:
+                self.players.pop(name)[1].set()
+
+    def clearSubscriptions(self, parameterName=None, **kwargs):
+
+        self.stopSubscriptions(parameterName)
+
+        if parameterName is None:
+            self.subscriptions.clear()
+        else:
+            self.subscriptions.pop(parameterName, None)
+
+    def _play(self, name, stop):
+
+        """
+        Delivers the recorded updates of a parameter from the present point
+        of the timeline on, at the recorded update period. While the timeline
+        is held at a set, and after the last update, the last value is
+        repeated with advancing time stamps, as a converter keeps publishing
+        while it waits.
+        """
+
+        events = self.events.get(name, [])
+
+        if not events:
+            return
+
+        times = [at for at, _ in events]
+        period = median([later - earlier for earlier, later
+                         in zip(times, times[1:])] or [1.])
+        index = bisect.bisect_left(times, self.now())
+        last = events[index - 1] if index else None
+        repeats = 0
+        previous = None
+
+        while not stop.wait(period / self.speedup):
+
+            now = self.now()
+            updates = []
+
+            while index < len(events) and events[index][0] <= now:
+                last = events[index]
+                updates.append(last[1])
+                index += 1
+                repeats = 0
+
+            if not updates and last is not None and \
+                    (index == len(events) or now == previous):
+                repeats += 1
+                updates.append(shifted(last[1], repeats * period))
+
+            previous = now
+            callback = self.subscriptions.get(name)
+
+            for value in updates:
+                if callback is not None:
+                    callback(name, *value)
+
+
+def shifted(value, offset):
+
+    """
+    Returns a recorded update, [value] or [value, header], with the time
+    stamps of its header moved forward by offset seconds.
+    """
+
+    if len(value) < 2 or not isinstance(value[1], dict):
+        return value
+
+    header = dict(value[1])
+
+    for key in ('acqStamp', 'cycleStamp'):
+
+        if isinstance(header.get(key), datetime):
+            header[key] = header[key] + timedelta(seconds=offset)
+        elif isinstance(header.get(key), (int, float)):
+            header[key] = header[key] + offset
+
+    return [value[0], header]
+
+
+def same_value(recorded, value):
+
+    try:
+        import numpy as np
+        return bool(np.allclose(np.asarray(recorded, dtype=float),
+                                np.asarray(value, dtype=float)))
+    except (TypeError, ValueError):
+        return recorded == value
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description="""
+    Summarises or lists a control system recording.
+    """, formatter_class=argparse.RawTextHelpFormatter)
+
+    parser.add_argument('path', help='''
+    Recording to read.''')
+
+    parser.add_argument('--list', dest='list', action='store_true', help='''
+    List every record instead of the summary.''')
+
+    arguments = parser.parse_args()
+
+    start, records = read_log(arguments.path)
+
+    print("Recorded {} records from {}\n".format(
+        len(records), datetime.fromtimestamp(start).isoformat(sep=' ')))
+
+    if arguments.list:
+
+        for kind, at, duration, name, value in records:
+            print("{:10.3f}s {:<9s} {:<60s} {:7.1f}ms {}".format(
+                at, KINDS[kind], name[:60], duration * 1000,
+                str(value)[:60]))
+
+    else:
+
+        counts = {}
+
+        for kind, at, duration, name, value in records:
+            count, total = counts.get((KINDS[kind], name), (0, 0.))
+            counts[(KINDS[kind], name)] = (count + 1, total + duration)
+
+        for (kind, name), (count, total) in sorted(counts.items()):
+            print("{:<9s} {:<60s} {:6d} {:9.1f}ms".format(
+                kind, name[:60], count, total * 1000))
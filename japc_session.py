@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+"""
+japc_session.py
+
+Provides the JAPC session shared by the spectrometer magnet scripts. The
+session is created on first use rather than at import time, and the RBAC token
+is kept until shortly before it expires, so that repeated operations in the
+same process do not log in again. A keep-alive thread can be started by
+long-running processes to renew the token in the background.
+
+Setting the environment variable MAGNET_JAPC_BACKEND to 'sim' replaces the
+control system and e-logbook by the simulation in japc_sim.py, running
+MAGNET_SIM_SPEEDUP times faster than real time, with the converters starting
+in the PC state MAGNET_SIM_STATE, OFF by default. Setting MAGNET_JAPC_RECORD to a
+file records the control system traffic to it, and MAGNET_JAPC_BACKEND set to
+'replay' plays back the recording in MAGNET_JAPC_REPLAY instead, also
+MAGNET_SIM_SPEEDUP times faster than real time; see japc_record.py.
+"""
+
+import os
+import threading
+from time import time
+
+from settings_cache import cache
+
+SELECTOR = 'SPS.USER.ALL'
+RBAC_USERNAME = 'awakeop'
+RBAC_PASSWORD = 'Plasma4edda'
+
+# Lifetime assumed for a token whose expiry time cannot be read, and how long
+# before expiry a token is renewed. Measured in seconds [s].
+TOKEN_LIFETIME = 8 * 3600.
+TOKEN_REFRESH_MARGIN = 300.
+
+BACKEND = os.environ.get('MAGNET_JAPC_BACKEND', 'japc')
+SIM_SPEEDUP = float(os.environ.get('MAGNET_SIM_SPEEDUP', '1'))
+SIM_STATE = os.environ.get('MAGNET_SIM_STATE')
+RECORD_PATH = os.environ.get('MAGNET_JAPC_RECORD')
+REPLAY_PATH = os.environ.get('MAGNET_JAPC_REPLAY')
+
+
+def token_expiry(token):
+
+    """
+    Returns the expiry time of an RBAC token as a Unix timestamp, falling back
+    to TOKEN_LIFETIME from now if the token does not provide one.
+    """
+
+    try:
+        return token.getExpirationTime().getTime() / 1000.
+    except Exception:
+        return time() + TOKEN_LIFETIME
+
+
+class SessionProvider(object):
+
+    """
+    Lazily creates a PyJapc session and keeps it logged in.
+
+    Arguments:
+
+        - selector      Timing selector for the session.
+
+        - username      RBAC user name.
+
+        - password      RBAC password.
+
+        - backend       'japc' for the control system, 'sim' for a
+                        SimulatedJapc or 'replay' for a ReplayJapc.
+
+        - sim_options   Keyword arguments for SimulatedJapc.
+
+        - record        File to record the control system traffic to, or None.
+    """
+
+    def __init__(self, selector=SELECTOR, username=RBAC_USERNAME,
+                 password=RBAC_PASSWORD, backend=BACKEND, sim_options=None,
+                 record=RECORD_PATH):
+
+        self.selector = selector
+        self.username = username
+        self.password = password
+        self.backend = backend
+        self.sim_options = sim_options or {'speedup': SIM_SPEEDUP,
+                                           'state': SIM_STATE}
+        self.record = record
+        self.recorder = None
+
+        self.wrappers = []
+
+        self._lock = threading.RLock()
+        self._japc = None
+        self._expiry = 0.
+        self._keepalive = None
+        self._stop = threading.Event()
+
+    def get(self):
+
+        """
+        Returns the session, creating it and renewing the RBAC token if needed.
+        """
+
+        with self._lock:
+
+            if self._japc is None:
+                self._japc = self._create()
+
+            if time() >= self._expiry - TOKEN_REFRESH_MARGIN:
+                self._login()
+
+            return self._japc
+
+    def _create(self):
+
+        if self.backend == 'sim':
+
+            from japc_sim import SimulatedJapc
+
+            japc = SimulatedJapc(self.selector, **self.sim_options)
+
+        elif self.backend == 'replay':
+
+            from japc_record import ReplayJapc
+
+            japc = ReplayJapc(REPLAY_PATH, speedup=SIM_SPEEDUP,
+                              selector=self.selector)
+
+        else:
+
+            import pyjapc
+
+            japc = pyjapc.PyJapc(self.selector)
+
+        if self.record is not None:
+
+            from japc_record import Recorder, RecordingJapc
+
+            if self.recorder is None:
+                self.recorder = Recorder(self.record)
+
+            japc = RecordingJapc(japc, self.recorder)
+
+        for wrapper in self.wrappers:
+            japc = wrapper(japc)
+
+        return japc
+
+    def add_wrapper(self, wrapper):
+
+        """
+        Registers a function which is applied to the PyJapc instance when it
+        is created, and returns an object to use in its place, for example to
+        instrument every get and set. An existing session is wrapped at once.
+        """
+
+        with self._lock:
+
+            self.wrappers.append(wrapper)
+
+            if self._japc is not None:
+                self._japc = wrapper(self._japc)
+
+    def use_simulator(self, **sim_options):
+
+        """
+        Switches the provider to a new SimulatedJapc, created with the given
+        keyword arguments on next use.
+        """
+
+        self.close()
+        self.backend = 'sim'
+        self.sim_options = sim_options
+
+    def logbook(self, activity='AWAKE'):
+
+        """
+        Returns an e-logbook for the given activity, simulated if the session
+        is simulated or replayed.
+        """
+
+        if self.backend in ('sim', 'replay'):
+
+            from japc_sim import SimulatedLogbook
+
+            return SimulatedLogbook(activity)
+
+        import pylogbook
+
+        return pylogbook.eLogbook(activity)
+
+    def _login(self):
+
+        self._japc.rbacLogin(username=self.username, password=self.password)
+        self._expiry = token_expiry(self._japc.rbacGetToken())
+
+    def start_keepalive(self, interval=60.):
+
+        """
+        Starts a background thread which renews the RBAC token before it
+        expires, for use by long-running processes such as the magnet daemon.
+
+        Arguments:
+
+            - interval      Time between token checks. Measured in seconds [s].
+        """
+
+        if self._keepalive is not None:
+            return
+
+        self._stop.clear()
+        self.get()
+
+        def keepalive():
+
+            while not self._stop.wait(interval):
+
+                try:
+                    self.get()
+                except Exception as error:
+                    print("RBAC token renewal failed: {}".format(error))
+
+        self._keepalive = threading.Thread(target=keepalive,
+                                           name='japc-keepalive', daemon=True)
+        self._keepalive.start()
+
+    def close(self):
+
+        """
+        Stops the keep-alive thread and any subscriptions, and forgets the
+        session so that the next call to get() creates a new one. The settings
+        cache loses its subscriptions with the session and is emptied.
+        """
+
+        self._stop.set()
+        self._keepalive = None
+
+        with self._lock:
+
+            if self._japc is not None:
+
+                try:
+                    self._japc.stopSubscriptions()
+                    self._japc.clearSubscriptions()
+                except Exception:
+                    pass
+
+            self._japc = None
+            self._expiry = 0.
+
+        cache.reset()
+
+
+provider = SessionProvider()
+
+
+def get_japc():
+
+    """
+    Returns the shared JAPC session, logging in on first use.
+    """
+
+    return provider.get()
+
+
+def get_logbook(activity='AWAKE'):
+
+    """
+    Returns the e-logbook for the given activity.
+    """
+
+    return provider.logbook(activity)
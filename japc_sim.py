@@ -0,0 +1,432 @@
+# -*- coding: utf-8 -*-
+"""
+japc_sim.py
+
+Simulated control system for running the spectrometer magnet procedures
+without access to the accelerator network. SimulatedJapc is a drop-in
+replacement for pyjapc.PyJapc which models the power converter state machine
+(OFF -> ON_STANDBY -> IDLE -> ARMED -> RUNNING), CTRIM and PLEP reference
+functions with ramp rates, MEAS.I noise and the TSG41 GUI support vector.
+
+Simulated time runs faster than real time by a configurable factor, so that
+turn on sequences can be benchmarked in a fraction of their real duration.
+Select it for the scripts with the environment variable
+MAGNET_JAPC_BACKEND=sim, and set the speed-up with MAGNET_SIM_SPEEDUP.
+"""
+
+import random
+import threading
+from collections import Counter
+from datetime import datetime
+from math import exp
+from time import time, monotonic, sleep
+
+import numpy as np
+
+GUI_SUPPORT_LENGTH = 100
+
+# Default behaviour of a simulated converter. Delays are in simulated seconds.
+#
+#   delays          Time taken to reach each state after the request.
+#   noise           Standard deviation of MEAS.I [A].
+#   plep_rate       Maximum dI/dt of a PLEP function [A/s].
+#   plep_tau        Time constant of the final approach of a PLEP function [s].
+#   state           PC state in which the converter starts.
+
+DEFAULT_CONVERTER = {
+    'delays': {'OFF': 2., 'ON_STANDBY': 3., 'IDLE': 0.5, 'ARMED': 0.3,
+               'RUNNING': 0.2},
+    'noise': 0.005,
+    'plep_rate': 50.,
+    'plep_tau': 0.2,
+    'state': 'OFF',
+}
+
+CONVERTERS = {
+    'RPPEF.BB4.RBIH.412435': {},
+    'RPADA.BB4.RQNI.412432': {'delays': {'OFF': 2., 'ON_STANDBY': 6.,
+                                         'IDLE': 0.5, 'ARMED': 0.3,
+                                         'RUNNING': 0.2}},
+}
+
+
+class SimClock(object):
+
+    """
+    Simulated wall clock running speedup times faster than real time.
+    """
+
+    def __init__(self, speedup=1.):
+
+        self.speedup = float(speedup)
+        self.origin = time()
+        self.start = monotonic()
+
+    def now(self):
+
+        return self.origin + (monotonic() - self.start) * self.speedup
+
+
+class SimulatedConverter(object):
+
+    """
+    State and reference function of one simulated power converter.
+    """
+
+    def __init__(self, device, clock, config):
+
+        self.device = device
+        self.clock = clock
+        self.delays = config['delays']
+        self.noise = config['noise']
+        self.plep_rate = config['plep_rate']
+        self.plep_tau = config['plep_tau']
+
+        self.state = config['state']
+        self.pending = None
+        self.settings = {'REF.FUNC.TYPE': 'NONE', 'REF.TRIM.DURATION': 0.,
+                         'REF.TRIM.FINAL': 0., 'REF.PLEP.FINAL': 0.}
+        self.reference = (0., 0., 0., 'NONE')
+        self.run_end = None
+
+        # A converter starting in RUNNING runs its reference from now.
+
+        if self.state == 'RUNNING':
+            self.start_reference(clock.now())
+
+    def update(self, now):
+
+        if self.pending is not None and now >= self.pending[1]:
+
+            self.state = self.pending[0]
+            self.pending = None
+
+            if self.state == 'RUNNING':
+                self.start_reference(now)
+
+        if self.state == 'RUNNING' and now >= self.run_end:
+            self.state = 'IDLE'
+
+    def request(self, state, now):
+
+        self.pending = (state, now + self.delays[state])
+
+        if state == 'OFF':
+            self.reference = (now, 0., 0., 'NONE')
+
+    def arm(self, now):
+
+        func_type = self.settings['REF.FUNC.TYPE']
+
+        if self.pending is None and self.state in ('IDLE', 'ARMED') and \
+                func_type in ('CTRIM', 'PLEP'):
+            self.request('ARMED', now)
+
+    def start_reference(self, now):
+
+        start_current = self.reference_current(now)
+        func_type = self.settings['REF.FUNC.TYPE']
+
+        if func_type == 'CTRIM':
+            final = self.settings['REF.TRIM.FINAL']
+            duration = self.settings['REF.TRIM.DURATION']
+        else:
+            final = self.settings['REF.PLEP.FINAL']
+            duration = self.plep_duration(abs(final - start_current))
+
+        self.reference = (now, start_current, final, func_type)
+        self.run_end = now + duration
+
+    def plep_duration(self, step):
+
+        return max(0., step / self.plep_rate - self.plep_tau) + 5 * self.plep_tau
+
+    def reference_current(self, now):
+
+        start, initial, final, func_type = self.reference
+        elapsed = now - start
+        step = final - initial
+
+        if func_type == 'CTRIM':
+
+            duration = self.settings['REF.TRIM.DURATION']
+
+            if duration <= 0 or elapsed >= duration:
+                return final
+
+            return initial + step * elapsed / duration
+
+        if func_type == 'PLEP':
+
+            # Rate-limited linear ramp followed by an exponential approach.
+
+            sign = 1. if step >= 0 else -1.
+            tail = min(abs(step), self.plep_rate * self.plep_tau)
+            linear_time = (abs(step) - tail) / self.plep_rate
+
+            if elapsed < linear_time:
+                return initial + sign * self.plep_rate * elapsed
+
+            return final - sign * tail * exp(-(elapsed - linear_time) /
+                                             self.plep_tau)
+
+        return final
+
+    def measured_current(self, now):
+
+        return self.reference_current(now) + random.gauss(0., self.noise)
+
+    def get(self, prop, now):
+
+        self.update(now)
+
+        if prop == 'STATE':
+            return {'PC': self.state}
+
+        if prop == 'MEAS.I':
+            return self.measured_current(now)
+
+        if prop == 'MODE.PC':
+            return self.pending[0] if self.pending else self.state
+
+        return self.settings[prop]
+
+    def set(self, prop, value, now):
+
+        self.update(now)
+
+        if prop == 'MODE.PC':
+            self.request(value, now)
+
+        elif prop == 'REF.RUN':
+            if self.state == 'ARMED' and self.pending is None:
+                self.request('RUNNING', now)
+
+        else:
+            self.settings[prop] = value
+            self.arm(now)
+
+
+class SimulatedToken(object):
+
+    class _Date(object):
+
+        def __init__(self, timestamp):
+
+            self.timestamp = timestamp
+
+        def getTime(self):
+
+            return int(self.timestamp * 1000)
+
+    def __init__(self, lifetime=8 * 3600.):
+
+        self.expiry = time() + lifetime
+
+    def getExpirationTime(self):
+
+        return self._Date(self.expiry)
+
+    def isValid(self):
+
+        return time() < self.expiry
+
+
+class SimulatedJapc(object):
+
+    """
+    Drop-in replacement for pyjapc.PyJapc backed by simulated converters.
+
+    Arguments:
+
+        - selector          Timing selector, only used in headers.
+
+        - speedup           Factor by which simulated time runs faster than
+                            real time.
+
+        - converters        Dictionary of per-device overrides of
+                            DEFAULT_CONVERTER. Unknown devices use the
+                            defaults.
+
+        - publish_period    Simulated time between subscription updates [s].
+
+        - latency           Real time taken by every get and set [s], to model
+                            network round trips.
+
+        - state             PC state in which every converter starts, or None
+                            for the state of its configuration.
+    """
+
+    def __init__(self, selector='SPS.USER.ALL', speedup=1., converters=None,
+                 publish_period=0.05, latency=0., state=None, **kwargs):
+
+        self.selector = selector
+        self.clock = SimClock(speedup)
+        self.overrides = dict(CONVERTERS)
+        self.overrides.update(converters or {})
+        self.publish_period = publish_period
+        self.latency = latency
+        self.state = state
+
+        self.converters = {}
+        self.gui_support = np.zeros(GUI_SUPPORT_LENGTH, dtype=np.float32)
+        self.counts = Counter()
+        self.lock = threading.RLock()
+
+        self.subscriptions = {}
+        self.active = set()
+        self._publisher = None
+
+    # Converters and parameters
+
+    def converter(self, device):
+
+        if device not in self.converters:
+
+            config = dict(DEFAULT_CONVERTER)
+            config.update(self.overrides.get(device, {}))
+
+            if self.state is not None:
+                config['state'] = self.state
+
+            self.converters[device] = SimulatedConverter(device, self.clock,
+                                                         config)
+
+        return self.converters[device]
+
+    def _get(self, name):
+
+        device, prop = name.split('/', 1)
+
+        if device == 'TSG41.AWAKE-GUI-SUPPORT':
+            return self.gui_support.copy()
+
+        return self.converter(device).get(prop, self.clock.now())
+
+    def getParam(self, parameterName, **kwargs):
+
+        if self.latency:
+            sleep(self.latency)
+
+        with self.lock:
+
+            if isinstance(parameterName, (list, tuple)):
+                self.counts['get_group'] += 1
+                return [self._get(name) for name in parameterName]
+
+            self.counts['get'] += 1
+            return self._get(parameterName)
+
+    def setParam(self, parameterName, parameterValue, **kwargs):
+
+        if self.latency:
+            sleep(self.latency)
+
+        with self.lock:
+
+            self.counts['set'] += 1
+            device, prop = parameterName.split('/', 1)
+
+            if device == 'TSG41.AWAKE-GUI-SUPPORT':
+                self.gui_support = np.array(parameterValue, dtype=np.float32)
+                return
+
+            self.converter(device).set(prop, parameterValue, self.clock.now())
+
+    # RBAC
+
+    def rbacLogin(self, username=None, password=None, **kwargs):
+
+        self.token = SimulatedToken()
+
+    def rbacGetToken(self):
+
+        return getattr(self, 'token', None)
+
+    def rbacLogout(self):
+
+        self.token = None
+
+    # Subscriptions
+
+    def subscribeParam(self, parameterName, onValueReceived=None,
+                       onException=None, getHeader=False, unixtime=False,
+                       **kwargs):
+
+        with self.lock:
+            self.subscriptions[parameterName] = (onValueReceived, getHeader,
+                                                 unixtime)
+
+    def _names(self, parameterName):
+
+        if parameterName is None:
+            return list(self.subscriptions)
+
+        return [parameterName] if parameterName in self.subscriptions else []
+
+    def startSubscriptions(self, parameterName=None, **kwargs):
+
+        with self.lock:
+
+            self.active.update(self._names(parameterName))
+
+            if self._publisher is None:
+                self._publisher = threading.Thread(target=self._publish,
+                                                   name='japc-sim-publisher',
+                                                   daemon=True)
+                self._publisher.start()
+
+    def stopSubscriptions(self, parameterName=None, **kwargs):
+
+        with self.lock:
+            self.active.difference_update(self._names(parameterName))
+
+    def clearSubscriptions(self, parameterName=None, **kwargs):
+
+        with self.lock:
+
+            for name in self._names(parameterName):
+                self.active.discard(name)
+                del self.subscriptions[name]
+
+    def _publish(self):
+
+        while True:
+
+            sleep(self.publish_period / self.clock.speedup)
+
+            with self.lock:
+
+                now = self.clock.now()
+                updates = [(name, self.subscriptions[name], self._get(name))
+                           for name in list(self.active)]
+
+            for name, (callback, get_header, unixtime), value in updates:
+
+                if callback is None:
+                    continue
+
+                if get_header:
+                    stamp = now if unixtime else datetime.fromtimestamp(now)
+                    callback(name, value, {'acqStamp': stamp,
+                                           'cycleStamp': stamp,
+                                           'selector': self.selector})
+                else:
+                    callback(name, value)
+
+
+class SimulatedLogbook(object):
+
+    """
+    Stand-in for pylogbook.eLogbook which keeps events in memory.
+    """
+
+    def __init__(self, activity):
+
+        self.activity = activity
+        self.events = []
+
+    def create_event(self, text):
+
+        self.events.append((time(), text))
+        return text
@@ -0,0 +1,377 @@
+# -*- coding: utf-8 -*-
+"""
+live_plot.py
+
+Continuous monitoring of the measured current of the spectrometer magnets.
+The MEAS.I samples of every magnet are drawn on one set of axes sharing the
+time axis, each magnet with its own current scale, and the plot is updated
+incrementally as samples arrive.
+
+On a display only the lines are redrawn, blitted over a cached background;
+the axes are only redrawn when a current leaves its range. Without a display,
+or when an output file is given, the plot is rendered to a PNG or SVG file on
+a timer instead. Each line holds at most a fixed number of points, decimated
+as they arrive, so the cost of a frame does not grow with the time window.
+NumPy and Matplotlib are imported when a plot is created.
+"""
+
+import argparse
+import os
+import sys
+import threading
+from time import monotonic, strftime, localtime
+
+COLOURS = ('tab:blue', 'tab:red', 'tab:green', 'tab:orange')
+
+
+class LiveSeries(object):
+
+    """
+    Fixed-capacity series of samples of one magnet. Samples are written twice,
+    at i and i + capacity, so that the newest capacity points are always a
+    contiguous view and appending costs the same for any amount of history.
+
+    Arguments:
+
+        - window        Time covered by the series. Measured in seconds [s].
+
+        - points        Maximum number of points kept; samples closer than
+                        window / points to the previous one are dropped.
+    """
+
+    def __init__(self, window, points):
+
+        import numpy as np
+
+        self.window = float(window)
+        self.capacity = int(points)
+        self.spacing = self.window / self.capacity
+        self.times = np.full(2 * self.capacity, np.nan)
+        self.values = np.full(2 * self.capacity, np.nan)
+        self.index = 0
+        self.count = 0
+        self.last = None
+        self.lock = threading.Lock()
+
+    def append(self, timestamp, value):
+
+        if self.last is not None and timestamp - self.last < self.spacing:
+            return
+
+        with self.lock:
+
+            for position in (self.index, self.index + self.capacity):
+                self.times[position] = timestamp
+                self.values[position] = value
+
+            self.index = (self.index + 1) % self.capacity
+            self.count = min(self.count + 1, self.capacity)
+            self.last = timestamp
+
+    def view(self):
+
+        """
+        Returns the times and values in chronological order, as views.
+        """
+
+        with self.lock:
+
+            start = self.index + self.capacity - self.count
+            return (self.times[start:start + self.count],
+                    self.values[start:start + self.count])
+
+
+class LivePlot(object):
+
+    """
+    Live plot of the MEAS.I of several magnets.
+
+    Arguments:
+
+        - magnets       List of Magnet objects.
+
+        - window        Time shown. Measured in seconds [s].
+
+        - interval      Time between frames, or between renders to the output
+                        file. Measured in seconds [s].
+
+        - output        PNG or SVG file to render to, or None to draw on the
+                        display.
+
+        - points        Maximum number of points per line.
+    """
+
+    def __init__(self, magnets, window=60., interval=0.5, output=None,
+                 points=2000):
+
+        self.magnets = magnets
+        self.window = window
+        self.interval = interval
+        self.output = output
+        self.headless = output is not None or not has_display()
+        self.series = [LiveSeries(window, points) for _ in magnets]
+        self.frames = 0
+        self.closed = False
+
+        if self.headless and output is None:
+            self.output = 'magnet_current.png'
+
+        import matplotlib
+
+        if self.headless:
+            matplotlib.use('Agg')
+
+        import matplotlib.pyplot as plt
+
+        self.plt = plt
+        self.figure, first = plt.subplots(figsize=(10, 5))
+        self.axes = [first] + [first.twinx() for _ in magnets[1:]]
+        self.lines = []
+
+        for index, (magnet, axes) in enumerate(zip(magnets, self.axes)):
+
+            colour = COLOURS[index % len(COLOURS)]
+            line, = axes.plot([], [], '-', color=colour, linewidth=1.,
+                              animated=not self.headless, label=magnet.label)
+            axes.set_ylabel("{} current [A]".format(magnet.label),
+                            color=colour)
+            axes.tick_params(axis='y', colors=colour)
+            self.lines.append(line)
+
+        first.set_xlim(-window, 0)
+        first.set_xlabel("Time [s]")
+        first.grid(True, alpha=0.3)
+        self.title = first.set_title("", animated=not self.headless)
+        first.legend(handles=self.lines, loc='upper left')
+
+        self.background = None
+
+    def start(self):
+
+        for magnet, series in zip(self.magnets, self.series):
+            magnet.acquisition.add_listener(series.append)
+            magnet.acquisition.start()
+
+        if not self.headless:
+
+            self.figure.canvas.mpl_connect('draw_event', self._on_draw)
+            self.figure.canvas.mpl_connect('close_event', self._on_close)
+            self.plt.show(block=False)
+
+    def stop(self):
+
+        for magnet, series in zip(self.magnets, self.series):
+            magnet.acquisition.remove_listener(series.append)
+            magnet.acquisition.stop()
+
+    def _on_draw(self, event):
+
+        self.background = self.figure.canvas.copy_from_bbox(self.figure.bbox)
+        self._draw_animated()
+
+    def _draw_animated(self):
+
+        self.axes[0].draw_artist(self.title)
+
+        for axes, line in zip(self.axes, self.lines):
+            axes.draw_artist(line)
+
+    def _on_close(self, event):
+
+        self.closed = True
+
+    def update(self):
+
+        """
+        Draws one frame: moves the lines to the newest samples and redraws
+        the axes only if a current left its range.
+        """
+
+        latest = max((series.last for series in self.series
+                      if series.last is not None), default=None)
+
+        if latest is None:
+            return
+
+        rescale = False
+
+        for axes, line, series in zip(self.axes, self.lines, self.series):
+
+            times, values = series.view()
+            line.set_data(times - latest, values)
+
+            visible = values[times >= latest - self.window]
+
+            if len(visible):
+                rescale |= self._fit_range(axes, visible.min(), visible.max())
+
+        self.title.set_text("MEAS.I up to {}: {}".format(
+            strftime("%H:%M:%S", localtime(latest)),
+            ", ".join("{} {}".format(magnet.label, stability(magnet))
+                      for magnet in self.magnets)))
+
+        self.frames += 1
+
+        if self.headless:
+            self.render()
+        elif rescale or self.background is None:
+            self.figure.canvas.draw()
+            self.figure.canvas.flush_events()
+        else:
+            self.blit()
+
+    def _fit_range(self, axes, low, high):
+
+        """
+        Sets the y range of an axes to contain [low, high] with a margin if
+        the data left it, or if it fills less than a quarter of it. Returns
+        True if the range changed.
+        """
+
+        bottom, top = axes.get_ylim()
+        span = max(high - low, 0.01)
+
+        if low >= bottom and high <= top and span > (top - bottom) / 4:
+            return False
+
+        axes.set_ylim(low - span / 2, high + span / 2)
+
+        return True
+
+    def blit(self):
+
+        canvas = self.figure.canvas
+        canvas.restore_region(self.background)
+        self._draw_animated()
+        canvas.blit(self.figure.bbox)
+        canvas.flush_events()
+
+    def render(self):
+
+        """
+        Renders the figure to the output file, replacing it atomically.
+        """
+
+        base, extension = os.path.splitext(self.output)
+        temporary = base + '.tmp' + extension
+
+        self.figure.savefig(temporary)
+        os.replace(temporary, self.output)
+
+    def run(self, duration=None):
+
+        """
+        Updates the plot every interval until duration seconds have passed,
+        the window is closed or the process is interrupted.
+        """
+
+        self.start()
+        end = monotonic() + duration if duration is not None else None
+
+        try:
+
+            while not self.closed and (end is None or monotonic() < end):
+
+                next_frame = monotonic() + self.interval
+                self.update()
+
+                wait = max(0., next_frame - monotonic())
+
+                if not self.headless:
+                    self.plt.pause(max(wait, 0.001))
+                elif wait > 0:
+                    threading.Event().wait(wait)
+
+        except KeyboardInterrupt:
+            pass
+
+        finally:
+            self.stop()
+
+
+def stability(magnet):
+
+    """
+    Describes whether the current of a magnet is stable within its settle
+    tolerance over the statistics window.
+    """
+
+    if magnet.is_stable():
+        return "stable"
+
+    return "not stable" if magnet.stats.full else "collecting"
+
+
+def has_display():
+
+    """
+    Returns True if a graphical display is available.
+    """
+
+    if os.environ.get('MPLBACKEND', '').lower() == 'agg':
+        return False
+
+    if os.name == 'nt' or sys.platform == 'darwin':
+        return True
+
+    return bool(os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY'))
+
+
+def add_arguments(parser):
+
+    """
+    Adds the live plot options to a command line parser.
+    """
+
+    parser.add_argument('--window', dest='window', type=float, default=60.,
+                        help='''
+    Time shown in the live plot. Measured in seconds [s].''')
+
+    parser.add_argument('--interval', dest='interval', type=float, default=0.5,
+                        help='''
+    Time between updates of the live plot. Measured in seconds [s].''')
+
+    parser.add_argument('--output', dest='output', default=None, help='''
+    Render the live plot to this PNG or SVG file instead of a window.''')
+
+    parser.add_argument('--duration', dest='duration', type=float,
+                        default=None, help='''
+    Stop the live plot after this time. Measured in seconds [s].''')
+
+
+def run_live(magnets, arguments):
+
+    """
+    Runs a live plot of the given magnets with the options of add_arguments().
+    """
+
+    plot = LivePlot(magnets, arguments.window, arguments.interval,
+                    arguments.output)
+
+    if plot.headless:
+        print("Rendering live plot to {} every {}s".format(plot.output,
+                                                           plot.interval))
+
+    plot.run(arguments.duration)
+
+    return plot
+
+
+if __name__ == "__main__":
+
+    from magnet_control import MAGNETS, Magnet
+
+    parser = argparse.ArgumentParser(description="""
+    Live plot of the measured current of the spectrometer magnets.
+    """, formatter_class=argparse.RawTextHelpFormatter)
+
+    parser.add_argument('--magnets', dest='magnets', nargs='+',
+                        default=['dipole', 'quadrupole'], choices=sorted(MAGNETS),
+                        help='''
+    Magnets to plot.''')
+
+    add_arguments(parser)
+
+    arguments = parser.parse_args()
+
+    run_live([Magnet(name) for name in arguments.magnets], arguments)
@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""
+magnet_benchmark.py
+
+Benchmark of the end-to-end latency of the spectrometer magnet operations.
+Each operation is run repeatedly against the simulated control system in
+japc_sim.py and the wall time, the time spent in each waited-on step and the
+number of get and set calls are reported. Results can be stored as a baseline
+and later runs compared against it to catch regressions.
+
+Times are reported in simulated seconds, that is the measured wall time
+multiplied by the simulation speed-up, so that they are comparable with the
+duration of the operations on the real converters.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+from collections import Counter, OrderedDict
+from time import perf_counter
+
+import numpy as np
+
+import current_archive
+from japc_session import provider
+from magnet_control import Magnet
+from settings_cache import cache
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'benchmark_baseline.json')
+
+# Allowed increase of the p95 time over the baseline before an operation is
+# reported as a regression.
+REGRESSION_TOLERANCE = 0.2
+
+
+class CountingJapc(object):
+
+    """
+    Wrapper around a PyJapc instance counting get and set calls.
+    """
+
+    def __init__(self, japc):
+
+        self.japc = japc
+        self.counts = Counter()
+
+    def getParam(self, parameterName, **kwargs):
+
+        self.counts['get'] += 1
+        return self.japc.getParam(parameterName, **kwargs)
+
+    def setParam(self, parameterName, parameterValue, **kwargs):
+
+        self.counts['set'] += 1
+        return self.japc.setParam(parameterName, parameterValue, **kwargs)
+
+    def __getattr__(self, name):
+
+        return getattr(self.japc, name)
+
+
+def operations(dipole, quadrupole):
+
+    """
+    Returns the benchmarked operations, in the order in which they are run in
+    each iteration, as an ordered dictionary of name to (magnet, function).
+    """
+
+    return OrderedDict([
+        ('dipole_turn_on', (dipole, lambda: dipole.turn_on(100., 15.))),
+        ('quadrupole_turn_on', (quadrupole, lambda: quadrupole.turn_on(150.))),
+        ('dipole_change_current',
+         (dipole, lambda: dipole.change_current(110., 15.))),
+        ('quadrupole_change_current',
+         (quadrupole, lambda: quadrupole.change_current(160.))),
+        ('dipole_current_plot', (dipole, lambda: dipole.measure_current())),
+        ('quadrupole_current_plot',
+         (quadrupole, lambda: quadrupole.measure_current())),
+        ('dipole_turn_off', (dipole, lambda: dipole.turn_off())),
+        ('quadrupole_turn_off', (quadrupole, lambda: quadrupole.turn_off())),
+    ])
+
+
+def run_benchmark(iterations=5, speedup=10., keep_cache=False):
+
+    """
+    Runs every operation the given number of times against a fresh simulated
+    control system and returns the results as a dictionary.
+
+    Arguments:
+
+        - iterations    Number of times each operation is run.
+
+        - speedup       Simulation speed-up.
+
+        - keep_cache    If True, the settings cache is subscribed to the PC
+                        state and function type, as in the magnet daemon.
+                        Otherwise it is cleared before each operation, as for
+                        separate command line invocations.
+    """
+
+    provider.use_simulator(speedup=speedup)
+    current_archive.disable()
+    japc = CountingJapc(provider.get())
+
+    dipole = Magnet('dipole', japc=japc)
+    quadrupole = Magnet('quadrupole', japc=japc)
+
+    if keep_cache:
+        for magnet in (dipole, quadrupole):
+            magnet.converter.subscribe_settings()
+
+    samples = OrderedDict()
+
+    for _ in range(iterations):
+
+        for name, (magnet, function) in operations(dipole, quadrupole).items():
+
+            if not keep_cache:
+                cache.invalidate()
+
+            magnet.last_transitions = None
+            japc.counts.clear()
+
+            start = perf_counter()
+
+            with contextlib.redirect_stdout(io.StringIO()):
+                function()
+
+            wall = (perf_counter() - start) * speedup
+            steps = {}
+
+            if magnet.last_transitions is not None:
+                for transition, _, _, elapsed in magnet.last_transitions.entries:
+                    steps[transition] = steps.get(transition, 0.) + elapsed * speedup
+
+            samples.setdefault(name, []).append(
+                (wall, steps, japc.counts['get'], japc.counts['set']))
+
+    provider.close()
+
+    return summarise(samples, iterations, speedup)
+
+
+def summarise(samples, iterations, speedup):
+
+    results = {'iterations': iterations, 'speedup': speedup,
+               'operations': OrderedDict()}
+
+    for name, runs in samples.items():
+
+        walls = np.array([run[0] for run in runs])
+        steps = OrderedDict()
+
+        for run in runs:
+            for step, elapsed in run[1].items():
+                steps.setdefault(step, []).append(elapsed)
+
+        results['operations'][name] = {
+            'p50': float(np.percentile(walls, 50)),
+            'p95': float(np.percentile(walls, 95)),
+            'p99': float(np.percentile(walls, 99)),
+            'steps': OrderedDict((step, float(np.mean(values)))
+                                 for step, values in steps.items()),
+            'gets': float(np.mean([run[2] for run in runs])),
+            'sets': float(np.mean([run[3] for run in runs])),
+        }
+
+    return results
+
+
+def print_results(results, baseline=None):
+
+    """
+    Prints the benchmark results, compared with the baseline if given, and
+    returns the names of operations which regressed.
+    """
+
+    regressions = []
+
+    print("\n{} iterations, simulation speed-up {}, times in simulated "
+          "seconds\n".format(results['iterations'], results['speedup']))
+    print("{:<28s} {:>8s} {:>8s} {:>8s} {:>6s} {:>6s} {:>10s}".format(
+        "Operation", "p50", "p95", "p99", "gets", "sets", "vs base"))
+
+    for name, result in results['operations'].items():
+
+        comparison = ""
+
+        if baseline is not None and name in baseline['operations']:
+
+            base = baseline['operations'][name]['p95']
+            change = (result['p95'] - base) / base if base > 0 else 0.
+            comparison = "{:+.0%}".format(change)
+
+            if change > REGRESSION_TOLERANCE:
+                comparison += " !"
+                regressions.append(name)
+
+        print("{:<28s} {:8.2f} {:8.2f} {:8.2f} {:6.1f} {:6.1f} {:>10s}".format(
+            name, result['p50'], result['p95'], result['p99'], result['gets'],
+            result['sets'], comparison))
+
+        for step, elapsed in result['steps'].items():
+            print("    {:<36s} {:8.2f}".format(step, elapsed))
+
+    if regressions:
+        print("\nRegressions beyond {:.0%} of the baseline p95: {}".format(
+            REGRESSION_TOLERANCE, ", ".join(regressions)))
+
+    return regressions
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="""
+    Benchmarks the spectrometer magnet operations against the simulated control system.
+    """, formatter_class=argparse.RawTextHelpFormatter)
+
+    parser.add_argument('--iterations', dest='iterations', type=int, default=5,
+                        help='''
+    Number of times each operation is run.''')
+
+    parser.add_argument('--speedup', dest='speedup', type=float, default=10.,
+                        help='''
+    Factor by which simulated time runs faster than real time.''')
+
+    parser.add_argument('--keep_cache', dest='keep_cache', action='store_true',
+                        help='''
+    Keep the settings cache subscribed between operations, as in the magnet daemon.''')
+
+    parser.add_argument('--baseline', dest='baseline', default=BASELINE_PATH,
+                        help='''
+    Baseline file to compare against.''')
+
+    parser.add_argument('--save_baseline', dest='save_baseline',
+                        action='store_true', help='''
+    Store the results as the new baseline instead of comparing.''')
+
+    arguments = parser.parse_args()
+
+    results = run_benchmark(arguments.iterations, arguments.speedup,
+                            arguments.keep_cache)
+
+    if arguments.save_baseline:
+
+        with open(arguments.baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+
+        print_results(results)
+        print("\nBaseline saved to {}".format(arguments.baseline))
+        sys.exit(0)
+
+    try:
+        with open(arguments.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    except IOError:
+        baseline = None
+
+    regressions = print_results(results, baseline)
+
+    sys.exit(1 if regressions else 0)
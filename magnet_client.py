@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+magnet_client.py
+
+Command line client for magnet_daemon.py. It takes the same --mode arguments as
+the spectrometer scripts, but the operation is carried out by the running
+daemon, so no JAPC session has to be created for each command.
+"""
+
+import argparse
+import json
+import os
+import socket
+import sys
+
+SOCKET_PATH = os.environ.get('MAGNET_DAEMON_SOCKET', '/tmp/magnet_settings.sock')
+
+MODES = ('on', 'off', 'plot', 'change', 'state', 'stats')
+
+
+def send_command(request, socket_path=SOCKET_PATH, echo=True):
+
+    """
+    Sends one command to the daemon and returns its final response.
+
+    Arguments:
+
+        - request       Dictionary with at least 'magnet' and 'mode'.
+
+        - socket_path   Path of the daemon's Unix socket.
+
+        - echo          Whether the progress output of the operation is
+                        printed as it arrives.
+    """
+
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.connect(socket_path)
+
+    try:
+
+        connection.sendall((json.dumps(request) + '\n').encode())
+        stream = connection.makefile('r')
+
+        for line in stream:
+
+            message = json.loads(line)
+
+            if 'output' in message:
+
+                if echo:
+                    sys.stdout.write(message['output'])
+
+                continue
+
+            return message
+
+    finally:
+        connection.close()
+
+    raise IOError("Connection to magnet daemon closed without a response")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="""
+    Sends a command for one of the spectrometer magnets to the magnet daemon.
+    """, formatter_class=argparse.RawTextHelpFormatter)
+
+    parser.add_argument('magnet', choices=['dipole', 'quadrupole'], help='''
+    The magnet to control.''')
+
+    parser.add_argument('--mode', dest='mode', default=None, choices=MODES,
+                        help='''
+    This defines what you would like to do to the magnet. The options are:
+
+        - 'on'      Switches on the magnet.
+
+        - 'off'     Switches off the magnet.
+
+        - 'plot'    Produces a plot of the current values over the past 10 seconds.
+
+        - 'change'  Changes the current without turning on/off.
+
+        - 'state'   Prints the PC state.
+
+        - 'stats'   Prints the current statistics over the recent samples.
+    ''')
+
+    parser.add_argument('--current', dest='current', default=None, help='''
+    The value of the current that the magnet should be set to. It is measured in Amps [A].''')
+
+    parser.add_argument('--ramp_duration', dest='ramp_duration', default=None, help='''
+    The time over which the dipole current should be ramped. It is measured in seconds [s].''')
+
+    parser.add_argument('--energy', dest='energy', default=None, help='''
+    Calculates the quadrupole current required to focus at the given energy. Energy is
+    measured in GeV.''')
+
+    parser.add_argument('--socket', dest='socket', default=SOCKET_PATH, help='''
+    Path of the daemon's Unix socket.''')
+
+    arguments = parser.parse_args()
+
+    if arguments.mode is None:
+        parser.error("--mode must be given")
+
+    request = {'magnet': arguments.magnet, 'mode': arguments.mode}
+
+    for key in ('current', 'ramp_duration', 'energy'):
+
+        if getattr(arguments, key) is not None:
+            request[key] = float(getattr(arguments, key))
+
+    response = send_command(request, arguments.socket)
+
+    if not response['ok']:
+
+        print(response.get('error', "Operation failed"))
+        sys.exit(1)
+
+    result = response['result']
+
+    if arguments.mode == 'state':
+
+        print("PC state: {}".format(result))
+
+    elif arguments.mode == 'stats':
+
+        for key, value in sorted(result.items()):
+            print("{:<18s} {:.5g}".format(key, value))
+
+    elif arguments.mode == 'plot':
+
+        import numpy as np
+        from magnet_control import plot_current
+
+        plot_current(np.array(result['times']), np.array(result['current']),
+                     result['plot_range'])
@@ -0,0 +1,790 @@
+# -*- coding: utf-8 -*-
+"""
+magnet_control.py
+
+Shared control procedures for the magnets of the electron spectrometer in the
+AWAKE experiment at CERN. Each magnet is described by an entry in the MAGNETS
+table; the Magnet class turns any entry into the turn on, change current, plot
+and turn off procedures used by the spectrometer scripts.
+
+NumPy and Matplotlib are only imported by the procedures which read MEAS.I or
+plot, so that switching a magnet off or changing its current starts quickly.
+"""
+
+import functools
+from time import perf_counter
+
+from japc_batch import get_params
+from japc_session import get_japc
+from metrics import registry
+from publisher import publisher
+from ramp_planner import plan_ramp
+from settings_cache import cache, CachedJapc
+from settle import wait_for_settle
+from state_wait import wait_for_state, wait_for_value, TransitionLog
+from tracing import tracer
+
+# Per-magnet configuration. Adding a magnet means adding an entry here.
+#
+#   label           Name used in printed messages and e-logbook entries.
+#   device          Power converter device name.
+#   func_type       Reference function type, 'CTRIM' or 'PLEP'.
+#   gui_index       Slot in the TSG41 GUI support vector holding the current.
+#   max_current     Maximum allowed current [A], or None.
+#   ramp            Ramp model of the magnet for ramp_planner: maximum dI/dt
+#                   [A/s], shortest CTRIM ramp [s], CTRIM ramp used while
+#                   max_rate is None [s] and time constant of the final
+#                   approach to the setpoint [s]. The dipole dI/dt limit has
+#                   not been measured yet, so its ramps keep the fixed 15 s
+#                   until max_rate is set to the measured value.
+#   settle          MEAS.I band around the setpoint [A] and number of
+#                   consecutive samples in it for the current to be settled,
+#                   and time allowed beyond settle_time before giving up [s].
+#   plot_range      Half-height of the plot y range around the mean [A], or
+#                   None for automatic limits.
+#   acquisition     MEAS.I history kept [s] and maximum sample rate [Hz].
+#   stats_window    Number of MEAS.I samples in the sliding statistics window.
+#   timeouts        Maximum time allowed to reach each PC state [s].
+
+MAGNETS = {
+
+    'dipole': {
+        'label': 'Dipole',
+        'device': 'RPPEF.BB4.RBIH.412435',
+        'func_type': 'CTRIM',
+        'gui_index': 68,
+        'max_current': None,
+        'ramp': {'max_rate': None, 'min_duration': 0.5,
+                 'default_duration': 15., 'settle_tau': 0.2},
+        'settle': {'tolerance': 0.1, 'samples': 10, 'margin': 10.},
+        'plot_range': None,
+        'acquisition': {'window': 60., 'rate': 50.},
+        'stats_window': 250,
+        'timeouts': {'OFF': 30., 'ON_STANDBY': 15., 'IDLE': 15.,
+                     'ARMED': 10., 'RUNNING': 10.},
+    },
+
+    'quadrupole': {
+        'label': 'Quadrupole',
+        'device': 'RPADA.BB4.RQNI.412432',
+        'func_type': 'PLEP',
+        'gui_index': 67,
+        'max_current': 362.,
+        'ramp': {'max_rate': 50., 'min_duration': 0.5, 'settle_tau': 0.2},
+        'settle': {'tolerance': 0.1, 'samples': 10, 'margin': 10.},
+        'plot_range': 2.,
+        'acquisition': {'window': 60., 'rate': 50.},
+        'stats_window': 250,
+        'timeouts': {'OFF': 30., 'ON_STANDBY': 30., 'IDLE': 30.,
+                     'ARMED': 10., 'RUNNING': 10.},
+    },
+}
+
+
+# Steps of the turn on procedure from each PC state, before the reference
+# function is applied. Each step is a (MODE.PC request, state waited for)
+# pair, where a request of None only waits. A converter in any other state is
+# first switched OFF. An ARMED converter is returned to IDLE, since it would
+# still read ARMED from its previous function while the new one re-arms it,
+# and REF.RUN would be sent before the new function is armed.
+
+TURN_ON_PATHS = {
+    'OFF': (('ON_STANDBY', 'ON_STANDBY'), ('IDLE', 'IDLE')),
+    'ON_STANDBY': (('IDLE', 'IDLE'),),
+    'IDLE': (),
+    'ARMED': (('IDLE', 'IDLE'),),
+    'RUNNING': ((None, 'IDLE'),),
+}
+
+
+def plan_turn_on(state, power_cycle=False):
+
+    """
+    Returns the shortest list of (MODE.PC request, state waited for) steps
+    which bring a converter from the given PC state to IDLE, ready for a
+    reference function. With power_cycle the converter is always switched OFF
+    first.
+    """
+
+    if state == 'OFF':
+        return list(TURN_ON_PATHS['OFF'])
+
+    if power_cycle or state not in TURN_ON_PATHS:
+        return [('OFF', 'OFF')] + list(TURN_ON_PATHS['OFF'])
+
+    return list(TURN_ON_PATHS[state])
+
+
+def traced(operation):
+
+    """
+    Decorator recording a Magnet method as an 'operation' span of the tracer
+    and in the operation metrics.
+    """
+
+    def decorator(method):
+
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+
+            labels = (('magnet', self.name), ('operation', operation))
+            begin = perf_counter()
+
+            try:
+                with tracer.span('operation', self.config['device'], operation,
+                                 args[0] if args else None):
+                    return method(self, *args, **kwargs)
+            except Exception:
+                registry.inc('magnet_operation_errors_total', labels)
+                raise
+            finally:
+                registry.observe('magnet_operation_duration_seconds', labels,
+                                 perf_counter() - begin)
+
+        return wrapper
+
+    return decorator
+
+
+class PowerConverter(object):
+
+    """
+    Thin wrapper around a single power converter device, so that properties
+    can be addressed without repeating the device name. Without an explicit
+    PyJapc instance the shared session from japc_session is used. Reads and
+    writes go through the shared settings cache.
+    """
+
+    def __init__(self, device, japc=None, cache=cache):
+
+        self.device = device
+        self.cache = cache
+        self._japc = japc
+
+    @property
+    def japc(self):
+
+        return self._japc if self._japc is not None else get_japc()
+
+    def parameter(self, prop):
+
+        return self.device + '/' + prop
+
+    def get(self, prop):
+
+        return self.cache.get(self.japc, self.parameter(prop))
+
+    def set(self, prop, value):
+
+        self.cache.set(self.japc, self.parameter(prop), value)
+
+    def set_if_changed(self, prop, value):
+
+        """
+        Writes a property unless it already has the given value. Returns True
+        if the value was written.
+        """
+
+        return self.cache.set_if_changed(self.japc, self.parameter(prop), value)
+
+    def subscribe_settings(self, props=('STATE', 'REF.FUNC.TYPE')):
+
+        """
+        Subscribes the settings cache to the given properties, so that they
+        are served from the cache and updated as they change.
+        """
+
+        for prop in props:
+            self.cache.subscribe(self.japc, self.parameter(prop))
+
+    def get_many(self, *props):
+
+        """
+        Reads several properties of the device in one round and returns a
+        dictionary mapping each property to its value.
+        """
+
+        values = get_params(self.japc, [self.parameter(prop) for prop in props])
+
+        for name, value in values.items():
+            if self.cache.cacheable(name):
+                self.cache.put(name, value)
+
+        return {prop: values[self.parameter(prop)] for prop in props}
+
+    def state(self):
+
+        return self.get('STATE')['PC']
+
+    def wait_for_state(self, target, timeout, log=None, initial=None):
+
+        return wait_for_state(CachedJapc(self.cache, self.japc), self.device,
+                              target, timeout=timeout, log=log,
+                              initial=initial)
+
+    def wait_for_value(self, prop, expected, log=None):
+
+        # Read-backs bypass the cache, which is only updated once the value
+        # has been confirmed.
+
+        value, reached, elapsed = wait_for_value(
+            self.japc, self.parameter(prop), expected, log=log)
+
+        if reached and self.cache.cacheable(self.parameter(prop)):
+            self.cache.put(self.parameter(prop), value)
+
+        return value, reached, elapsed
+
+
+class Magnet(object):
+
+    """
+    Control procedures for one spectrometer magnet.
+
+    Arguments:
+
+        - name      Key of the magnet in the MAGNETS table.
+
+        - japc      PyJapc instance to use. Defaults to the shared session,
+                    which is only created when the magnet is first used.
+    """
+
+    def __init__(self, name, japc=None):
+
+        self.name = name
+        self.config = MAGNETS[name]
+        self.label = self.config['label']
+        self.converter = PowerConverter(self.config['device'], japc)
+        self._acquisition = None
+        self._stats = None
+
+        # TransitionLog of the most recent turn on, change or turn off.
+        self.last_transitions = None
+
+    @property
+    def acquisition(self):
+
+        """
+        CurrentAcquisition of MEAS.I, created on first use together with the
+        sliding-window statistics and the archive fed from it.
+        """
+
+        if self._acquisition is None:
+
+            from acquisition import CurrentAcquisition
+            from current_stats import StreamingStats
+
+            self._stats = StreamingStats(self.config['stats_window'])
+            self._acquisition = CurrentAcquisition(
+                self.config['device'], japc=self.converter._japc,
+                **self.config['acquisition'])
+            self._acquisition.add_listener(self._stats.update)
+
+            archive = self.archive
+
+            if archive is not None:
+                self._acquisition.add_listener(archive.append)
+                self._acquisition.add_stop_listener(archive.flush)
+
+        return self._acquisition
+
+    @property
+    def archive(self):
+
+        """
+        MagnetArchive to which the acquired MEAS.I samples are appended, or
+        None if archiving is disabled.
+        """
+
+        from current_archive import get_archive
+
+        archive = get_archive()
+
+        return archive[self.name] if archive is not None else None
+
+    @property
+    def stats(self):
+
+        """
+        StreamingStats of MEAS.I, created together with the acquisition.
+        """
+
+        if self._stats is None:
+            self.acquisition
+
+        return self._stats
+
+    def is_stable(self):
+
+        """
+        Returns True if the MEAS.I statistics window is full and every sample
+        in it lies within the settle tolerance of the window mean.
+        """
+
+        return self.stats.is_stable(self.config['settle']['tolerance'])
+
+    def stats_summary(self):
+
+        """
+        Returns the MEAS.I statistics, including whether the current is
+        stable within the settle tolerance.
+        """
+
+        return self.stats.summary(self.config['settle']['tolerance'])
+
+    @property
+    def japc(self):
+
+        return self.converter.japc
+
+    def timeout(self, state):
+
+        return self.config['timeouts'][state]
+
+    def limit_current(self, current):
+
+        """
+        Returns the current clipped to the maximum allowed for this magnet.
+        """
+
+        current = float(current)
+        max_current = self.config['max_current']
+
+        if max_current is not None and current > max_current:
+
+            print("Requested current greater than {}A. Setting to "
+                  "maximum current.".format(max_current))
+            current = max_current
+
+        return current
+
+    @traced('turn_on')
+    def turn_on(self, current, ramp_duration=None, publish=True,
+                power_cycle=False):
+
+        """
+        This function turns on the magnet to the settings given by the input
+        arguments.
+
+        Arguments:
+
+            - current           This is the value of the current that the
+                                magnet should be set to. It is measured in
+                                Amps [A].
+
+            - ramp_duration     This is the length of time over which the
+                                current should be ramped up, for CTRIM
+                                magnets. It is measured in seconds [s]. If
+                                None, the shortest duration allowed by the
+                                ramp model of the magnet is used.
+
+            - publish           Whether the current is written to the TSG41
+                                GUI support vector and the e-logbook. Callers
+                                which publish several magnets at once pass
+                                False.
+
+            - power_cycle       Whether the power converter is switched off
+                                and on again even if it is already on.
+
+        Returns True if the power converter was armed and started and the
+        current settled on the setpoint.
+        """
+
+        transitions = self.last_transitions = TransitionLog(
+            self.label + " turn on")
+        converter = self.converter
+
+        print("Turning on {} to current {}A.\n".format(self.name, current))
+        print("Checking PC state...")
+
+        pc_status = converter.state()
+        steps = plan_turn_on(pc_status, power_cycle)
+
+        if not steps:
+            print("PC already in state: {}. No restart needed.\n".format(
+                pc_status))
+        else:
+            print("PC in state: {}. Steps: {}\n".format(
+                pc_status, " -> ".join(state for _, state in steps)))
+
+        pc_status = self._follow(steps, pc_status, transitions)
+
+        if pc_status is None:
+            return False
+
+        print("")
+
+        return self._apply(current, ramp_duration, transitions, pc_status,
+                           publish)
+
+    @traced('change_current')
+    def change_current(self, current, ramp_duration=None, publish=True):
+
+        """
+        This function changes the current of the magnet without turning the
+        power converter off and on again. The arguments are the same as for
+        turn_on().
+        """
+
+        transitions = self.last_transitions = TransitionLog(
+            self.label + " change current")
+
+        pc_status = self.converter.state()
+
+        print("PC in state: {}\n".format(pc_status))
+
+        # A function still running or armed has to return to IDLE before the
+        # new one can be armed.
+
+        if pc_status in ('ARMED', 'RUNNING'):
+
+            pc_status = self._follow(TURN_ON_PATHS[pc_status], pc_status,
+                                     transitions)
+
+            if pc_status is None:
+                return False
+
+            print("")
+
+        return self._apply(current, ramp_duration, transitions, pc_status,
+                           publish)
+
+    def _follow(self, steps, pc_status, transitions):
+
+        """
+        Makes the MODE.PC requests of a list of (request, state waited for)
+        steps, starting from pc_status. Returns the state reached, or None if
+        a state was not reached.
+        """
+
+        # Update PC modes and check in correct state
+
+        for request, state in steps:
+
+            if request is not None:
+                self.converter.set('MODE.PC', request)
+
+            pc_status, _, _ = self.converter.wait_for_state(
+                state, self.timeout(state), log=transitions, initial=pc_status)
+
+            print("PC is now in state: {}".format(pc_status))
+
+            if pc_status != state:
+                print("PC did not reach state {}. Breaking...".format(state))
+                transitions.report()
+                return None
+
+        return pc_status
+
+    def _apply(self, current, ramp_duration, transitions, pc_status,
+               publish=True):
+
+        """
+        Writes the reference function, runs it and reports the current reached.
+        pc_status is the PC state before the function is written.
+        """
+
+        current_set = self.limit_current(current)
+
+        # Plan the ramp from the present current.
+
+        present = self.converter.get('MEAS.I')
+        ramp_duration_set, settle_time = plan_ramp(
+            self.config, present, current_set,
+            float(ramp_duration) if ramp_duration is not None else None)
+
+        print("Step of {:.3f}A from {:.3f}A, expected to settle in {:.2f}s\n"
+              .format(current_set - present, present, settle_time))
+
+        if self.config['func_type'] == 'CTRIM':
+
+            self._set_function_type(transitions)
+            if publish:
+                self._publish(current_set)
+            self._write_trim(current_set, ramp_duration_set, transitions)
+
+        else:
+
+            if publish:
+                self._publish(current_set)
+            self._write_plep(current_set, transitions)
+            self._set_function_type(transitions, arms=True)
+
+        # PC state should now go to 'ARMED'.
+
+        check_state, _, _ = self.converter.wait_for_state(
+            'ARMED', self.timeout('ARMED'), log=transitions, initial=pc_status)
+
+        print("PC State set to: {}\n".format(check_state))
+
+        if check_state == 'ARMED':
+
+            print("Turning on {}...\n".format(self.name))
+
+            self.converter.set('REF.RUN', 1.0)
+
+            # A short function may already have finished and returned the
+            # converter to IDLE by the time the state is first read.
+
+            check_run_state, run_started, _ = self.converter.wait_for_state(
+                ('RUNNING', 'IDLE'), self.timeout('RUNNING'), log=transitions,
+                initial=check_state)
+
+            print("PC State: {}".format(check_run_state))
+
+            if not run_started:
+                print("PC did not start the function. Breaking...")
+                transitions.report()
+                return False
+
+        else:
+
+            print("PC state not 'ARMED'. Breaking...")
+            transitions.report()
+            return False
+
+        # Wait for the current to settle on the setpoint.
+
+        settled, detector, _ = self.wait_for_settle(current_set, settle_time,
+                                                    log=transitions)
+
+        if settled:
+            print("Current is at {}A".format(detector.last))
+        else:
+            print("Current did not settle: {}".format(detector.diagnostic()))
+
+        transitions.report()
+
+        return settled
+
+    def wait_for_settle(self, current, expected_time, log=None):
+
+        """
+        Waits until MEAS.I has settled within the configured band around the
+        given current, allowing the expected settling time plus the configured
+        margin. Returns a tuple (settled, detector, elapsed).
+        """
+
+        settle = self.config['settle']
+
+        return wait_for_settle(self.acquisition, current, settle['tolerance'],
+                               settle['samples'],
+                               expected_time + settle['margin'], log=log)
+
+    def _set_function_type(self, transitions, arms=False):
+
+        # Finding _non_multiplexed_sps context. A write which arms the
+        # converter, after the PLEP settings, is always made.
+
+        print("Setting function type...")
+
+        func_type = self.config['func_type']
+
+        if arms:
+            self.converter.set('REF.FUNC.TYPE', func_type)
+
+        elif not self.converter.set_if_changed('REF.FUNC.TYPE', func_type):
+
+            print("Function type already: {}\n".format(func_type))
+            return
+
+        func_type, _, _ = self.converter.wait_for_value(
+            'REF.FUNC.TYPE', func_type, log=transitions)
+
+        print("Function type set to: {}\n".format(func_type))
+
+    def _write_trim(self, current_set, ramp_duration_set, transitions):
+
+        print("Setting magnet trim settings to:")
+        print("Current = {}A".format(current_set))
+        print("Ramp Duration = {}s\n".format(ramp_duration_set))
+
+        self.converter.set('REF.TRIM.DURATION', ramp_duration_set)
+        self.converter.set('REF.TRIM.FINAL', current_set)
+
+        check = self.converter.get_many('REF.TRIM.FINAL', 'REF.TRIM.DURATION')
+
+        print("Magnet settings have been set to:")
+        print("Current = {}A".format(check['REF.TRIM.FINAL']))
+        print("Ramp Duration = {}s\n".format(check['REF.TRIM.DURATION']))
+
+    def _write_plep(self, current_set, transitions):
+
+        print("Setting magnet PLEP settings to:")
+        print("Current = {}A\n".format(current_set))
+
+        self.converter.set('REF.PLEP.FINAL', current_set)
+
+        check_current, _, _ = self.converter.wait_for_value(
+            'REF.PLEP.FINAL', current_set, log=transitions)
+
+        print("Magnet settings have been set to:")
+        print("Current = {}A".format(check_current))
+
+    def _publish(self, current_set):
+
+        # This stores the variable somewhere the event builder can find it
+        # and prints to e-log. Both are done in the background.
+
+        publisher.set_slots({self.config['gui_index']: current_set},
+                            self.converter._japc)
+        publisher.log("Spectrometer {} set to {:0.2f} Amps".format(
+            self.label, current_set))
+
+    @traced('measure_current')
+    def measure_current(self, duration=10.):
+
+        """
+        Returns the MEAS.I samples of the last duration seconds, as NumPy
+        arrays of times relative to the first sample and currents. If the
+        acquisition is not already running it is started for the duration of
+        the measurement.
+        """
+
+        acquisition = self.acquisition
+        started = not acquisition.running
+
+        if started:
+            acquisition.buffer.clear()
+            acquisition.start()
+
+        try:
+            acquisition.wait_for(duration)
+        finally:
+            if started:
+                acquisition.stop()
+
+        times, current_array = acquisition.read(duration)
+
+        if not len(times):
+            raise RuntimeError("No MEAS.I samples received from {}".format(
+                self.config['device']))
+
+        return times - times[0], current_array
+
+    def current_plot(self):
+
+        """
+        This function plots the current values for the last 10 seconds, and
+        also returns the mean current.
+        """
+
+        print("\nGathering current data. Please wait...\n")
+
+        times, current_array = self.measure_current()
+
+        print_stats(self.stats_summary())
+
+        return plot_current(times, current_array, self.config['plot_range'])
+
+    @traced('turn_off')
+    def turn_off(self):
+
+        """
+        This function checks the state of the magnet, and turns it off if it
+        isn't already.
+        """
+
+        transitions = self.last_transitions = TransitionLog(
+            self.label + " turn off")
+
+        check_state = self.converter.state()
+
+        print("PC current state: {}".format(check_state))
+
+        if check_state == 'OFF':
+
+            print("PC is already off. Do not need to turn off.")
+            return
+
+        print('Turning off...')
+        self.converter.set('MODE.PC', 'OFF')
+
+        # Wait for the shutdown to complete
+
+        pc_state, _, elapsed = self.converter.wait_for_state(
+            'OFF', self.timeout('OFF'), log=transitions, initial=check_state)
+
+        print("PC current state: {} (after {:.1f}s)".format(pc_state, elapsed))
+
+
+def read_magnets(magnets, props=('STATE', 'MEAS.I'), japc=None):
+
+    """
+    Reads the same properties of several magnets in one round.
+
+    Arguments:
+
+        - magnets   List of Magnet objects.
+
+        - props     Properties to read from each power converter.
+
+        - japc      PyJapc instance to use. Defaults to the shared session.
+
+    Returns a dictionary mapping each magnet name to a dictionary of property
+    values.
+    """
+
+    names = [magnet.converter.parameter(prop)
+             for magnet in magnets for prop in props]
+    values = get_params(japc if japc is not None else get_japc(), names)
+
+    return {magnet.name: {prop: values[magnet.converter.parameter(prop)]
+                          for prop in props}
+            for magnet in magnets}
+
+
+def print_stats(summary):
+
+    """
+    Prints the sliding-window current statistics returned by
+    StreamingStats.summary().
+    """
+
+    print("Current statistics over the last {} samples:".format(summary['samples']))
+    print("  Standard deviation = {:.4f}A".format(summary['std']))
+    print("  Peak to peak       = {:.4f}A".format(summary['peak_to_peak']))
+    print("  Drift              = {:.5f}A/s".format(summary['drift']))
+    print("  Ripple             = {:.4f}A at {:.2f}Hz".format(
+        summary['ripple_amplitude'], summary['ripple_frequency']))
+
+    if 'stable' in summary:
+        print("  Stable             = {}".format(
+            "yes" if summary['stable'] else
+            "no" if summary['full'] else "window not full yet"))
+
+
+def plot_current(times, current_array, plot_range=None):
+
+    """
+    Plots a series of current measurements together with their mean, and
+    returns the mean current.
+
+    Arguments:
+
+        - times             Sample times. Measured in seconds [s].
+
+        - current_array     Measured currents. Measured in Amps [A].
+
+        - plot_range        Half-height of the y range around the mean, or
+                            None for automatic limits. Measured in Amps [A].
+    """
+
+    import numpy as np
+    import matplotlib.pyplot as plt
+
+    mean_val = np.mean(current_array)
+
+    print("Mean current is {0:3.3f}A".format(mean_val))
+    plt.plot(times, current_array, "-o")
+    plt.plot((times[0], times[-1]), (mean_val, mean_val), 'r-', linewidth=1.5)
+    plt.xlabel("Time [s]")
+    plt.ylabel("Current [A]")
+    plt.xlim(times[0], times[-1])
+
+    if plot_range is not None:
+        plt.ylim(mean_val - plot_range, mean_val + plot_range)
+
+    plt.show()
+
+    return mean_val
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""
+magnet_daemon.py
+
+Long-running control daemon for the electron spectrometer magnets in the AWAKE
+experiment at CERN. The daemon keeps the JAPC session, RBAC token and magnet
+objects alive between commands and serves the magnet operations over a Unix
+socket, so that each command only costs the hardware time. Commands are sent
+with magnet_client.py.
+
+Protocol: the client sends one JSON object per line, for example
+{"magnet": "dipole", "mode": "on", "current": 100, "ramp_duration": 15}.
+The daemon answers with any number of {"output": text} lines carrying the
+printed progress of the operation, followed by one {"ok": bool, "result": ...}
+line.
+"""
+
+import argparse
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+
+import metrics
+import tracing
+from japc_session import provider
+from magnet_client import SOCKET_PATH, MODES
+from magnet_control import MAGNETS, Magnet
+from publisher import publisher
+from thread_output import ThreadOutput
+
+
+class MagnetService(object):
+
+    """
+    Executes magnet commands. Commands for the same magnet are serialised,
+    commands for different magnets may run at the same time.
+    """
+
+    def __init__(self):
+
+        self.magnets = {name: Magnet(name) for name in MAGNETS}
+        self.locks = {name: threading.Lock() for name in MAGNETS}
+
+    def start_acquisition(self):
+
+        """
+        Starts the MEAS.I acquisition of every magnet, so that plots can be
+        served from the recent history without waiting, and subscribes the
+        settings cache to the PC state and function type and the shared TSG41
+        GUI support vector to its acquisition.
+        """
+
+        for magnet in self.magnets.values():
+            magnet.acquisition.start()
+            magnet.converter.subscribe_settings()
+
+        publisher.gui.subscribe()
+
+    def execute(self, request):
+
+        name = request.get('magnet')
+        mode = request.get('mode')
+
+        if name not in self.magnets:
+            raise ValueError("Unknown magnet: {}".format(name))
+
+        if mode not in MODES:
+            raise ValueError("Unknown mode: {}".format(mode))
+
+        magnet = self.magnets[name]
+
+        with self.locks[name]:
+
+            if mode == 'state':
+                return magnet.converter.state()
+
+            if mode == 'stats':
+                return {key: float(value)
+                        for key, value in magnet.stats_summary().items()}
+
+            if mode == 'off':
+                return magnet.turn_off()
+
+            if mode == 'plot':
+
+                print("\nGathering current data. Please wait...\n")
+
+                times, current_array = magnet.measure_current()
+
+                return {'times': times.tolist(),
+                        'current': current_array.tolist(),
+                        'plot_range': magnet.config['plot_range']}
+
+            current = self.requested_current(request)
+
+            if mode == 'on':
+                return magnet.turn_on(current, request.get('ramp_duration'))
+
+            return magnet.change_current(current, request.get('ramp_duration'))
+
+    def requested_current(self, request):
+
+        if request.get('current') is not None:
+            return float(request['current'])
+
+        if request.get('energy') is not None and request['magnet'] == 'quadrupole':
+
+            from energy_calibration import energy_to_current
+
+            current, clipped = energy_to_current(float(request['energy']))
+
+            if clipped:
+                print("Current for {} GeV clipped to {:.1f}A".format(
+                    request['energy'], float(current)))
+
+            return float(current)
+
+        raise ValueError("--mode '{}' requires --current".format(request['mode']))
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+
+    disconnected = False
+
+    def send(self, message):
+
+        """
+        Sends a message to the client. Once the client has disconnected,
+        messages are dropped, so that an operation in progress always runs to
+        completion rather than failing on its next print.
+        """
+
+        if self.disconnected:
+            return
+
+        try:
+            self.wfile.write((json.dumps(message) + '\n').encode())
+            self.wfile.flush()
+        except OSError:
+            self.disconnected = True
+
+    def handle(self):
+
+        for line in self.rfile:
+
+            try:
+                request = json.loads(line.decode())
+            except ValueError as error:
+                self.send({'ok': False, 'error': str(error)})
+                continue
+
+            output.local.sink = lambda text: self.send({'output': text})
+
+            try:
+                result = self.server.service.execute(request)
+                response = {'ok': result is not False, 'result': result}
+            except Exception as error:
+                response = {'ok': False, 'error': str(error)}
+            finally:
+                output.local.sink = None
+
+            self.send(response)
+
+
+class MagnetDaemon(socketserver.ThreadingUnixStreamServer):
+
+    daemon_threads = True
+
+    def __init__(self, socket_path=SOCKET_PATH):
+
+        if os.path.exists(socket_path):
+
+            # Only remove the socket of a daemon which is no longer running.
+
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+            try:
+                probe.connect(socket_path)
+            except OSError:
+                os.unlink(socket_path)
+            else:
+                raise RuntimeError("A magnet daemon is already listening on "
+                                   "{}".format(socket_path))
+            finally:
+                probe.close()
+
+        socketserver.ThreadingUnixStreamServer.__init__(self, socket_path,
+                                                        RequestHandler)
+        self.service = MagnetService()
+
+
+output = ThreadOutput(sys.stdout)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="""
+    Runs the spectrometer magnet control daemon, which keeps the JAPC session open and
+    serves commands from magnet_client.py.
+    """, formatter_class=argparse.RawTextHelpFormatter)
+
+    parser.add_argument('--socket', dest='socket', default=SOCKET_PATH, help='''
+    Path of the Unix socket on which commands are accepted.''')
+
+    tracing.add_arguments(parser)
+    metrics.add_arguments(parser)
+
+    arguments = parser.parse_args()
+
+    tracing.from_arguments(arguments)
+    metrics.from_arguments(arguments)
+
+    sys.stdout = output
+
+    try:
+        server = MagnetDaemon(arguments.socket)
+    except RuntimeError as error:
+        sys.exit(str(error))
+
+    provider.start_keepalive()
+    server.service.start_acquisition()
+
+    print("Magnet daemon listening on {}".format(arguments.socket))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(arguments.socket)
+        from current_archive import close as close_archive
+        close_archive()
+        provider.close()
+        tracing.finish()
+        metrics.finish()
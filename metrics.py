@@ -0,0 +1,387 @@
+# -*- coding: utf-8 -*-
+"""
+metrics.py
+
+Aggregate metrics of the control path of the spectrometer magnets, to follow
+how it behaves over time rather than per run as with tracing. Counters and
+fixed-bucket latency histograms are kept per device and property for every
+JAPC get and set, per device and PC state transition for the waits on STATE,
+and per magnet for each operation.
+
+The metrics are exposed in the Prometheus text format, over HTTP on a local
+port and/or written to a file at the end of a run. Metrics are off until
+enable() is called; the disabled registry costs one attribute check per call,
+and an enabled observation a bucket search and two additions under a lock.
+"""
+
+import os
+import threading
+from bisect import bisect_left
+from time import perf_counter
+
+# Upper bounds of the latency histogram buckets. Measured in seconds [s].
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1., 2.5, 5., 10., 30., 60., 120.)
+
+METRICS = {
+    'magnet_japc_request_duration_seconds': (
+        'histogram', 'Duration of JAPC gets and sets.'),
+    'magnet_japc_errors_total': (
+        'counter', 'JAPC gets and sets which raised an error.'),
+    'magnet_japc_updates_total': (
+        'counter', 'Subscription updates received.'),
+    'magnet_pc_transition_duration_seconds': (
+        'histogram', 'Time from the command until the target state was '
+        'seen.'),
+    'magnet_pc_transition_timeouts_total': (
+        'counter', 'Waits on STATE which timed out.'),
+    'magnet_operation_duration_seconds': (
+        'histogram', 'Duration of magnet operations.'),
+    'magnet_operation_errors_total': (
+        'counter', 'Magnet operations which raised an error.'),
+}
+
+
+def split_name(name):
+
+    if isinstance(name, (list, tuple)):
+        return 'group', ','.join(name)
+
+    device, _, prop = name.partition('/')
+    return device, prop
+
+
+class Histogram(object):
+
+    """
+    Fixed-bucket histogram. Counts are kept per bucket and made cumulative
+    when exported.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.
+
+    def observe(self, value):
+
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Registry(object):
+
+    """
+    Counters and histograms identified by a metric name and a tuple of
+    (label, value) pairs.
+    """
+
+    def __init__(self):
+
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.server = None
+
+    def inc(self, name, labels, amount=1):
+
+        if not self.enabled:
+            return
+
+        key = (name, labels)
+
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, labels, value):
+
+        if not self.enabled:
+            return
+
+        key = (name, labels)
+
+        with self.lock:
+
+            histogram = self.histograms.get(key)
+
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+
+            histogram.observe(value)
+
+    def render(self):
+
+        """
+        Returns the metrics in the Prometheus text exposition format.
+        """
+
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: (list(histogram.counts), histogram.sum)
+                          for key, histogram in self.histograms.items()}
+
+        lines = []
+
+        for name, (kind, description) in sorted(METRICS.items()):
+
+            series = counters if kind == 'counter' else histograms
+            keys = sorted(key for key in series if key[0] == name)
+
+            if not keys:
+                continue
+
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} {}'.format(name, kind))
+
+            for key in keys:
+
+                labels = key[1]
+
+                if kind == 'counter':
+                    lines.append('{}{} {}'.format(name, format_labels(labels),
+                                                  series[key]))
+                    continue
+
+                counts, total = series[key]
+                cumulative = 0
+
+                for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), counts):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(
+                        name, format_labels(labels + (('le', str(bound)),)),
+                        cumulative))
+
+                lines.append('{}_sum{} {!r}'.format(name, format_labels(labels),
+                                                    total))
+                lines.append('{}_count{} {}'.format(
+                    name, format_labels(labels), cumulative))
+
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path):
+
+        """
+        Writes the metrics to a file, replacing it atomically, for example in
+        the directory of the Prometheus node exporter textfile collector.
+        """
+
+        temporary = path + '.tmp'
+
+        with open(temporary, 'w') as metrics_file:
+            metrics_file.write(self.render())
+
+        os.replace(temporary, path)
+
+    def serve(self, port, host='127.0.0.1'):
+
+        """
+        Serves the metrics over HTTP on a background thread, at any path.
+        """
+
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name='metrics',
+                         daemon=True).start()
+
+    def stop(self):
+
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+def format_labels(labels):
+
+    if not labels:
+        return ''
+
+    return '{' + ','.join('{}="{}"'.format(
+        name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in labels) + '}'
+
+
+class MetricsJapc(object):
+
+    """
+    Wrapper around a PyJapc instance timing every get and set and counting
+    subscription updates. Other attributes are passed through.
+    """
+
+    def __init__(self, japc, registry):
+
+        self.japc = japc
+        self.registry = registry
+        self.labels = {}
+
+    def _labels(self, operation, parameterName):
+
+        key = (operation, tuple(parameterName)
+               if isinstance(parameterName, list) else parameterName)
+        labels = self.labels.get(key)
+
+        if labels is None:
+            device, prop = split_name(parameterName)
+            labels = self.labels[key] = (('operation', operation),
+                                         ('device', device),
+                                         ('property', prop))
+
+        return labels
+
+    def _call(self, operation, parameterName, call, *args, **kwargs):
+
+        if not self.registry.enabled:
+            return call(parameterName, *args, **kwargs)
+
+        labels = self._labels(operation, parameterName)
+        begin = perf_counter()
+
+        try:
+            return call(parameterName, *args, **kwargs)
+        except Exception:
+            self.registry.inc('magnet_japc_errors_total', labels)
+            raise
+        finally:
+            self.registry.observe('magnet_japc_request_duration_seconds',
+                                  labels, perf_counter() - begin)
+
+    def getParam(self, parameterName, **kwargs):
+
+        return self._call('get', parameterName, self.japc.getParam, **kwargs)
+
+    def setParam(self, parameterName, parameterValue, **kwargs):
+
+        return self._call('set', parameterName, self.japc.setParam,
+                          parameterValue, **kwargs)
+
+    def subscribeParam(self, parameterName, onValueReceived=None, **kwargs):
+
+        device, prop = split_name(parameterName)
+        labels = (('device', device), ('property', prop))
+
+        def counted(*args):
+
+            self.registry.inc('magnet_japc_updates_total', labels)
+
+            if onValueReceived is not None:
+                onValueReceived(*args)
+
+        return self.japc.subscribeParam(parameterName, onValueReceived=counted,
+                                        **kwargs)
+
+    def __getattr__(self, name):
+
+        return getattr(self.japc, name)
+
+
+def observe_transition(device, initial, state, reached, elapsed):
+
+    """
+    Records a wait on the PC state of a device, from the state before the
+    command to the state it ended in. Waits which found the target state on
+    their first read are recorded too, as the fastest transitions.
+    """
+
+    if not registry.enabled:
+        return
+
+    labels = (('device', device), ('from', initial), ('to', state))
+
+    if reached:
+        registry.observe('magnet_pc_transition_duration_seconds', labels,
+                         elapsed)
+    else:
+        registry.inc('magnet_pc_transition_timeouts_total', labels)
+
+
+registry = Registry()
+
+_file = None
+_installed = False
+
+
+def enable(port=None, path=None):
+
+    """
+    Starts collecting metrics and installs the metrics wrapper on the shared
+    JAPC session.
+
+    Arguments:
+
+        - port      Local port on which to serve the metrics, or None.
+
+        - path      File to which finish() writes the metrics, or None.
+    """
+
+    global _file, _installed
+
+    from japc_session import provider
+
+    if not _installed:
+        provider.add_wrapper(lambda japc: MetricsJapc(japc, registry))
+        _installed = True
+
+    registry.enabled = True
+    _file = path
+
+    if port is not None and registry.server is None:
+        registry.serve(port)
+
+
+def finish():
+
+    """
+    Writes the metrics file if one was requested, and stops the HTTP server.
+    """
+
+    if registry.enabled and _file is not None:
+        registry.dump(_file)
+
+    registry.stop()
+
+
+def add_arguments(parser):
+
+    """
+    Adds the --metrics_port and --metrics_file options to a command line
+    parser.
+    """
+
+    parser.add_argument('--metrics_port', dest='metrics_port', type=int,
+                        default=None, help='''
+    Serve JAPC and PC state transition metrics in the Prometheus format on this local port.''')
+
+    parser.add_argument('--metrics_file', dest='metrics_file', default=None,
+                        help='''
+    Write the metrics in the Prometheus format to this file at the end of the run.''')
+
+
+def from_arguments(arguments):
+
+    """
+    Enables metrics if requested by the options added with add_arguments().
+    """
+
+    if arguments.metrics_port is not None or arguments.metrics_file is not None:
+        enable(arguments.metrics_port, arguments.metrics_file)
@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+"""
+publisher.py
+
+Background publishing of the spectrometer magnet settings. The set currents
+are stored in the TSG41 GUI support vector for the event builder and announced
+in the AWAKE e-logbook; both are done by a worker thread, so that a slow or
+unavailable logbook never delays a magnet change. Slot updates of all magnets
+are merged in the shared GuiSupportVector and written at a bounded rate.
+
+Logbook events are coalesced: events arriving within a flush interval are
+posted as one entry, and events inside a batch(), such as an energy scan, are
+posted as one summary entry when the batch ends. Failed posts are retried with
+backoff and, if the logbook stays down, appended to a spool file which is
+replayed once posting succeeds again.
+
+The spool file can be moved with the environment variable
+MAGNET_LOGBOOK_SPOOL.
+"""
+
+import atexit
+import json
+import os
+import queue
+import threading
+from contextlib import contextmanager
+from time import time, monotonic
+
+from gui_vector import GuiSupportVector
+from japc_session import get_logbook
+
+SPOOL_PATH = os.environ.get(
+    'MAGNET_LOGBOOK_SPOOL',
+    os.path.join(os.path.expanduser('~'), '.magnet_logbook_spool.jsonl'))
+
+
+class Publisher(object):
+
+    """
+    Queue of TSG41 slot updates and e-logbook events, served by a worker
+    thread started on first use.
+
+    Arguments:
+
+        - activity      E-logbook activity.
+
+        - interval      Time for which logbook events are collected before
+                        they are posted together. Measured in seconds [s].
+
+        - retries       Number of failed posts of an entry before it is
+                        spooled.
+
+        - backoff       Delay before the first retry, doubled after each
+                        failure. Measured in seconds [s].
+
+        - spool_path    File in which entries that could not be posted are
+                        kept.
+    """
+
+    def __init__(self, activity='AWAKE', interval=2., retries=3, backoff=1.,
+                 spool_path=SPOOL_PATH):
+
+        self.activity = activity
+        self.interval = interval
+        self.retries = retries
+        self.backoff = backoff
+        self.spool_path = spool_path
+
+        self.gui = GuiSupportVector()
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.batches = []
+        self._worker = None
+
+        # State owned by the worker thread.
+
+        self.events = []
+        self.first_event = None
+        self.entries = []
+        self.failures = 0
+        self.retry_at = 0.
+
+    # Interface
+
+    def set_slots(self, slots, japc=None):
+
+        """
+        Updates slots of the TSG41 GUI support vector, which is written in the
+        background.
+
+        Arguments:
+
+            - slots     Dictionary mapping vector indices to values.
+
+            - japc      PyJapc instance to use. Defaults to the shared session.
+        """
+
+        if japc is not None:
+            self.gui.japc = japc
+
+        self.gui.update(slots)
+        self._put(('slots', None, None))
+
+    def log(self, text):
+
+        """
+        Queues an e-logbook event.
+        """
+
+        with self.lock:
+
+            if self.batches:
+                self.batches[-1].append(text)
+                return
+
+        self._put(('event', text, None))
+
+    @contextmanager
+    def batch(self, title):
+
+        """
+        Context manager collecting the logbook events of the enclosed block
+        into a single entry headed by title, posted when the block ends.
+        """
+
+        events = []
+
+        with self.lock:
+            self.batches.append(events)
+
+        try:
+            yield
+        finally:
+
+            with self.lock:
+                self.batches.remove(events)
+
+            if events:
+                self._put(('event', "\n".join([title] + events), None))
+
+    def flush(self, timeout=10.):
+
+        """
+        Writes pending slots and posts pending events, spooling those which
+        fail, and waits for the worker to finish. Returns False on timeout.
+        """
+
+        if self._worker is None:
+            return True
+
+        done = threading.Event()
+        self.queue.put(('flush', done, None))
+
+        return done.wait(timeout)
+
+    # Worker
+
+    def _put(self, item):
+
+        with self.lock:
+
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run,
+                                                name='magnet-publisher',
+                                                daemon=True)
+                self._worker.start()
+                atexit.register(self.flush)
+
+        self.queue.put(item)
+
+    def _run(self):
+
+        self._drain_spool()
+
+        while True:
+
+            try:
+                kind, item, _ = self.queue.get(timeout=self._wait_time())
+            except queue.Empty:
+                kind = None
+
+            if kind == 'event':
+
+                if not self.events:
+                    self.first_event = monotonic()
+                self.events.append(item)
+
+            # Coalesce everything already queued before writing.
+
+            if kind is not None and kind != 'flush' and not self.queue.empty():
+                continue
+
+            self._write_slots(force=kind == 'flush')
+            self._post(force=kind == 'flush')
+
+            if kind == 'flush':
+                item.set()
+
+    def _wait_time(self):
+
+        now = monotonic()
+        deadlines = []
+
+        if self.events:
+            deadlines.append(self.first_event + self.interval)
+        if self.entries:
+            deadlines.append(max(self.retry_at, now))
+        if self.gui.pending:
+            deadlines.append(now + self.gui.next_write())
+
+        return max(0., min(deadlines) - now) if deadlines else None
+
+    def _write_slots(self, force=False):
+
+        try:
+            self.gui.flush(force)
+        except Exception as error:
+            print("Writing the TSG41 GUI support vector failed: {}".format(
+                error))
+            self.gui.last_write = monotonic() + self.backoff
+
+    def _post(self, force=False):
+
+        if self.events and (force or
+                            monotonic() >= self.first_event + self.interval):
+            self.entries.append("\n".join(self.events))
+            self.events = []
+
+        if not self.entries or (not force and monotonic() < self.retry_at):
+            return
+
+        # Spooled entries are older than the queued ones, and are posted first
+        # so that the logbook keeps its order after an outage.
+
+        try:
+            if not self._drain_spool():
+                raise RuntimeError("spooled entries could not be posted")
+            logbook = get_logbook(self.activity)
+            while self.entries:
+                logbook.create_event(self.entries[0])
+                self.entries.pop(0)
+        except Exception as error:
+            self.failures += 1
+            print("E-logbook post failed ({} of {}): {}".format(
+                self.failures, self.retries, error))
+            if force or self.failures >= self.retries:
+                self._spool()
+            else:
+                self.retry_at = monotonic() + self.backoff * 2 ** (
+                    self.failures - 1)
+            return
+
+        self.failures = 0
+
+    def _spool(self):
+
+        with open(self.spool_path, 'a') as spool:
+            for text in self.entries:
+                spool.write(json.dumps({'time': time(),
+                                        'activity': self.activity,
+                                        'text': text}) + '\n')
+
+        print("Spooled {} e-logbook entries to {}".format(len(self.entries),
+                                                         self.spool_path))
+        self.entries = []
+        self.failures = 0
+        self.retry_at = monotonic() + self.backoff
+
+    def _drain_spool(self):
+
+        """
+        Posts the entries of the spool file, keeping those which fail.
+        Returns True if the spool is empty afterwards.
+        """
+
+        if not os.path.exists(self.spool_path):
+            return True
+
+        with open(self.spool_path) as spool:
+            records = [json.loads(line) for line in spool if line.strip()]
+
+        posted = 0
+
+        try:
+            for record in records:
+                get_logbook(record['activity']).create_event(record['text'])
+                posted += 1
+        except Exception:
+            pass
+
+        if posted == len(records):
+            os.remove(self.spool_path)
+            return True
+
+        with open(self.spool_path, 'w') as spool:
+            for record in records[posted:]:
+                spool.write(json.dumps(record) + '\n')
+
+        return False
+
+
+publisher = Publisher()
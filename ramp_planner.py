@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+ramp_planner.py
+
+Ramp planning for the spectrometer magnets. Each magnet has a model of how
+fast its current may change, given by the 'ramp' entry of its configuration
+in magnet_control.MAGNETS. From the present MEAS.I and the requested current
+the planner works out the shortest safe CTRIM ramp duration, and the time a
+PLEP function needs to reach and settle on its final value, so that small
+steps are not run with the duration of the largest one. Requested durations
+which would exceed the dI/dt limit are lengthened. A magnet whose limit has not
+been measured has a max_rate of None and ramps in default_duration.
+
+    max_rate            Maximum dI/dt of the converter and magnet [A/s], or
+                        None if it is not known.
+    min_duration        Shortest CTRIM ramp duration [s].
+    default_duration    CTRIM ramp duration used while max_rate is None [s].
+    settle_tau          Time constant of the final approach to the setpoint [s].
+    settle_taus         Number of time constants allowed for settling.
+"""
+
+from math import ceil
+
+
+class RampModel(object):
+
+    """
+    Current ramp limits of one magnet.
+
+    Arguments:
+
+        - max_rate      Maximum dI/dt. Measured in Amps per second [A/s].
+                        None if it is not known.
+
+        - min_duration  Shortest ramp duration. Measured in seconds [s].
+
+        - default_duration  Ramp duration used while max_rate is None.
+                            Measured in seconds [s].
+
+        - settle_tau    Time constant of the approach to the setpoint.
+                        Measured in seconds [s].
+
+        - settle_taus   Number of time constants allowed for settling.
+    """
+
+    def __init__(self, max_rate, min_duration=0.5, default_duration=15.,
+                 settle_tau=0.2, settle_taus=5):
+
+        self.max_rate = float(max_rate) if max_rate is not None else None
+        self.min_duration = float(min_duration)
+        self.default_duration = float(default_duration)
+        self.settle_tau = float(settle_tau)
+        self.settle_taus = settle_taus
+
+    @classmethod
+    def from_config(cls, config):
+
+        return cls(**config['ramp'])
+
+    def ramp_duration(self, start, target):
+
+        """
+        Returns the shortest CTRIM ramp duration from start to target which
+        keeps dI/dt within max_rate, rounded up to 10 ms, or default_duration
+        if max_rate is None.
+        """
+
+        if self.max_rate is None:
+            return self.default_duration
+
+        duration = ceil(abs(target - start) / self.max_rate * 100) / 100.
+
+        return max(self.min_duration, duration)
+
+    def settle_time(self, start, target, ramp_duration=None):
+
+        """
+        Returns the expected time from REF.RUN until MEAS.I has settled on
+        target: the ramp, at the given duration or at max_rate, followed by
+        the final approach.
+        """
+
+        if ramp_duration is None:
+            ramp_duration = (abs(target - start) / self.max_rate
+                             if self.max_rate is not None
+                             else self.default_duration)
+
+        return ramp_duration + self.settle_taus * self.settle_tau
+
+
+def plan_ramp(config, start, target, ramp_duration=None):
+
+    """
+    Returns a tuple (ramp_duration, settle_time) for a change of current.
+
+    Arguments:
+
+        - config            Magnet configuration from magnet_control.MAGNETS.
+
+        - start             Present current. Measured in Amps [A].
+
+        - target            Requested current. Measured in Amps [A].
+
+        - ramp_duration     Requested CTRIM ramp duration [s], or None to use
+                            the shortest safe one. A duration shorter than the
+                            safe one is lengthened to it. Ignored for PLEP
+                            magnets, for which None is returned.
+    """
+
+    model = RampModel.from_config(config)
+
+    if config['func_type'] != 'CTRIM':
+        return None, model.settle_time(start, target)
+
+    safe_duration = model.ramp_duration(start, target)
+
+    if ramp_duration is None:
+        ramp_duration = safe_duration
+
+    elif model.max_rate is not None and ramp_duration < safe_duration:
+        print("Ramp duration of {:.2f}s exceeds the {:.1f}A/s limit for a "
+              "step of {:.3f}A. Ramping in {:.2f}s instead.".format(
+                  ramp_duration, model.max_rate, target - start,
+                  safe_duration))
+        ramp_duration = safe_duration
+
+    return ramp_duration, model.settle_time(start, target, ramp_duration)
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+settings_cache.py
+
+Read-through cache of power converter parameters, such as the PC state and
+the reference function type, keyed by the full parameter name. Only parameters
+with a running subscription are cached, so that changes made from other
+consoles are always seen; entries are refreshed by the subscription and
+invalidated by our own writes. This allows redundant reads, and writes of a
+value a setting already has, to be skipped in long-running processes such as
+the magnet daemon.
+"""
+
+import threading
+
+
+class SettingsCache(object):
+
+    """
+    Cache of the values of subscribed parameters.
+    """
+
+    def __init__(self):
+
+        self.entries = {}
+        self.subscribed = set()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def cacheable(self, name):
+
+        return name in self.subscribed
+
+    def lookup(self, name):
+
+        """
+        Returns (True, value) if a valid entry exists, else (False, None).
+        """
+
+        with self.lock:
+
+            if name in self.entries and name in self.subscribed:
+                self.hits += 1
+                return True, self.entries[name]
+
+            self.misses += 1
+            return False, None
+
+    def put(self, name, value):
+
+        with self.lock:
+            self.entries[name] = value
+
+    def invalidate(self, name=None, device=None):
+
+        """
+        Removes the entry for one parameter, for all parameters of one device,
+        or, without arguments, all entries.
+        """
+
+        with self.lock:
+
+            if name is not None:
+                self.entries.pop(name, None)
+            elif device is not None:
+                for key in [key for key in self.entries
+                            if key.startswith(device + '/')]:
+                    del self.entries[key]
+            else:
+                self.entries.clear()
+
+    def get(self, japc, name):
+
+        """
+        Returns the value of a parameter, from the cache where possible.
+        """
+
+        if self.cacheable(name):
+
+            found, value = self.lookup(name)
+
+            if found:
+                return value
+
+        value = japc.getParam(name)
+
+        if self.cacheable(name):
+            self.put(name, value)
+
+        return value
+
+    def set(self, japc, name, value):
+
+        """
+        Writes a parameter and invalidates its entry. A MODE.PC write
+        invalidates every entry of the device, since the converter may reset
+        its settings when changing mode.
+        """
+
+        japc.setParam(name, value)
+
+        device, prop = name.split('/', 1)
+
+        if prop == 'MODE.PC':
+            self.invalidate(device=device)
+        else:
+            self.invalidate(name)
+
+    def set_if_changed(self, japc, name, value):
+
+        """
+        Writes a parameter unless its subscription shows that it already has
+        the given value. Returns True if the value was written.
+        """
+
+        if self.cacheable(name) and self.get(japc, name) == value:
+            return False
+
+        self.set(japc, name, value)
+        return True
+
+    def subscribe(self, japc, name):
+
+        """
+        Subscribes to a parameter so that its entry is kept up to date and
+        never expires.
+        """
+
+        if name in self.subscribed:
+            return
+
+        japc.subscribeParam(name, onValueReceived=self.put)
+        japc.startSubscriptions(parameterName=name)
+        self.subscribed.add(name)
+
+    def unsubscribe(self, japc, name):
+
+        if name not in self.subscribed:
+            return
+
+        japc.stopSubscriptions(parameterName=name)
+        japc.clearSubscriptions(parameterName=name)
+        self.subscribed.discard(name)
+        self.invalidate(name)
+
+    def reset(self):
+
+        """
+        Forgets all subscriptions and entries, for when the JAPC session they
+        belong to is closed.
+        """
+
+        with self.lock:
+            self.subscribed.clear()
+            self.entries.clear()
+
+
+class CachedJapc(object):
+
+    """
+    Read-only view of a PyJapc instance whose getParam goes through a cache,
+    for passing to functions which expect a PyJapc instance.
+    """
+
+    def __init__(self, cache, japc):
+
+        self.cache = cache
+        self.japc = japc
+
+    def getParam(self, name):
+
+        return self.cache.get(self.japc, name)
+
+
+cache = SettingsCache()
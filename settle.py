@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+settle.py
+
+Detection of the measured current of a spectrometer magnet converging on its
+setpoint. A change of current is complete as soon as MEAS.I has stayed within a
+tolerance band around the requested value for a number of consecutive samples,
+rather than after a fixed, worst-case wait.
+"""
+
+import threading
+from time import monotonic
+
+from tracing import tracer
+
+
+class SettleDetector(object):
+
+    """
+    Counts consecutive samples within tolerance of the target current.
+
+    Arguments:
+
+        - target        Requested current. Measured in Amps [A].
+
+        - tolerance     Half-width of the band around the target. Measured in
+                        Amps [A].
+
+        - samples       Number of consecutive samples that must lie in the
+                        band.
+    """
+
+    def __init__(self, target, tolerance, samples):
+
+        self.target = float(target)
+        self.tolerance = float(tolerance)
+        self.samples = int(samples)
+        self.in_band = 0
+        self.longest = 0
+        self.count = 0
+        self.last = None
+
+    def update(self, value):
+
+        """
+        Adds one MEAS.I sample and returns True once the current has settled.
+        """
+
+        self.count += 1
+        self.last = value
+
+        if abs(value - self.target) <= self.tolerance:
+            self.in_band += 1
+            self.longest = max(self.longest, self.in_band)
+        else:
+            self.in_band = 0
+
+        return self.in_band >= self.samples
+
+    @property
+    def settled(self):
+
+        return self.in_band >= self.samples
+
+    def diagnostic(self):
+
+        """
+        Returns a description of how far the current was from settling.
+        """
+
+        if self.last is None:
+            return "no MEAS.I samples received"
+
+        return ("last MEAS.I {:.4f}A is {:+.4f}A from the target {:.4f}A "
+                "(tolerance {}A); longest run in band {} of {} samples, "
+                "{} samples received".format(
+                    self.last, self.last - self.target, self.target,
+                    self.tolerance, self.longest, self.samples, self.count))
+
+
+def wait_for_settle(acquisition, target, tolerance, samples, timeout,
+                    log=None):
+
+    """
+    Waits until the MEAS.I samples of an acquisition have settled on a target.
+    The acquisition is started for the duration of the wait if it is not
+    already running.
+
+    Arguments:
+
+        - acquisition   CurrentAcquisition of the magnet.
+
+        - target        Requested current. Measured in Amps [A].
+
+        - tolerance     Half-width of the band around the target. Measured in
+                        Amps [A].
+
+        - samples       Number of consecutive samples that must lie in the
+                        band.
+
+        - timeout       Maximum time to wait. Measured in seconds [s].
+
+        - log           Optional TransitionLog on which the outcome is
+                        recorded.
+
+    Returns a tuple (settled, detector, elapsed), where the detector holds the
+    last sample and can describe a failure to settle.
+    """
+
+    detector = SettleDetector(target, tolerance, samples)
+    done = threading.Event()
+
+    def listener(timestamp, value):
+
+        if detector.update(value):
+            done.set()
+
+    start = monotonic()
+    started = not acquisition.running
+
+    acquisition.add_listener(listener)
+
+    try:
+
+        if started:
+            acquisition.start()
+
+        done.wait(timeout)
+
+    finally:
+
+        acquisition.remove_listener(listener)
+
+        if started:
+            acquisition.stop()
+
+    elapsed = monotonic() - start
+    settled = detector.settled
+
+    tracer.record('wait', acquisition.parameter.split('/')[0],
+                  'MEAS.I settled', detector.last, elapsed,
+                  'ok' if settled else 'timeout')
+
+    if log is not None:
+        log.record('MEAS.I settled at {}'.format(detector.target),
+                   detector.last, settled, elapsed)
+
+    return settled, detector, elapsed
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""
+spectrometer.py
+
+This script drives the dipole and quadrupole magnets of the electron
+spectrometer in the AWAKE experiment at CERN together. The two power converters
+are sequenced in parallel, so that setting up the spectrometer takes as long as
+the slower of the two magnets rather than the sum of both.
+"""
+
+import argparse
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import live_plot
+import spectrometer_dipole
+import spectrometer_quadrupole
+import metrics
+import tracing
+from magnet_control import read_magnets
+from thread_output import destination, prefixed
+
+
+def run_parallel(tasks):
+
+    """
+    Runs the given tasks at the same time and waits for all of them to finish.
+
+    Arguments:
+
+        - tasks     Dictionary mapping a magnet name to a tuple
+                    (function, arguments) to be called for that magnet.
+
+    Returns a dictionary mapping each magnet name to the value returned by its
+    function, or to the exception it raised. Each line printed by a function
+    is prefixed with its magnet name.
+    """
+
+    results = {}
+    write = destination()
+    width = max(len(name) for name in tasks) + 2
+
+    def labelled(name, function, args):
+
+        with prefixed('{:<{}s} '.format('[' + name + ']', width), write):
+            return function(*args)
+
+    with ThreadPoolExecutor(max_workers=len(tasks)) as executor:
+
+        futures = {name: executor.submit(labelled, name, function, args)
+                   for name, (function, args) in tasks.items()}
+
+        for name, future in futures.items():
+
+            try:
+                results[name] = future.result()
+            except Exception as error:
+                results[name] = error
+
+    return results
+
+
+def spectrometer_turn_on(dipole_current, ramp_duration, quadrupole_current):
+
+    """
+    Turns on the spectrometer dipole and quadrupole at the same time.
+
+    Arguments:
+
+        - dipole_current        The current the dipole should be set to. It is
+                                measured in Amps [A].
+
+        - ramp_duration         The dipole ramp duration. It is measured in
+                                seconds [s].
+
+        - quadrupole_current    The current the quadrupole should be set to. It
+                                is measured in Amps [A].
+
+    Returns True only if both power converters reached ARMED, were started and
+    settled on their setpoints.
+    """
+
+    print("Turning on spectrometer: dipole to {}A, quadrupole to {}A.\n".format(
+        dipole_current, quadrupole_current))
+
+    results = run_parallel({
+        'dipole': (spectrometer_dipole.dipole_turn_on,
+                   (dipole_current, ramp_duration)),
+        'quadrupole': (spectrometer_quadrupole.quadrupole_turn_on,
+                       (quadrupole_current,)),
+    })
+
+    return report(results)
+
+
+def spectrometer_turn_off():
+
+    """
+    Turns off the spectrometer dipole and quadrupole at the same time.
+    """
+
+    results = run_parallel({
+        'dipole': (spectrometer_dipole.dipole_turn_off, ()),
+        'quadrupole': (spectrometer_quadrupole.quadrupole_turn_off, ()),
+    })
+
+    return report(results)
+
+
+def spectrometer_status():
+
+    """
+    Reads the PC state and measured current of both magnets in one round and
+    prints them.
+    """
+
+    status = read_magnets([spectrometer_dipole.dipole,
+                           spectrometer_quadrupole.quadrupole])
+
+    for name, values in status.items():
+        print("  {:<12s} {:<12s} {:.3f}A".format(name, values['STATE']['PC'],
+                                               values['MEAS.I']))
+
+    return True
+
+
+def report(results):
+
+    """
+    Prints the outcome for each magnet and returns True if none of them failed.
+    A magnet has failed if its procedure raised or returned False.
+    """
+
+    ok = True
+
+    print("\nSpectrometer summary:")
+
+    for name, result in results.items():
+
+        if isinstance(result, Exception):
+
+            print("  {:<12s} FAILED ({})".format(name, result))
+            ok = False
+
+        elif result is False:
+
+            print("  {:<12s} FAILED (PC not 'ARMED' or current not settled)".format(name))
+            ok = False
+
+        else:
+
+            print("  {:<12s} ok".format(name))
+
+    return ok
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="""
+    This script controls the dipole and quadrupole magnets of the electron spectrometer in the AWAKE experiment at CERN together.
+    """, formatter_class=argparse.RawTextHelpFormatter)
+
+    parser.add_argument('--mode', dest='mode', default=None, choices=['on', 'off', 'status', 'live'],
+                        help='''
+    This defines what you would like to do to the spectrometer magnets. The options
+    are:
+
+        - 'on'      Switches on the dipole and quadrupole in parallel.
+
+        - 'off'     Switches off the dipole and quadrupole in parallel.
+
+        - 'status'  Prints the PC state and current of both magnets.
+
+        - 'live'    Plots the current of both magnets continuously, in a window or
+                    to the --output file.
+    ''')
+
+    parser.add_argument('--dipole_current', dest='dipole_current', default=None, help='''
+    The value of the current that the dipole magnet should be set to. It is measured in Amps [A].''')
+
+    parser.add_argument('--ramp_duration', dest='ramp_duration', default=None, help='''
+    The time over which the dipole current should be ramped up. It is measured in seconds [s].
+    By default the shortest duration allowed by the dipole ramp rate limit is used, or 15s while
+    the limit has not been measured. Shorter durations are lengthened to the limit.''')
+
+    parser.add_argument('--quadrupole_current', dest='quadrupole_current', default=None, help='''
+    The value of the current that the quadrupole magnet should be set to. It is measured in Amps [A].''')
+
+    parser.add_argument('--energy', dest='energy', default=None, help='''
+    Calculates the quadrupole current required to focus at the given energy instead
+    of using --quadrupole_current. Energy is measured in GeV.''')
+
+    live_plot.add_arguments(parser)
+    tracing.add_arguments(parser)
+    metrics.add_arguments(parser)
+
+    arguments = parser.parse_args()
+
+    tracing.from_arguments(arguments)
+    metrics.from_arguments(arguments)
+
+    if arguments.mode == 'off':
+
+        success = spectrometer_turn_off()
+
+    elif arguments.mode == 'status':
+
+        success = spectrometer_status()
+
+    elif arguments.mode == 'live':
+
+        live_plot.run_live([spectrometer_dipole.dipole,
+                            spectrometer_quadrupole.quadrupole], arguments)
+        success = True
+
+    elif arguments.mode == 'on':
+
+        if arguments.dipole_current is None or (
+                arguments.quadrupole_current is None and arguments.energy is None):
+
+            parser.error("--mode 'on' requires --dipole_current and either "
+                         "--quadrupole_current or --energy")
+
+        if arguments.quadrupole_current is None:
+
+            quadrupole_current = spectrometer_quadrupole.energy_to_current(
+                float(arguments.energy))
+
+        else:
+
+            quadrupole_current = float(arguments.quadrupole_current)
+
+        success = spectrometer_turn_on(float(arguments.dipole_current),
+                                       arguments.ramp_duration,
+                                       quadrupole_current)
+
+    else:
+
+        parser.error("--mode must be given")
+
+    tracing.finish()
+    metrics.finish()
+
+    sys.exit(0 if success else 1)
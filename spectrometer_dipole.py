@@ -6,19 +6,16 @@ This script controls the dipole magnet that is part of the electron spectrometer
 at CERN. Developed by James Chappell: james.anthony.chappell@cern.ch
 """
 
-import pyjapc
-import numpy as np
-import matplotlib.pyplot as plt
-import pylogbook
-from time import sleep
 import argparse
 
-japc = pyjapc.PyJapc('SPS.USER.ALL')
-japc.rbacLogin(username='awakeop', password='Plasma4edda')
-japc.rbacGetToken()
+import metrics
+import tracing
+from magnet_control import Magnet
 
+dipole = Magnet('dipole')
 
-def dipole_turn_on(current, ramp_duration):
+
+def dipole_turn_on(current, ramp_duration, power_cycle=False):
     
     """ 
     This function turns on the UCL AWAKE Spectrometer dipole to the settings 
@@ -31,195 +28,22 @@ def dipole_turn_on(current, ramp_duration):
                     
         - ramp_duration     This is the length of time over which the current
                             should be ramped up. It is measured in seconds [s].
+
+        - power_cycle       Whether the PC is switched off and on again even
+                            if it is already on.
                             
     """
     
-    # Check whether PC mode is off
-    
-    print("Turning on dipole to current {}A.\n".format(current))
-    print("Checking PC state...")
-    
-    pc_status = japc.getParam('RPPEF.BB4.RBIH.412435/STATE')
-    
-    if pc_status['PC'] != 'OFF':
-        
-        japc.setParam('RPPEF.BB4.RBIH.412435/MODE.PC', 'OFF')
-        
-        print("PC was in state: {}".format(pc_status['PC']))
-        print("Turning PC off.")
-        
-        # Wait a few seconds to allow PC to switch off
-        sleep(10)
-        
-        updated_status = japc.getParam('RPPEF.BB4.RBIH.412435/STATE')
-        
-        print("PC is now in state: {}\n".format(updated_status['PC']))
-        print("Beginning dipole turn on procedure...\n")
-        
-    else:
-        
-        print("PC already in state: {}\n".format(pc_status['PC']))
-        print("Beginning dipole turn on procedure...\n")
-        
-        
-    # Update PC modes and check in correct state
-    
-    print("Updating PC modes...")
-    
-    japc.setParam('RPPEF.BB4.RBIH.412435/MODE.PC', 'ON_STANDBY')
-    sleep(5)
-    japc.setParam('RPPEF.BB4.RBIH.412435/MODE.PC', 'IDLE')
-    
-    pc_status = japc.getParam('RPPEF.BB4.RBIH.412435/STATE')
-    
-    print("PC in state: {}\n".format(pc_status['PC']))
-    
-    # Finding _non_multiplexed_sps context
-    
-    print("Setting function type...")
-    
-    japc.setParam('RPPEF.BB4.RBIH.412435/REF.FUNC.TYPE', 'CTRIM')
-    sleep(1)
-    func_type = japc.getParam('RPPEF.BB4.RBIH.412435/REF.FUNC.TYPE')
-    
-    print("Function type set to: {}\n".format(func_type))
-    
-    # Set the trim settings for duration and final according to the input
-    # arguments specified.
-    
-    current_set = float(current)
-    ramp_duration_set = float(ramp_duration)
-    
-    print("Setting magnet trim settings to:")
-    print("Current = {}A".format(current_set))
-    print("Ramp Duration = {}s\n".format(ramp_duration_set))
-    
-    # This stores the variable somewhere the event builder can find it and prints to e-log
-    var_vec = japc.getParam('TSG41.AWAKE-GUI-SUPPORT/ValueAcquisition#floatValue')
-    var_vec[68] = current_set
-    japc.setParam('TSG41.AWAKE-GUI-SUPPORT/ValueSettings#floatValue',var_vec)
-    elog = pylogbook.eLogbook("AWAKE")
-    entry = elog.create_event("Spectrometer Dipole set to "+"{:0.2f}".format(current_set)+" Amps")
-    
-    japc.setParam('RPPEF.BB4.RBIH.412435/REF.TRIM.DURATION', ramp_duration_set)
-    japc.setParam('RPPEF.BB4.RBIH.412435/REF.TRIM.FINAL', current_set)
-    
-    sleep(3)
-    
-    check_current = japc.getParam('RPPEF.BB4.RBIH.412435/REF.TRIM.FINAL')
-    check_ramp = japc.getParam('RPPEF.BB4.RBIH.412435/REF.TRIM.DURATION')
-    
-    print("Magnet settings have been set to:")
-    print("Current = {}A".format(check_current))
-    print("Ramp Duration = {}s\n".format(check_ramp))
-    
-    # PC state should now be 'ARMED'. 
-    
-    check_state = japc.getParam('RPPEF.BB4.RBIH.412435/STATE')
-    
-    print("PC State set to: {}\n".format(check_state['PC']))
-    
-    if check_state['PC'] == 'ARMED':
-    
-        print("Turning on dipole...\n")
-    
-        japc.setParam('RPPEF.BB4.RBIH.412435/REF.RUN', 1.0)
-        
-        sleep(1)
-        
-        check_run_state = japc.getParam('RPPEF.BB4.RBIH.412435/STATE')
-        
-        print("PC State: {}".format(check_run_state['PC']))
-    
-    else:
-        
-        print("PC state not 'ARMED'. Breaking...")
-        return 0
-    
-    # Wait for ramp duration to check what the current is.
-    
-    sleep(ramp_duration_set)
-    
-    current_test = japc.getParam('RPPEF.BB4.RBIH.412435/MEAS.I')
-    
-    print("Current is at {}A".format(current_test))
-    
-    
-def change_current(current):
+    return dipole.turn_on(current, ramp_duration, power_cycle=power_cycle)
     
-    pc_status = japc.getParam('RPPEF.BB4.RBIH.412435/STATE')
     
-    print("PC in state: {}\n".format(pc_status['PC']))
+def change_current(current, ramp_duration=None):
     
-    # Finding _non_multiplexed_sps context
-    
-    print("Setting function type...")
-    
-    japc.setParam('RPPEF.BB4.RBIH.412435/REF.FUNC.TYPE', 'CTRIM')
-    sleep(1)
-    func_type = japc.getParam('RPPEF.BB4.RBIH.412435/REF.FUNC.TYPE')
-    
-    print("Function type set to: {}\n".format(func_type))
-    
-    # Set the trim settings for duration and final according to the input
-    # arguments specified.
-    
-    current_set = float(current)
-    ramp_duration_set = float(ramp_duration)
-    
-    print("Setting magnet trim settings to:")
-    print("Current = {}A".format(current_set))
-    print("Ramp Duration = {}s\n".format(ramp_duration_set))
-    
-    # This stores the variable somewhere the event builder can find it and prints to e-log
-    var_vec = japc.getParam('TSG41.AWAKE-GUI-SUPPORT/ValueAcquisition#floatValue')
-    var_vec[68] = current_set
-    japc.setParam('TSG41.AWAKE-GUI-SUPPORT/ValueSettings#floatValue',var_vec)
-    elog = pylogbook.eLogbook("AWAKE")
-    entry = elog.create_event("Spectrometer Dipole set to "+"{:0.2f}".format(current_set)+" Amps")
-    
-    japc.setParam('RPPEF.BB4.RBIH.412435/REF.TRIM.DURATION', ramp_duration_set)
-    japc.setParam('RPPEF.BB4.RBIH.412435/REF.TRIM.FINAL', current_set)
-    
-    sleep(3)
-    
-    check_current = japc.getParam('RPPEF.BB4.RBIH.412435/REF.TRIM.FINAL')
-    check_ramp = japc.getParam('RPPEF.BB4.RBIH.412435/REF.TRIM.DURATION')
-    
-    print("Magnet settings have been set to:")
-    print("Current = {}A".format(check_current))
-    print("Ramp Duration = {}s\n".format(check_ramp))
-    
-    # PC state should now be 'ARMED'. 
-    
-    check_state = japc.getParam('RPPEF.BB4.RBIH.412435/STATE')
-    
-    print("PC State set to: {}\n".format(check_state['PC']))
-    
-    if check_state['PC'] == 'ARMED':
-    
-        print("Turning on dipole...\n")
-    
-        japc.setParam('RPPEF.BB4.RBIH.412435/REF.RUN', 1.0)
-        
-        sleep(1)
-        
-        check_run_state = japc.getParam('RPPEF.BB4.RBIH.412435/STATE')
-        
-        print("PC State: {}".format(check_run_state['PC']))
-    
-    else:
-        
-        print("PC state not 'ARMED'. Breaking...")
-        return 0
-    
-    # Wait for ramp duration to check what the current is.
-    
-    sleep(ramp_duration_set)
-    
-    current_test = japc.getParam('RPPEF.BB4.RBIH.412435/MEAS.I')
+    """
+    This function changes the dipole current without turning the PC off and on.
+    """
     
-    print("Current is at {}A".format(current_test))
+    return dipole.change_current(current, ramp_duration)
     
     
 def current_plot():
@@ -228,29 +52,7 @@ def current_plot():
     This function plots the current values for the last 10 seconds, and also returns the mean current.
     """
     
-    print("\nGathering current data. Please wait...\n")
-    
-    timesteps = 1
-    
-    current_array = []
-    
-    while timesteps <= 100:
-        
-        current_val = japc.getParam('RPPEF.BB4.RBIH.412435/MEAS.I')
-        current_array.append(current_val)
-        sleep(0.1)
-        timesteps = timesteps + 1
-    
-    mean_val = np.mean(current_array)
-    
-    print("Mean current is {0:3.3f}A".format(mean_val))
-    x = np.linspace(0, 10, 100)
-    plt.plot(x, current_array, "-o")
-    plt.plot((0, 100), (mean_val, mean_val), 'r-', linewidth=1.5)
-    plt.xlabel("Time [s]")
-    plt.ylabel("Current [A]")
-    plt.xlim(0, 10)
-    plt.show()
+    return dipole.current_plot()
     
 
 def dipole_turn_off():
@@ -259,27 +61,7 @@ def dipole_turn_off():
     This function checks the state of the dipole, and turns it off if it isn't already.
     """
     
-    check_state = japc.getParam('RPPEF.BB4.RBIH.412435/STATE')
-    
-    if check_state['PC'] == 'OFF':
-        
-        print("PC current state: {}".format(check_state['PC']))
-        print("PC is already off. Do not need to turn off.")
-        return
-    
-    else:
-        
-        print("PC current state: {}".format(check_state['PC']))
-        print('Turning off...')
-        japc.setParam('RPPEF.BB4.RBIH.412435/MODE.PC', 'OFF')
-        
-        # Allow time to shutdown
-        
-        sleep(10)
-        
-        pc_state = japc.getParam('RPPEF.BB4.RBIH.412435/STATE')
-        
-        print("PC current state: {}".format(pc_state['PC']))
+    dipole.turn_off()
     
 
 if __name__ == "__main__":
@@ -305,11 +87,22 @@ if __name__ == "__main__":
     parser.add_argument('--current', dest='current', default=None, help='''
     This argument defines the value of the current that the dipole magnet should be set to. It is measured in Amps [A].''')
     
-    parser.add_argument('--ramp_duration', dest='ramp_duration', default=15, 
+    parser.add_argument('--ramp_duration', dest='ramp_duration', default=None, 
                         help='''
-    This argument defines the time over which the current should be ramped up to the desired value. It is measured in seconds [s].''')
+    This argument defines the time over which the current should be ramped up to the desired value. It is measured in seconds [s].
+    By default the shortest duration allowed by the dipole ramp rate limit is used, or 15s while
+    the limit has not been measured. Shorter durations are lengthened to the limit.''')
     
+    parser.add_argument('--power_cycle', dest='power_cycle', action='store_true', help='''
+    With --mode 'on', switch the PC off and on again even if it is already on.''')
+
+    tracing.add_arguments(parser)
+    metrics.add_arguments(parser)
+
     arguments = parser.parse_args()
+
+    tracing.from_arguments(arguments)
+    metrics.from_arguments(arguments)
     
     mode = arguments.mode
     
@@ -323,17 +116,18 @@ if __name__ == "__main__":
         
     elif mode == 'change':
         
-        change_current(arguments.current)
+        change_current(arguments.current, arguments.ramp_duration)
         
-    elif arguments.mode == 'on' and arguments.current is None or arguments.ramp_duration is None:
+    elif arguments.mode == 'on' and arguments.current is None:
         
-        parser.error("--mode 'on' also requires --current and --ramp_duration")
+        parser.error("--mode 'on' also requires --current")
         
     else:
         
         current_set = float(arguments.current)
-        ramp_duration_set = float(arguments.ramp_duration)
-        
-        dipole_turn_on(current_set, ramp_duration_set)
-        
+        ramp_duration_set = arguments.ramp_duration
         
+        dipole_turn_on(current_set, ramp_duration_set, arguments.power_cycle)
+
+    tracing.finish()
+    metrics.finish()
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+startup_benchmark.py
+
+Benchmark of the start-up time of the spectrometer magnet scripts. Each
+command is run in a fresh interpreter against the simulated control system,
+with tracing enabled, and the time from launching the process to its first
+JAPC get and set is taken from the trace. The import of each script is also
+checked for heavy modules, which should only be loaded by the modes that need
+them.
+
+The time to the first JAPC call is compared with STARTUP_BUDGET, and for the
+off and change commands, which start with the simulated converters already on,
+so is the time to their first set. Both include the start of the simulator,
+which loads NumPy; against the real control system the JVM start of pyjapc
+takes its place.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from collections import OrderedDict
+from statistics import median
+from time import time
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+# Maximum time from launching a command to its first JAPC call [s].
+STARTUP_BUDGET = 0.25
+
+# Modules which must not be loaded by importing a script.
+HEAVY_MODULES = ('numpy', 'matplotlib', 'pyjapc', 'pylogbook', 'jpype')
+
+# Command, PC state in which the simulated converters start, and whether its
+# first set is held to the budget.
+COMMANDS = OrderedDict([
+    ('dipole_off', (['spectrometer_dipole.py', '--mode', 'off'], 'IDLE', True)),
+    ('quadrupole_off', (['spectrometer_quadrupole.py', '--mode', 'off'], 'IDLE',
+                        True)),
+    ('dipole_change', (['spectrometer_dipole.py', '--mode', 'change',
+                        '--current', '10'], 'IDLE', True)),
+    ('quadrupole_change', (['spectrometer_quadrupole.py', '--mode', 'change',
+                            '--current', '10'], 'IDLE', True)),
+    ('dipole_on', (['spectrometer_dipole.py', '--mode', 'on', '--current', '10',
+                    '--ramp_duration', '1'], 'OFF', False)),
+    ('quadrupole_on', (['spectrometer_quadrupole.py', '--mode', 'on',
+                        '--current', '10'], 'OFF', False)),
+    ('spectrometer_status', (['spectrometer.py', '--mode', 'status'], 'OFF',
+                             False)),
+])
+
+SCRIPTS = ('spectrometer_dipole', 'spectrometer_quadrupole', 'spectrometer',
+           'magnet_client', 'magnet_daemon')
+
+
+def environment(speedup, state='OFF'):
+
+    env = dict(os.environ)
+    env['MAGNET_JAPC_BACKEND'] = 'sim'
+    env['MAGNET_SIM_SPEEDUP'] = str(speedup)
+    env['MAGNET_SIM_STATE'] = state
+
+    return env
+
+
+def run_command(arguments, speedup, state='OFF'):
+
+    """
+    Runs one command and returns a tuple (first_call, first_set, total) of
+    times since launch in seconds, with None for calls which were not made.
+    """
+
+    with tempfile.TemporaryDirectory() as directory:
+
+        trace = os.path.join(directory, 'trace.jsonl')
+        command = [sys.executable, os.path.join(DIRECTORY, arguments[0])] + \
+            arguments[1:] + ['--trace', trace]
+
+        start = time()
+        subprocess.run(command, env=environment(speedup, state),
+                       cwd=directory, stdout=subprocess.DEVNULL, check=True,
+                       timeout=120)
+        total = time() - start
+
+        with open(trace) as trace_file:
+            spans = [json.loads(line) for line in trace_file]
+
+    calls = [span['start'] for span in spans if span['kind'] in ('get', 'set')]
+    sets = [span['start'] for span in spans if span['kind'] == 'set']
+
+    return (min(calls) - start if calls else None,
+            min(sets) - start if sets else None, total)
+
+
+def interpreter_startup():
+
+    start = time()
+    subprocess.run([sys.executable, '-c', 'pass'], check=True)
+
+    return time() - start
+
+
+def heavy_imports(script):
+
+    """
+    Returns the heavy modules loaded by importing a script.
+    """
+
+    code = ("import sys; import {}; print(','.join(name for name in {!r} "
+            "if name in sys.modules))".format(script, HEAVY_MODULES))
+    output = subprocess.run([sys.executable, '-c', code], cwd=DIRECTORY,
+                            env=environment(1.), check=True,
+                            stdout=subprocess.PIPE, universal_newlines=True)
+
+    return [name for name in output.stdout.strip().split(',') if name]
+
+
+def run_benchmark(iterations=5, speedup=100.):
+
+    """
+    Runs every command the given number of times and returns the median
+    times as a dictionary.
+    """
+
+    results = OrderedDict()
+
+    for name, (arguments, state, _) in COMMANDS.items():
+
+        runs = [run_command(arguments, speedup, state)
+                for _ in range(iterations)]
+        results[name] = [median(values) if None not in values else None
+                         for values in zip(*runs)]
+
+    return results
+
+
+def print_results(results, python_startup, imports):
+
+    """
+    Prints the benchmark results and returns the names of commands over the
+    budget and of scripts loading heavy modules at import.
+    """
+
+    failures = []
+
+    def seconds(value):
+        return "{:7.3f}s".format(value) if value is not None else "       -"
+
+    print("\nInterpreter start-up: {:.3f}s, budget to first JAPC call, and "
+          "to first set of off and change: {:.3f}s\n".format(
+              python_startup, STARTUP_BUDGET))
+    print("{:<24s} {:>10s} {:>10s} {:>10s}".format(
+        "Command", "1st call", "1st set", "Total"))
+
+    for name, (first_call, first_set, total) in results.items():
+
+        flag = ""
+        check_set = COMMANDS[name][2]
+
+        if first_call is None or first_call > STARTUP_BUDGET or (
+                check_set and (first_set is None or
+                               first_set > STARTUP_BUDGET)):
+            flag = "  over budget"
+            failures.append(name)
+
+        print("{:<24s} {:>10s} {:>10s} {:>10s}{}".format(
+            name, seconds(first_call), seconds(first_set), seconds(total),
+            flag))
+
+    print("\nHeavy modules loaded at import:")
+
+    for script, modules in imports.items():
+
+        print("  {:<24s} {}".format(script, ", ".join(modules) or "none"))
+
+        if modules:
+            failures.append(script)
+
+    return failures
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="""
+    Benchmarks the start-up time of the spectrometer magnet scripts against the simulated
+    control system.
+    """, formatter_class=argparse.RawTextHelpFormatter)
+
+    parser.add_argument('--iterations', dest='iterations', type=int, default=5,
+                        help='''
+    Number of times each command is run.''')
+
+    parser.add_argument('--speedup', dest='speedup', type=float, default=100.,
+                        help='''
+    Factor by which simulated time runs faster than real time.''')
+
+    arguments = parser.parse_args()
+
+    results = run_benchmark(arguments.iterations, arguments.speedup)
+    imports = OrderedDict((script, heavy_imports(script)) for script in SCRIPTS)
+
+    failures = print_results(results, interpreter_startup(), imports)
+
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+state_wait.py
+
+Helpers for waiting on power converter state transitions in the AWAKE electron
+spectrometer scripts. Instead of sleeping for a fixed, worst-case time after
+every MODE.PC or reference write, the relevant property is polled with a short
+interval that grows geometrically until the requested value is seen or the
+transition times out.
+"""
+
+from time import sleep, monotonic
+
+import metrics
+from tracing import tracer
+
+
+def wait_for(read, accept, timeout=30., poll_interval=0.05,
+             max_poll_interval=0.5, backoff=1.5):
+
+    """
+    Repeatedly calls read() until accept(value) is true or the timeout expires.
+
+    Arguments:
+
+        - read                  Function with no arguments returning the
+                                current value of the quantity being waited on.
+
+        - accept                Function taking a value returned by read() and
+                                returning True once the wait is complete.
+
+        - timeout               Maximum time to wait. Measured in seconds [s].
+
+        - poll_interval         Time between the first two reads. Measured in
+                                seconds [s].
+
+        - max_poll_interval     Upper bound on the time between reads once the
+                                interval has been increased by the backoff
+                                factor. Measured in seconds [s].
+
+        - backoff               Factor by which the poll interval grows after
+                                every unsuccessful read.
+
+    Returns a tuple (value, reached, elapsed) with the last value read, whether
+    it was accepted, and the time spent waiting in seconds.
+    """
+
+    start = monotonic()
+    interval = poll_interval
+
+    while True:
+
+        value = read()
+        elapsed = monotonic() - start
+
+        if accept(value):
+            return value, True, elapsed
+
+        if elapsed >= timeout:
+            return value, False, elapsed
+
+        sleep(min(interval, timeout - elapsed))
+        interval = min(interval * backoff, max_poll_interval)
+
+
+def wait_for_state(japc, device, target, timeout=30., log=None, initial=None,
+                   **kwargs):
+
+    """
+    Waits until the PC state of a power converter is one of the target states.
+
+    Arguments:
+
+        - japc          The PyJapc instance used to read the converter.
+
+        - device        Name of the power converter device, for example
+                        'RPPEF.BB4.RBIH.412435'.
+
+        - target        A PC state name ('OFF', 'ON_STANDBY', 'IDLE', 'ARMED',
+                        'RUNNING') or a tuple of acceptable state names.
+
+        - timeout       Maximum time to wait for the transition. Measured in
+                        seconds [s].
+
+        - log           Optional TransitionLog on which the outcome of the
+                        transition is recorded.
+
+        - initial       PC state before the command which started the
+                        transition, recorded with the transition metrics.
+                        Defaults to the first state read.
+
+    Any further keyword arguments are passed on to wait_for(). Returns a tuple
+    (state, reached, elapsed).
+    """
+
+    targets = (target,) if isinstance(target, str) else tuple(target)
+    states = []
+
+    def read():
+
+        state = japc.getParam(device + '/STATE')['PC']
+
+        if not states:
+            states.append(state)
+
+        return state
+
+    state, reached, elapsed = wait_for(
+        read, lambda value: value in targets, timeout=timeout, **kwargs)
+
+    transition = 'STATE -> ' + '/'.join(targets)
+    tracer.record('wait', device, transition, state, elapsed,
+                  'ok' if reached else 'timeout')
+    metrics.observe_transition(device, initial if initial is not None
+                               else states[0], state, reached, elapsed)
+
+    if log is not None:
+        log.record(transition, state, reached, elapsed)
+
+    return state, reached, elapsed
+
+
+def wait_for_value(japc, parameter, expected, timeout=5., tolerance=1e-3,
+                   log=None, **kwargs):
+
+    """
+    Waits until a parameter reads back the expected value, for example after
+    writing REF.FUNC.TYPE or REF.PLEP.FINAL.
+
+    Arguments:
+
+        - japc          The PyJapc instance used to read the parameter.
+
+        - parameter     Full parameter name, 'DEVICE/PROPERTY'.
+
+        - expected      The value the parameter should read back.
+
+        - timeout       Maximum time to wait. Measured in seconds [s].
+
+        - tolerance     Allowed difference when the expected value is a
+                        float, since settings are read back in single
+                        precision.
+
+        - log           Optional TransitionLog on which the outcome of the
+                        wait is recorded.
+
+    Any further keyword arguments are passed on to wait_for(). Returns a tuple
+    (value, reached, elapsed).
+    """
+
+    if isinstance(expected, float):
+        accept = lambda value: abs(value - expected) <= tolerance
+    else:
+        accept = lambda value: value == expected
+
+    value, reached, elapsed = wait_for(
+        lambda: japc.getParam(parameter), accept,
+        timeout=timeout, **kwargs)
+
+    device, _, prop = parameter.partition('/')
+    tracer.record('wait', device, prop + ' = {}'.format(expected), value,
+                  elapsed, 'ok' if reached else 'timeout')
+
+    if log is not None:
+        log.record(prop + ' = {}'.format(expected), value, reached, elapsed)
+
+    return value, reached, elapsed
+
+
+class TransitionLog(object):
+
+    """
+    Records how long each waited-on transition of a control sequence actually
+    took, so that the hardware time of a turn on can be reported.
+    """
+
+    def __init__(self, name):
+
+        self.name = name
+        self.entries = []
+
+    def record(self, transition, value, reached, elapsed):
+
+        self.entries.append((transition, value, reached, elapsed))
+
+    def total(self):
+
+        return sum(entry[3] for entry in self.entries)
+
+    def report(self):
+
+        print("\n{} transition times:".format(self.name))
+
+        for transition, value, reached, elapsed in self.entries:
+
+            outcome = "ok" if reached else "TIMEOUT (last value {})".format(value)
+            print("  {:<30s} {:7.2f}s  {}".format(transition, elapsed, outcome))
+
+        print("  {:<30s} {:7.2f}s\n".format("Total", self.total()))
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+thread_output.py
+
+Per-thread redirection of printed output. The magnet procedures report their
+progress with print; a process running several of them at once, such as the
+magnet daemon or an energy scan, installs a ThreadOutput as sys.stdout and
+sends the output of each thread where it belongs, while threads without a
+sink, such as the publisher or the acquisition, keep printing to the console.
+Procedures run side by side can have each of their lines prefixed with the
+magnet they belong to.
+"""
+
+import sys
+import threading
+from contextlib import contextmanager
+
+
+class ThreadOutput(object):
+
+    """
+    Replacement for sys.stdout which sends the output of a thread to the sink
+    set for that thread, and everything else to the real stdout.
+    """
+
+    def __init__(self, stream):
+
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, text):
+
+        sink = getattr(self.local, 'sink', None)
+
+        if sink is None:
+            return self.stream.write(text)
+
+        sink(text)
+        return len(text)
+
+    def flush(self):
+
+        self.stream.flush()
+
+
+def install():
+
+    """
+    Installs a ThreadOutput as sys.stdout, unless one already is, and returns
+    it.
+    """
+
+    if not isinstance(sys.stdout, ThreadOutput):
+        sys.stdout = ThreadOutput(sys.stdout)
+
+    return sys.stdout
+
+
+class LinePrefixer(object):
+
+    """
+    Sink passing complete lines on to write, each preceded by a prefix, so
+    that the lines of threads printing at the same time are not mixed and
+    show which thread they came from.
+    """
+
+    lock = threading.Lock()
+
+    def __init__(self, prefix, write):
+
+        self.prefix = prefix
+        self.write = write
+        self.pending = ''
+
+    def __call__(self, text):
+
+        lines = (self.pending + text).split('\n')
+        self.pending = lines.pop()
+
+        if lines:
+            with self.lock:
+                self.write(''.join((self.prefix + line).rstrip() + '\n'
+                                   for line in lines))
+
+    def close(self):
+
+        if self.pending:
+            self('\n')
+
+
+def destination():
+
+    """
+    Returns the function to which what the calling thread prints is written.
+    """
+
+    output = install()
+
+    return getattr(output.local, 'sink', None) or output.stream.write
+
+
+@contextmanager
+def prefixed(prefix, write=None):
+
+    """
+    Context manager prefixing every line the calling thread prints in the
+    enclosed block, and passing it on to write, by default where the output
+    of the thread went before.
+    """
+
+    sink = LinePrefixer(prefix, write if write is not None else destination())
+
+    with redirect(sink):
+        try:
+            yield
+        finally:
+            sink.close()
+
+
+@contextmanager
+def redirect(sink):
+
+    """
+    Context manager sending what the calling thread prints in the enclosed
+    block to sink, a function taking the text, or dropping it if sink is None.
+    """
+
+    output = install()
+    previous = getattr(output.local, 'sink', None)
+    output.local.sink = sink if sink is not None else (lambda text: None)
+
+    try:
+        yield
+    finally:
+        output.local.sink = previous
@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+"""
+tracing.py
+
+Timing instrumentation of the spectrometer magnet control sequences. Every
+JAPC get and set, every wait and every magnet operation is recorded as a span
+(kind, device, property, value, duration, outcome). Spans are written to a
+JSON-lines trace file and can be summarised in a table at the end of a run, to
+find where the time of a sequence goes.
+
+Tracing is off until enable() is called; the disabled tracer costs one
+attribute check per call.
+"""
+
+import json
+import threading
+from contextlib import contextmanager
+from time import time, perf_counter
+
+
+def describe(value):
+
+    """
+    Returns a compact, JSON-serialisable form of a parameter value. Long
+    vectors such as the TSG41 GUI support vector are only described by their
+    length.
+    """
+
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+
+    if isinstance(value, dict):
+        return {str(key): describe(item) for key, item in value.items()}
+
+    try:
+        length = len(value)
+    except TypeError:
+        return str(value)
+
+    if length > 8:
+        return '<{} values>'.format(length)
+
+    return [describe(item) for item in value]
+
+
+def split_name(name):
+
+    if isinstance(name, (list, tuple)):
+        return 'group', ','.join(name)
+
+    device, _, prop = name.partition('/')
+    return device, prop
+
+
+class Tracer(object):
+
+    """
+    Collects spans and writes them to a JSON-lines file.
+
+    Arguments:
+
+        - path      File to which spans are appended, or None to only keep
+                    them in memory for the summary.
+    """
+
+    def __init__(self, path=None):
+
+        self.enabled = False
+        self.path = path
+        self.spans = []
+        self.lock = threading.Lock()
+        self._file = None
+
+    def start(self, path=None):
+
+        with self.lock:
+
+            if path is not None:
+                self.path = path
+
+            if self.path is not None and self._file is None:
+                self._file = open(self.path, 'a')
+
+            self.enabled = True
+
+    def stop(self):
+
+        with self.lock:
+
+            self.enabled = False
+
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def record(self, kind, device, prop, value, duration, outcome='ok',
+               start=None):
+
+        """
+        Records a completed span.
+
+        Arguments:
+
+            - kind          'get', 'set', 'wait' or 'operation'.
+
+            - device        Device name.
+
+            - prop          Property name, or a description of the wait or
+                            operation.
+
+            - value         Value read, written or waited for.
+
+            - duration      Duration of the span. Measured in seconds [s].
+
+            - outcome       'ok', 'timeout' or a description of the error.
+
+            - start         Unix time at which the span started.
+        """
+
+        if not self.enabled:
+            return
+
+        span = {'start': start if start is not None else time() - duration,
+                'kind': kind, 'device': device, 'property': prop,
+                'value': describe(value), 'duration': duration,
+                'outcome': outcome,
+                'thread': threading.current_thread().name}
+
+        with self.lock:
+
+            self.spans.append(span)
+
+            if self._file is not None:
+                self._file.write(json.dumps(span, default=str) + '\n')
+                self._file.flush()
+
+    @contextmanager
+    def span(self, kind, device, prop, value=None):
+
+        """
+        Context manager recording the enclosed block as a span. The outcome is
+        'ok' unless the block raises.
+        """
+
+        if not self.enabled:
+            yield
+            return
+
+        start = time()
+        begin = perf_counter()
+
+        try:
+            yield
+        except Exception as error:
+            self.record(kind, device, prop, value, perf_counter() - begin,
+                        'error: {}'.format(error), start)
+            raise
+
+        self.record(kind, device, prop, value, perf_counter() - begin,
+                    start=start)
+
+    def summary(self):
+
+        """
+        Returns a list of (kind, device, property, count, total, mean, max,
+        failures) tuples, sorted by decreasing total time.
+        """
+
+        groups = {}
+
+        with self.lock:
+
+            for span in self.spans:
+
+                key = (span['kind'], span['device'], span['property'])
+                groups.setdefault(key, []).append(span)
+
+        rows = []
+
+        for (kind, device, prop), spans in groups.items():
+
+            durations = [span['duration'] for span in spans]
+            failures = sum(1 for span in spans if span['outcome'] != 'ok')
+            rows.append((kind, device, prop, len(spans), sum(durations),
+                         sum(durations) / len(durations), max(durations),
+                         failures))
+
+        return sorted(rows, key=lambda row: -row[4])
+
+    def print_summary(self):
+
+        print("\n{:<10s} {:<24s} {:<30s} {:>5s} {:>8s} {:>8s} {:>8s} {:>5s}".format(
+            "Kind", "Device", "Property", "Count", "Total", "Mean", "Max",
+            "Fail"))
+
+        for kind, device, prop, count, total, mean, longest, failures in \
+                self.summary():
+
+            print("{:<10s} {:<24s} {:<30s} {:5d} {:7.3f}s {:7.3f}s {:7.3f}s "
+                  "{:5d}".format(kind, device[:24], prop[:30], count, total,
+                                 mean, longest, failures))
+
+
+class TracingJapc(object):
+
+    """
+    Wrapper around a PyJapc instance recording every get and set as a span.
+    Other attributes are passed through to the wrapped instance.
+    """
+
+    def __init__(self, japc, tracer):
+
+        self.japc = japc
+        self.tracer = tracer
+
+    def getParam(self, parameterName, **kwargs):
+
+        if not self.tracer.enabled:
+            return self.japc.getParam(parameterName, **kwargs)
+
+        device, prop = split_name(parameterName)
+        start = time()
+        begin = perf_counter()
+
+        try:
+            value = self.japc.getParam(parameterName, **kwargs)
+        except Exception as error:
+            self.tracer.record('get', device, prop, None,
+                               perf_counter() - begin,
+                               'error: {}'.format(error), start)
+            raise
+
+        self.tracer.record('get', device, prop, value, perf_counter() - begin,
+                           start=start)
+        return value
+
+    def setParam(self, parameterName, parameterValue, **kwargs):
+
+        device, prop = split_name(parameterName)
+
+        with self.tracer.span('set', device, prop, parameterValue):
+            return self.japc.setParam(parameterName, parameterValue, **kwargs)
+
+    def __getattr__(self, name):
+
+        return getattr(self.japc, name)
+
+
+tracer = Tracer()
+
+_summary = False
+_installed = False
+
+
+def enable(path=None, summary=False):
+
+    """
+    Starts recording spans, appending them to path if given, and installs the
+    tracing wrapper on the shared JAPC session.
+
+    Arguments:
+
+        - path      JSON-lines trace file, or None.
+
+        - summary   Whether finish() prints the summary table.
+    """
+
+    global _summary, _installed
+
+    from japc_session import provider
+
+    if not _installed:
+        provider.add_wrapper(lambda japc: TracingJapc(japc, tracer))
+        _installed = True
+
+    tracer.start(path)
+    _summary = summary
+
+
+def finish():
+
+    """
+    Prints the summary table if it was requested, and closes the trace file.
+    """
+
+    if tracer.enabled and _summary:
+        tracer.print_summary()
+
+    tracer.stop()
+
+
+def add_arguments(parser):
+
+    """
+    Adds the --trace and --trace_summary options to a command line parser.
+    """
+
+    parser.add_argument('--trace', dest='trace', default=None, help='''
+    Record the duration of every JAPC call, wait and operation to this JSON-lines file.''')
+
+    parser.add_argument('--trace_summary', dest='trace_summary',
+                        action='store_true', help='''
+    Print a table of where the time was spent at the end of the run.''')
+
+
+def from_arguments(arguments):
+
+    """
+    Enables tracing if requested by the options added with add_arguments().
+    """
+
+    if arguments.trace is not None or arguments.trace_summary:
+        enable(arguments.trace, arguments.trace_summary)